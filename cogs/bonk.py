@@ -1,10 +1,11 @@
 import datetime
 
 import discord
-from blitzdb import Document, FileBackend
+from blitzdb import Document
 from discord.ext import commands
 
 import util
+from util.tracing import TracedBackend
 
 
 class BonkCount(Document):
@@ -14,7 +15,7 @@ class BonkCount(Document):
 class Bonk(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.backend = FileBackend("db")
+        self.backend = TracedBackend("db")
         self.backend.autocommit = True
         self.config = bot.config["Bonk"]
         bot.logger.info("horny jail ready!")
@@ -1,17 +1,38 @@
+import asyncio
 import io
-from contextlib import contextmanager
+import threading
+import time
+import weakref
 from typing import List, Optional, Dict
 
 import discord
-import openai
-import yaml
 from discord.commands import SlashCommandGroup, Option
-from discord.ext import commands
-from blitzdb import Document, FileBackend
+from discord.ext import commands, tasks
+from blitzdb import Document
 
 import util
-from util.chatgpt import GPTUser, UserConfig, ConversationLine, Model, DEFAULT_FLAGS
-from util.souls import Soul, REMEMBRANCE_PROMPT
+import util.mockllm
+from util.chatgpt import (
+    GPTUser,
+    UserConfig,
+    ConversationLine,
+    Model,
+    DEFAULT_FLAGS,
+    ChannelSummary,
+    ModelRegistry,
+    measure,
+)
+from util.budget import BudgetPlanner, ContextPlan
+from util.cache import ResponseCache
+from util import metrics
+from util.history import MessageBuffer
+from util.quota import QuotaTracker, QuotaVerdict
+from util.settings import SettingsCache
+from util.translate import TranslationEngine, TranslationSession
+from util.usage import UsageTracker, split_completion
+from util.souls import render_remembrance_prompt, registry as soul_registry
+from util.tracing import TracedBackend
+from util import reload, transcript
 
 
 class PersistentUser(Document):
@@ -19,49 +40,301 @@ class PersistentUser(Document):
         primary_key = "uid"
 
 
+THREAD_PROMPT = (
+    "\nSeveral people are talking with you in this conversation. Each of their messages begins with the name of "
+    "the speaker, a colon, and then whatever the speaker said."
+)
+
+SUMMARY_PROMPT = (
+    "The following is a conversation between various people in a Discord chat. It is formatted such "
+    "that each line begins with the name of the speaker, a colon, and then whatever the speaker "
+    "said. Please provide a summary of the conversation beginning below: \n{text}\n"
+)
+
+# About how many tokens one chat message takes, for estimating the size of a summary before the messages are fetched
+MESSAGE_TOKENS = 30
+
+QUOTA_MESSAGE = (
+    "Sorry, the AI quota for you or this server has run out. Please try again later."
+)
+
+
 class ChatGPT(commands.Cog):
     gpt = SlashCommandGroup("ai", "AI chatbot", guild_ids=util.guilds)
+    intents = ("message_content",)
 
     def __init__(self, bot):
         self.bot = bot
         self.config = bot.config["ChatGPT"]
         self.users: Dict[int, GPTUser] = {}
-        self.backend = FileBackend("db")
+        # Shared conversations, keyed by the ID of the thread that owns them
+        self.threads: Dict[int, GPTUser] = {}
+        self.summaries: Dict[int, ChannelSummary] = {}
+        # Users in translation mode, keyed by user ID
+        self.translations: Dict[int, TranslationSession] = {}
+        # Held while a message is added to a conversation and answered, keyed like `users` or `threads`. Locks go
+        # away once nobody holds or waits for them.
+        self.conversation_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = (
+            weakref.WeakValueDictionary()
+        )
+        self.models = ModelRegistry(self.config)
+        self.backend = TracedBackend("db")
         self.backend.autocommit = True
-        openai.api_key = self.config["openai_api_key"]
-        util.chatgpt.anthropic_api.api_key = self.config["anthropic_api_key"]
+        # Usage and quota counters are written from a worker thread, so they get a backend of their own that nothing
+        # on the event loop touches, and the lock keeps a late flush and the one on unload from writing at once
+        self.usage_backend = TracedBackend("db")
+        self.usage_backend.autocommit = True
+        self.usage_lock = threading.Lock()
+        cache_config = self.config.get("response_cache", {})
+        self.response_cache = ResponseCache(
+            max_entries=cache_config.get("max_entries", 1024),
+            ttl=cache_config.get("ttl", 86400),
+            backend=self.backend if cache_config.get("persistent") else None,
+        )
+        self.response_cache.purge()
+        buffer_config = self.config.get("history_buffer", {})
+        self.history = MessageBuffer(
+            channels=buffer_config.get("channels", [])
+            + self.config.get("summary_channels", []),
+            per_channel=buffer_config.get("per_channel", 1000),
+            per_guild=buffer_config.get("per_guild", 5000),
+        )
+        self.user_settings = SettingsCache(
+            self.backend, PersistentUser, "uid", {"config": DEFAULT_FLAGS.value}
+        )
+        self.user_settings.preload()
+        usage_config = self.config.get("usage", {})
+        self.usage = UsageTracker(usage_config.get("latency_samples", 1000))
+        self.planner = (
+            BudgetPlanner(**self.config["context_budget"])
+            if "context_budget" in self.config
+            else None
+        )
+        self.quota = QuotaTracker(
+            self.config.get("quotas", {}), backend=self.usage_backend
+        )
+        translation_config = dict(self.config.get("translation", {}))
+        self.translation_window = translation_config.pop("window", 3)
+        self.translator = TranslationEngine(self.send_translation, **translation_config)
+        self.flush_usage.change_interval(minutes=usage_config.get("flush_interval", 5))
+        util.chatgpt.set_api_keys(
+            self.config["openai_api_key"], self.config["anthropic_api_key"]
+        )
+        if "mock" in self.config:
+            util.mockllm.configure(**self.config["mock"])
+        if self.config.get("summary_channels"):
+            self.refresh_summaries.change_interval(
+                minutes=self.config.get("summary_interval", 10)
+            )
+            self.refresh_summaries.start()
+        metrics.registry.gauge(
+            "pixlbot_ai_sessions",
+            "Conversations held in memory",
+            lambda: {("user",): len(self.users), ("thread",): len(self.threads)},
+            labels=["kind"],
+        )
         bot.logger.info("ChatGPT integration initialized")
 
-    @contextmanager
-    def get_persistent_userdata(self, userid: int) -> PersistentUser:
-        """Searches for a user's persistent data in the DB by id, returning it if found, or a new minimal set if not."""
-        try:
-            pu = self.backend.get(PersistentUser, {"uid": userid})
-        except PersistentUser.DoesNotExist:
-            pu = PersistentUser({"uid": userid, "config": DEFAULT_FLAGS.value})
-        yield pu
-        self.backend.save(pu)
+    def export_state(self) -> dict:
+        # Conversations only live in memory, so they're handed over to the reloaded cog
+        return {
+            "users": self.users,
+            "threads": self.threads,
+            "summaries": self.summaries,
+            "translations": self.translations,
+        }
+
+    def import_state(self, state: dict):
+        self.users.update(state["users"])
+        self.threads.update(state["threads"])
+        self.summaries.update(state["summaries"])
+        self.translations.update(state["translations"])
+
+    def apply_config(self, config) -> bool:
+        # Model settings, quotas and the context budget change in place; anything else needs the cog reloaded
+        changed = {
+            key
+            for key in config.keys() | self.config.keys()
+            if config.get(key) != self.config.get(key)
+        }
+        if any(
+            key not in ("default", "models", "quotas", "context_budget")
+            and not isinstance(key, int)
+            for key in changed
+        ):
+            return False
+        self.models.load(config)
+        with self.usage_lock:
+            # Turning quotas on restores their counters from the usage backend
+            self.quota.configure(config.get("quotas", {}))
+        self.planner = (
+            BudgetPlanner(**config["context_budget"])
+            if "context_budget" in config
+            else None
+        )
+        self.config = config
+        return True
+
+    def cog_unload(self):
+        self.refresh_summaries.cancel()
+        self.flush_usage.cancel()
+        self.save_usage(self.usage.take_pending(), self.quota.take_changed())
+
+    def save_usage(self, usage, windows) -> int:
+        """Writes usage and quota counters taken on the event loop. This blocks on the database.
+        :return: The number of records written
+        """
+        with self.usage_lock:
+            return self.usage.save(self.usage_backend, usage) + self.quota.save(
+                self.usage_backend, windows
+            )
 
-    async def send_to_model(self, user, conversation=None) -> Optional[str]:
+    async def send_to_model(
+        self,
+        user,
+        conversation=None,
+        model=None,
+        cache=False,
+        context=None,
+        command="chat",
+        max_tokens=None,
+    ) -> Optional[str]:
         """Sends a conversation to OpenAI for chat completion and returns what the model said in reply. The model
         details will be read from the provided GPTUser. If a conversation is provided, it will be sent to the model.
         Otherwise, the conversation will be read from the user object.
         :param conversation: A specific conversation to be replied to, rather than the user's conversation
         :type conversation: List[ConversationLine] or None
         :param GPTUser user: The user object associated with this conversation
+        :param model: A specific model to use rather than the user's model. Required if `user` is None.
+        :type model: Model or None
+        :param cache: Whether the response may be served from and stored in the response cache. Only set this for
+         requests where the same input always deserves the same answer, never for regular (stateful) chat.
+        :param context: The message, command context or channel the request was made from, for usage accounting. A
+         list of them shares the usage out between them.
+        :param str command: What the request was for, for usage accounting
+        :param max_tokens: A shorter reply length limit than the model's own
+        :type max_tokens: int or None
         :return: The response from the model, or none if there was a problem
         """
+        model = model or user.model
+        conversation = conversation or user.conversation
+        key = ResponseCache.key(model, conversation) if cache else None
+        if key:
+            response = self.response_cache.get(key)
+            if response:
+                return response
+        completion = None
+        started = time.perf_counter()
         try:
-            response = await user.model.send(conversation or user.conversation)
-            return response
+            completion = await model.complete(conversation, max_tokens)
         except Exception as e:
             self.bot.logger.error(e)
-            return None
+        latency = completion.latency if completion else time.perf_counter() - started
+        # A request made for several contexts at once, like a batch of translations, is charged to each in turn
+        contexts = context if isinstance(context, list) else [context]
+        shares = (
+            split_completion(completion, len(contexts))
+            if completion
+            else [None] * len(contexts)
+        )
+        for each, share in zip(contexts, shares):
+            guild = getattr(each, "guild", None)
+            author = getattr(each, "author", None)
+            self.usage.record(
+                guild.id if guild else None,
+                author.id if author else None,
+                model.model,
+                command,
+                share,
+                latency,
+            )
+            if share and self.quota.enabled:
+                self.quota.spend(
+                    guild.id if guild else None,
+                    author.id if author else None,
+                    share.prompt_tokens + share.completion_tokens,
+                )
+        metrics.LLM_REQUESTS.observe(
+            latency,
+            model=model.model,
+            command=command,
+            status="ok" if completion else "error",
+        )
+        if completion:
+            metrics.LLM_TOKENS.inc(
+                completion.prompt_tokens, model=model.model, kind="prompt"
+            )
+            metrics.LLM_TOKENS.inc(
+                completion.completion_tokens, model=model.model, kind="completion"
+            )
+            metrics.LLM_TOKENS.inc(
+                completion.cached_tokens, model=model.model, kind="cached"
+            )
+        if completion and self.planner:
+            self.planner.observe(model, completion)
+        response = completion.text if completion else None
+        if user:
+            user.last_completion = completion
+        if key and response:
+            self.response_cache.set(key, response)
+        return response
+
+    def check_quota(self, context, tokens: int) -> QuotaVerdict:
+        """Check a request of about `tokens` tokens against the quotas of the guild and user it came from
+        :param context: The message or command context the request was made from
+        """
+        if not self.quota.enabled:
+            return QuotaVerdict.OK
+        return self.quota.check(
+            context.guild.id if context.guild else None, context.author.id, tokens
+        )
+
+    async def check_estimated_quota(
+        self, context, model: Model, *texts: str, messages: int = 0
+    ) -> QuotaVerdict:
+        """Check a request against the quotas of the guild and user it came from, estimating its size as a prompt
+        made of `texts` plus `messages` chat messages that haven't been fetched yet, and the longest reply it may get
+        :param context: The message or command context the request was made from
+        :param model: The model the request would go to
+        """
+        if not self.quota.enabled:
+            return QuotaVerdict.OK
+        prompt = await measure(model.encoding, *texts)
+        prompt += messages * MESSAGE_TOKENS
+        return self.check_quota(
+            context,
+            min(prompt, model.max_context - model.max_tokens) + model.max_tokens,
+        )
+
+    def plan_context(
+        self, gu: GPTUser, model: Model, message_tokens: int
+    ) -> ContextPlan:
+        """Decide how much of a user's conversation to send to a model, and how long its reply may be"""
+        if not self.planner:
+            return ContextPlan(model.max_context - model.max_tokens, model.max_tokens)
+        return self.planner.plan(model, message_tokens, gu.recent_replies)
+
+    async def send_translation(
+        self, conversation: List[ConversationLine], model: Model, contexts: list
+    ) -> Optional[str]:
+        return await self.send_to_model(
+            None, conversation, model=model, context=contexts, command="translate"
+        )
 
     def remove_bot_mention(self, content: str) -> str:
         mention = self.bot.user.mention
         return content.replace(mention, "").strip()
 
+    def get_server_config(self, guild: Optional[discord.Guild]) -> dict:
+        """Returns the AI configuration for the given guild, or the default configuration if it has none"""
+        if guild:
+            return self.config.get(guild.id, self.config["default"])
+        return self.config["default"]
+
+    def get_model(self, guild: Optional[discord.Guild]) -> Model:
+        """Returns the model configured for the given guild"""
+        return self.models.get(guild.id if guild else None)
+
     def get_user_from_context(self, context, force_new=False, **kwargs) -> GPTUser:
         """Returns a new or existing GPTUser based on the `author` of the provided context.
         Generally, you should be using this rather than reaching directly into `self.users`
@@ -74,27 +347,36 @@ class ChatGPT(commands.Cog):
              promptinfo str: A short description of the provided system prompt
         """
         uid = context.author.id
-        if context.guild:
-            server_config = self.config.get(context.guild.id, self.config["default"])
-        else:
-            server_config = self.config["default"]
+        server_config = self.get_server_config(context.guild)
         sysprompt = kwargs.pop("sysprompt", None)
         promptinfo = kwargs.pop("promptinfo", None)
         gu = self.users.get(uid)
         if (not gu) or force_new or sysprompt:
-            with self.get_persistent_userdata(uid) as pu:
-                gu = GPTUser(
-                    uid=uid,
-                    uname=context.author.display_name,
-                    sysprompt=sysprompt or server_config["system_prompt"],
-                    prompt_info=promptinfo,
-                    model=Model(
-                        server_config["model_name"], vendor=server_config["vendor"]
-                    ),
-                    config=UserConfig(pu.config),
-                )
+            gu = GPTUser(
+                uid=uid,
+                uname=context.author.display_name,
+                sysprompt=sysprompt or server_config["system_prompt"],
+                prompt_info=promptinfo,
+                model=self.get_model(context.guild),
+                config=UserConfig(self.user_settings.get(uid).config),
+            )
+        elif gu.model not in self.models:
+            # The models were reloaded since this conversation started
+            gu.model = self.get_model(context.guild)
         return gu
 
+    def new_thread_conversation(self, thread: discord.Thread) -> GPTUser:
+        """Returns a new conversation to be shared by everyone talking in the given thread"""
+        server_config = self.get_server_config(thread.guild)
+        return GPTUser(
+            uid=thread.id,
+            uname=thread.name,
+            sysprompt=server_config["system_prompt"] + THREAD_PROMPT,
+            prompt_info="Thread",
+            model=self.get_model(thread.guild),
+            config=DEFAULT_FLAGS & ~UserConfig.NAMESUFFIX,
+        )
+
     def should_reply(self, message: discord.Message) -> bool:
         """Determine whether the given message should be replied to. TL;DR: DON'T reply to system messages,
         bot messages, @everyone pings, or anything in a NSFW channel. DO reply to direct messages where we
@@ -113,6 +395,8 @@ class ChatGPT(commands.Cog):
         elif isinstance(message.channel, discord.Thread):
             if message.channel.me and message.channel.member_count == 2:
                 return True
+            if message.channel.id in self.threads:
+                return self.bot.user.mentioned_in(message)
         elif self.bot.user.mentioned_in(message):
             return True
         else:
@@ -149,96 +433,173 @@ class ChatGPT(commands.Cog):
                 await message.reply(chunk, embed=em)
             em = None
 
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # A new gateway session means we may have missed messages, so the buffered history can't be trusted anymore
+        self.history.clear()
+        if not self.flush_usage.is_running():
+            self.flush_usage.start()
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if "content" in payload.data:
+            self.history.edit(
+                payload.channel_id, payload.message_id, payload.data["content"]
+            )
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.history.delete(payload.channel_id, payload.message_id)
+
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
+        self.history.add(message)
         if not self.should_reply(message):
             return
 
-        self.copy_public_reply(message)
-
         user_id = message.author.id
-        gu = self.get_user_from_context(message)
-
-        message.content = self.remove_bot_mention(message.content)
-        if gu.is_stale:
-            if gu.staleseen:
-                gu = self.get_user_from_context(message, True)
-
-        gu.push_conversation({"role": "user", "content": message.content})
-        if gu.soul:
-            # noinspection PyProtectedMember
-            gu.push_conversation(
-                {
-                    "role": "system",
-                    "content": REMEMBRANCE_PROMPT.format(**gu.soul._asdict()),
-                }
-            )
-        overflow = []
-        while gu.oversized:
-            overflow.append(gu.pop_conversation(0))
+        shared = message.channel.id in self.threads
+        if not shared and user_id in self.translations:
+            await self.continue_translation(message)
+            return
+        # One message at a time per conversation, or lines from people talking at once get interleaved
+        key = message.channel.id if shared else user_id
+        lock = self.conversation_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if shared:
+                gu = self.threads[message.channel.id]
+            else:
+                self.copy_public_reply(message)
+                gu = self.get_user_from_context(message)
 
-        async with message.channel.typing():
-            response = await self.send_to_model(gu)
-            telembed = None
-            warnings = ""
-            stats = ""
-            if gu.soul:
-                response, telepathy = util.souls.format_from_soul(response)
-                telembed = (
-                    util.mkembed(
-                        "info",
-                        "",
-                        title=f"{gu.soul.name}'s mind",
-                        feeling=telepathy[0],
-                        thought=telepathy[1],
-                        analysis=telepathy[2],
+            message.content = self.remove_bot_mention(message.content)
+            if gu.is_stale:
+                if gu.staleseen:
+                    gu = (
+                        self.new_thread_conversation(message.channel)
+                        if shared
+                        else self.get_user_from_context(message, True)
                     )
-                    if gu.config & UserConfig.TELEPATHY
-                    else None
+
+            if shared:
+                content = f"{message.author.display_name}: {message.content}"
+            else:
+                content = message.content
+            # Only a long message is counted in a worker process, anything else right here
+            message_tokens = await gu.count_tokens(content)
+            # Kept to take back out if the model can't be reached or the quota is used up
+            pushed = [{"role": "user", "content": content}]
+            gu.push_conversation(pushed[0], tokens=message_tokens)
+            if gu.soul:
+                pushed.append(
+                    {"role": "system", "content": render_remembrance_prompt(gu.soul)}
                 )
+                gu.push_conversation(pushed[1])
+            # Too long for the model: recent_conversation leaves out the oldest lines, the conversation keeps them
+            trimmed = gu.oversized
 
-            if response:
-                gu.conversation = [
-                    y
-                    for x, y in enumerate(gu.conversation)
-                    if (y["role"] == "system" and x == 0)
-                    or (y["role"] != "system" and x > 0)
-                ]  # Throw out any system prompts but the first one
-                gu.push_conversation({"role": "assistant", "content": response})
-                if gu.is_stale:
+            plan = self.plan_context(gu, gu.model, message_tokens)
+            verdict = self.check_quota(
+                message, min(gu.conversation_len, plan.context_tokens) + plan.max_tokens
+            )
+            if verdict == QuotaVerdict.REFUSE:
+                gu.remove_conversation(*pushed)
+                await message.reply(QUOTA_MESSAGE)
+                return
+            model = gu.model
+            if verdict == QuotaVerdict.DEGRADE:
+                model = self.models.degraded
+                plan = self.plan_context(gu, model, message_tokens)
+
+            async with message.channel.typing():
+                response = await self.send_to_model(
+                    gu,
+                    gu.recent_conversation(plan.context_tokens),
+                    model=model,
+                    context=message,
+                    max_tokens=plan.max_tokens,
+                )
+                telembed = None
+                warnings = ""
+                if response and verdict == QuotaVerdict.DEGRADE:
                     if gu.config & UserConfig.TERSEWARNINGS:
-                        warnings += "⏰❗ "
+                        warnings += "📉❗ "
                     else:
                         warnings += (
-                            "*This conversation is pretty old so the next time you talk to me, it will be a fresh "
-                            "start. Please take this opportunity to save our conversation using the /ai save command "
-                            "if you wish, or use /ai continue to keep this conversation going.*\n"
+                            "*You or this server are over the AI quota, so I answered with a smaller model and less of "
+                            "our conversation.*\n"
                         )
-                    gu.staleseen = True
-                if overflow:
-                    if gu.config & UserConfig.TERSEWARNINGS:
-                        warnings += "📏❗ "
-                    else:
-                        warnings += (
-                            "*Our conversation is getting too long so I had to forget some of the earlier context. You "
-                            "may wish to reset and/or save our conversation using the /ai commands if it is no "
-                            "longer useful.*\n"
+                stats = ""
+                if gu.soul:
+                    response, telepathy = util.souls.format_from_soul(response)
+                    telembed = (
+                        util.mkembed(
+                            "info",
+                            "",
+                            title=f"{gu.soul.name}'s mind",
+                            feeling=telepathy[0],
+                            thought=telepathy[1],
+                            analysis=telepathy[2],
                         )
-                    gu.conversation = overflow + gu.conversation
-                if gu.config & UserConfig.SHOWSTATS:
-                    stats = (
-                        f"\n\n*📏{gu.conversation_len}/{gu.model.max_context}{'(❗)' if gu.oversized else ''}  "
-                        f"{'👼' + gu.soul.name + '  ' if gu.soul else ''}"
-                        f"🗣️{gu.model.model}  "
-                        f"📝{'Default' if not gu.prompt_info else gu.prompt_info}  "
-                        f"*"
+                        if gu.config & UserConfig.TELEPATHY
+                        else None
                     )
-            else:
-                response = "Sorry, can't talk to OpenAI right now."
-                gu.pop_conversation()  # GPT didn't get the last thing the user said, so forget it
-            response = f"{warnings}\n{response}\n{stats}"
-            self.users[user_id] = gu
-            await self.reply(message, response, telembed)
+
+                if response:
+                    # Throw out any system prompts but the first one
+                    gu.remove_conversation(
+                        *(
+                            line
+                            for line in gu.conversation[1:]
+                            if line["role"] == "system"
+                        )
+                    )
+                    gu.push_conversation({"role": "assistant", "content": response})
+                    if gu.last_completion:
+                        gu.recent_replies.append(gu.last_completion.completion_tokens)
+                    if gu.is_stale:
+                        if gu.config & UserConfig.TERSEWARNINGS:
+                            warnings += "⏰❗ "
+                        else:
+                            warnings += (
+                                "*This conversation is pretty old so the next time you talk to me, it will be a fresh "
+                                "start. Please take this opportunity to save our conversation using the /ai save command "
+                                "if you wish, or use /ai continue to keep this conversation going.*\n"
+                            )
+                        gu.staleseen = True
+                    if trimmed:
+                        if gu.config & UserConfig.TERSEWARNINGS:
+                            warnings += "📏❗ "
+                        else:
+                            warnings += (
+                                "*Our conversation is getting too long so I had to forget some of the earlier context. You "
+                                "may wish to reset and/or save our conversation using the /ai commands if it is no "
+                                "longer useful.*\n"
+                            )
+                    if gu.config & UserConfig.SHOWSTATS:
+                        cached_tokens = (
+                            gu.last_completion.cached_tokens
+                            if gu.last_completion
+                            else 0
+                        )
+                        stats = (
+                            f"\n\n*📏{gu.conversation_len}/{gu.model.max_context}{'(❗)' if gu.oversized else ''}  "
+                            f"{'👼' + gu.soul.name + '  ' if gu.soul else ''}"
+                            f"🗣️{gu.model.model}  "
+                            f"{'💾' + str(cached_tokens) + '  ' if cached_tokens else ''}"
+                            f"📝{'Default' if not gu.prompt_info else gu.prompt_info}  "
+                            f"*"
+                        )
+                else:
+                    response = "Sorry, can't talk to OpenAI right now."
+                    # GPT didn't get the last thing the user said, so forget it
+                    gu.remove_conversation(*pushed)
+                response = f"{warnings}\n{response}\n{stats}"
+                if shared:
+                    self.threads[message.channel.id] = gu
+                else:
+                    self.users[user_id] = gu
+                await self.reply(message, response, telembed)
 
     @gpt.command(guild_ids=util.guilds)
     async def reset(
@@ -259,6 +620,7 @@ class ChatGPT(commands.Cog):
         )
         user_id = ctx.author.id
         self.users[user_id] = gu
+        self.translations.pop(user_id, None)
         response = "Your conversation history has been reset."
         if system_prompt:
             response += f"\nSystem prompt set to: {system_prompt}"
@@ -307,8 +669,18 @@ class ChatGPT(commands.Cog):
             )
 
     @gpt.command(guild_ids=util.guilds)
-    async def save_conversation(self, ctx):
-        """Save your current conversation with the bot to a text file"""
+    async def save_conversation(
+        self,
+        ctx,
+        file_format: Option(
+            str,
+            name="format",
+            description="Text to read, or an export that /ai load_conversation can restore",
+            choices=["text"] + [f"export ({c})" for c in transcript.compressions()],
+            default="text",
+        ),
+    ):
+        """Save your current conversation with the bot to a file"""
         user_id = ctx.author.id
         if user_id not in self.users:
             await ctx.respond(
@@ -318,20 +690,32 @@ class ChatGPT(commands.Cog):
 
         gu = self.get_user_from_context(ctx)
         bot_display_name = self.bot.user.display_name
-        formatted_conversation = gu.format_conversation(bot_display_name)
 
         try:
             with io.BytesIO() as temp_file:
-                temp_file.write(formatted_conversation.encode())
+                if file_format == "text":
+                    filename = "conversation.txt"
+                    temp_file.write(gu.format_conversation(bot_display_name).encode())
+                else:
+                    compression = file_format[len("export (") : -1]
+                    filename = (
+                        "conversation.jsonl"
+                        + {
+                            "none": "",
+                            "gzip": ".gz",
+                            "zstd": ".zst",
+                        }[compression]
+                    )
+                    transcript.write_export(gu, temp_file, compression)
                 temp_file.seek(0)
-                discord_file = discord.File(temp_file, filename="conversation.txt")
+                discord_file = discord.File(temp_file, filename=filename)
                 await ctx.author.send(
                     f"Here is your conversation with {bot_display_name}:",
                     file=discord_file,
                 )
 
             await ctx.respond(
-                "I've sent you a private message with your conversation history as a text file.",
+                "I've sent you a private message with your conversation history as a file.",
                 ephemeral=True,
             )
         except discord.Forbidden:
@@ -341,6 +725,137 @@ class ChatGPT(commands.Cog):
                 ephemeral=True,
             )
 
+    async def update_summary(
+        self, channel, num_messages: int, model: Model, context=None
+    ) -> Optional[ChannelSummary]:
+        """Brings the cached summary for a channel up to date and returns it. Only messages newer than the cached
+        watermark are fetched, and they are merged into the previous summary rather than re-summarizing everything.
+        If nothing has been said since the last summary, it is returned as-is without talking to the model. A summary
+        that reaches back fewer messages than asked for is redone from scratch.
+        :param channel: The channel to summarize
+        :param num_messages: The maximum number of messages a summary should cover
+        :param model: The model used to generate the summary
+        :param context: The command context that asked for the summary, if any, for usage accounting
+        :return: The updated summary, or None if the model could not be reached
+        """
+        cached = self.summaries.get(channel.id)
+        summary_message_id = cached.summary_message_id if cached else None
+        if cached and cached.message_count < num_messages:
+            cached = None
+        messages = await self.history.history(
+            channel, num_messages, cached.last_message_id if cached else None
+        )
+        messages = [m for m in messages if m.id != summary_message_id]
+        if not messages:
+            return cached
+        text = "\n".join(
+            [f"{message.author_name}: {message.content}" for message in messages]
+        )
+        merge = cached and len(messages) < num_messages
+        if merge:
+            sysprompt = (
+                f"The following is a summary of an earlier conversation between various people in a Discord chat, "
+                f"followed by the messages that have been sent since. The messages are formatted such that each "
+                f"line begins with the name of the speaker, a colon, and then whatever the speaker said. Please "
+                f"provide an updated summary of the whole conversation.\nSummary so far:\n{cached.summary}\n"
+                f"New messages:\n{text}\n"
+            )
+        else:
+            sysprompt = SUMMARY_PROMPT.format(text=text)
+        summary = await self.send_to_model(
+            None,
+            [{"role": "system", "content": sysprompt}],
+            model=model,
+            cache=True,
+            context=context or channel,
+            command="summarize" if context else "rolling_summary",
+        )
+        if not summary:
+            return None
+        self.summaries[channel.id] = ChannelSummary(
+            last_message_id=messages[-1].id,
+            summary=summary,
+            summary_message_id=summary_message_id,
+            # From scratch, it covers everything asked for, or everything there is if the channel has fewer messages
+            message_count=(
+                cached.message_count + len(messages) if merge else num_messages
+            ),
+        )
+        return self.summaries[channel.id]
+
+    @tasks.loop(minutes=10)
+    async def refresh_summaries(self):
+        """Keeps the rolling summaries of opted-in channels up to date so summarize_chat can answer right away"""
+        for channel_id in self.config.get("summary_channels", []):
+            channel = self.bot.get_channel(channel_id)
+            if not channel:
+                continue
+            num_messages = self.config.get("summary_messages", 50)
+            try:
+                await self.update_summary(
+                    channel, num_messages, self.get_model(channel.guild)
+                )
+            except Exception as e:
+                # One channel we can't read shouldn't stop the others, or the loop
+                self.bot.logger.error(
+                    f"Could not refresh the summary of {channel}: {e}"
+                )
+
+    @refresh_summaries.before_loop
+    async def before_refresh_summaries(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(minutes=5)
+    async def flush_usage(self):
+        """Writes the usage and quota counters recorded since the last run to the database in one batch"""
+        usage = self.usage.take_pending()
+        windows = self.quota.take_changed()
+        written = await asyncio.to_thread(self.save_usage, usage, windows)
+        if written:
+            self.bot.logger.debug(f"Saved {written} usage records")
+
+    @gpt.command(guild_ids=util.guilds)
+    async def load_conversation(
+        self,
+        ctx: discord.ApplicationContext,
+        file: Option(
+            discord.Attachment,
+            description="A conversation exported with /ai save_conversation",
+        ),
+    ):
+        """Pick up a saved conversation where you left off (warning: replaces your current conversation)"""
+        if file.size > transcript.MAX_SIZE:
+            await ctx.respond("That file is too large.", ephemeral=True)
+            return
+        await ctx.defer(ephemeral=True)
+        try:
+            data = await file.read()
+            gu = await asyncio.to_thread(
+                transcript.restore,
+                data,
+                ctx.author.id,
+                ctx.author.display_name,
+                self.get_model(ctx.guild),
+            )
+        except Exception as e:
+            await ctx.respond(
+                embed=util.mkembed(
+                    "error", f"Could not load that conversation: {repr(e)}"
+                ),
+                ephemeral=True,
+            )
+            return
+        self.users[gu.id] = gu
+        await ctx.respond(
+            embed=util.mkembed(
+                "done",
+                "Conversation loaded, just @mention me to continue it.",
+                lines=len(gu.conversation),
+                tokens=gu.conversation_len,
+            ),
+            ephemeral=True,
+        )
+
     @gpt.command(guild_ids=util.guilds)
     async def summarize_chat(
         self,
@@ -368,44 +883,61 @@ class ChatGPT(commands.Cog):
             )
             return
 
-        channel = ctx.channel
-        messages = await channel.history(limit=num_messages).flatten()
-        messages.reverse()  # Reverse the messages to get them in chronological order.
-
-        text = "\n".join(
-            [f"{message.author.name}: {message.content}" for message in messages]
-        )
-        sysprompt = (
-            f"{prompt}\n{text}"
-            if prompt
-            else (
-                f"The following is a conversation between various people in a Discord chat. It is formatted such "
-                f"that each line begins with the name of the speaker, a colon, and then whatever the speaker "
-                f"said. Please provide a summary of the conversation beginning below: \n{text}\n"
-            )
+        cached = None if prompt else self.summaries.get(ctx.channel.id)
+        verdict = await self.check_estimated_quota(
+            ctx,
+            gu.model,
+            prompt or SUMMARY_PROMPT,
+            cached.summary if cached else "",
+            messages=num_messages,
         )
+        if verdict == QuotaVerdict.REFUSE:
+            await ctx.respond(QUOTA_MESSAGE, ephemeral=True)
+            return
+        model = self.models.degraded if verdict == QuotaVerdict.DEGRADE else gu.model
 
-        conversation: List[ConversationLine] = [
-            {
-                "role": "system",
-                "content": sysprompt,
-            }
-        ]
+        channel = ctx.channel
         async with ctx.channel.typing():
             await ctx.respond("Working on the summary now", ephemeral=True)
-            loading_message = await ctx.send(
-                f"Now generating summary of the last {num_messages} messages…"
-            )
-            # noinspection PyTypeChecker
-            # This is a lint bug
-            summary = await self.send_to_model(gu, conversation)
-            if summary:
-                await loading_message.edit(
-                    content=f"Summary of the last {num_messages} messages:\n\n{summary}"
+            # The summary is only posted once it's done, so it's never part of what gets summarized
+            channel_summary = None
+            if prompt:
+                # Custom prompts are one-offs, so they are never merged into or stored in the channel's summary
+                messages = await self.history.history(channel, num_messages)
+                text = "\n".join(
+                    [
+                        f"{message.author_name}: {message.content}"
+                        for message in messages
+                    ]
+                )
+                conversation: List[ConversationLine] = [
+                    {"role": "system", "content": f"{prompt}\n{text}"}
+                ]
+                # noinspection PyTypeChecker
+                # This is a lint bug
+                summary = await self.send_to_model(
+                    gu,
+                    conversation,
+                    model=model,
+                    cache=True,
+                    context=ctx,
+                    command="summarize",
                 )
             else:
-                await loading_message.edit(
-                    content="Sorry, can't generate a summary right now."
+                channel_summary = await self.update_summary(
+                    channel, num_messages, model, context=ctx
+                )
+                summary = channel_summary.summary if channel_summary else None
+            if not summary:
+                await ctx.send("Sorry, can't generate a summary right now.")
+                return
+            summary_message = await ctx.send(
+                f"Summary of the last {num_messages} messages:\n\n{summary}"
+            )
+            if channel_summary:
+                # Don't count our own summary message as new chat the next time around
+                self.summaries[channel.id] = channel_summary._replace(
+                    summary_message_id=summary_message.id
                 )
 
     @gpt.command(guild_ids=util.guilds)
@@ -417,11 +949,9 @@ class ChatGPT(commands.Cog):
     ):
         """Load a soul core (warning: resets conversation)"""
         try:
-            with open(f"cores/{core.split(' ')[0]}") as file:
-                core_data = yaml.safe_load(file)
-            loaded_soul = Soul(**core_data)
+            soul_core = soul_registry.get(core)
             gu = self.get_user_from_context(ctx, True)
-            gu.soul = loaded_soul
+            gu.soul = soul_core.soul
             gu.config |= UserConfig.TELEPATHY if telepathy else gu.config
             self.users[gu.id] = gu
         except Exception as e:
@@ -449,6 +979,16 @@ class ChatGPT(commands.Cog):
             value="EXPERIMENTAL: load a soul core to have a conversation with a specific personality. Resets your "
             "current conversation. Use the reset command to return to normal.",
         )
+        help_embed.add_field(
+            name="thread_mode",
+            value="Use this in a thread to have everyone there share one conversation with the bot, rather than "
+            "each person having their own. Mention the bot to talk. Use it again to turn it off.",
+        )
+        help_embed.add_field(
+            name="save_conversation / load_conversation",
+            value="Save your conversation in one of the export formats to pick it up again later with "
+            "load_conversation, even after the bot restarts or the conversation times out.",
+        )
         help_embed.add_field(
             name="continue",
             value="Once a conversation is six hours old, the bot will say the next message is a fresh start. If you "
@@ -479,8 +1019,7 @@ class ChatGPT(commands.Cog):
             gu.config |= flag_to_toggle  # If the flag is not set, set it
 
         self.users[gu.id] = gu
-        with self.get_persistent_userdata(gu.id) as pu:
-            pu.config = gu.config.value
+        self.user_settings.update(gu.id, config=gu.config.value)
         await ctx.respond(
             f"{flag} has been {'enabled' if gu.config & flag_to_toggle else 'disaled'}.",
             ephemeral=True,
@@ -497,6 +1036,115 @@ class ChatGPT(commands.Cog):
         out += "```"
         await ctx.respond(out, ephemeral=True)
 
+    @gpt.command(guild_ids=util.guilds)
+    async def reload_models(self, ctx: discord.ApplicationContext):
+        """Re-read the config file to pick up new AI model settings (admin only)"""
+        if not util.is_admin(ctx.author, self.bot.config):
+            await ctx.respond("Access denied", ephemeral=True)
+            return
+        try:
+            result = await self.bot.reloader.reload()
+        except Exception as e:
+            await ctx.respond(
+                embed=util.mkembed("error", f"Could not reload models: {repr(e)}"),
+                ephemeral=True,
+            )
+            return
+        # This cog may have been reloaded, so the models are looked up on the cog that is loaded now
+        cog = self.bot.get_cog(self.qualified_name) or self
+        await ctx.respond(
+            embed=util.mkembed(
+                "done",
+                reload.summary(result),
+                default=repr(cog.models.get()),
+            ),
+            ephemeral=True,
+        )
+
+    @gpt.command(guild_ids=util.guilds)
+    async def thread_mode(self, ctx: discord.ApplicationContext):
+        """Toggle one shared conversation for everyone in this thread (thread owner or admin only)"""
+        if not isinstance(ctx.channel, discord.Thread):
+            await ctx.respond("This only works in threads.", ephemeral=True)
+            return
+        if ctx.author.id != ctx.channel.owner_id and not util.is_admin(
+            ctx.author, self.bot.config
+        ):
+            await ctx.respond("Access denied", ephemeral=True)
+            return
+        if self.threads.pop(ctx.channel.id, None):
+            await ctx.respond(
+                "This thread is back to everyone having their own conversation."
+            )
+            return
+        self.threads[ctx.channel.id] = self.new_thread_conversation(ctx.channel)
+        await ctx.respond(
+            "Everyone in this thread now shares one conversation with me. Mention me to talk!"
+        )
+
+    @gpt.command(guild_ids=util.guilds)
+    async def cache_stats(self, ctx: discord.ApplicationContext):
+        """Show how well the AI response cache is doing"""
+        await ctx.respond(
+            embed=util.mkembed(
+                "info", "AI response cache statistics", **self.response_cache.stats
+            ),
+            ephemeral=True,
+        )
+
+    @gpt.command(guild_ids=util.guilds)
+    async def usage(self, ctx: discord.ApplicationContext):
+        """Show AI token usage and latency since the bot started (admin only)"""
+        if not util.is_admin(ctx.author, self.bot.config):
+            await ctx.respond("Access denied", ephemeral=True)
+            return
+
+        def top(dimension: int, label) -> str:
+            totals = sorted(
+                self.usage.summarize(dimension).items(),
+                key=lambda i: i[1]["prompt_tokens"] + i[1]["completion_tokens"],
+                reverse=True,
+            )[:5]
+            return (
+                "\n".join(
+                    f"{label(k)}: {v['prompt_tokens'] + v['completion_tokens']} tokens in {v['requests']} requests"
+                    for k, v in totals
+                )
+                or "None yet"
+            )
+
+        def latencies(percentiles) -> str:
+            return (
+                "\n".join(
+                    f"{name}: {p['p50']:.2f}s / {p['p95']:.2f}s / {p['p99']:.2f}s"
+                    for name, p in percentiles
+                )
+                or "None yet"
+            )
+
+        def guild_name(guild_id) -> str:
+            guild = self.bot.get_guild(guild_id) if guild_id else None
+            return guild.name if guild else str(guild_id or "DM")
+
+        await ctx.respond(
+            embed=util.mkembed(
+                "info",
+                "AI usage since startup",
+                **self.usage.grand_total(),
+                top_servers=top(0, guild_name),
+                top_users=top(1, lambda uid: f"<@{uid}>" if uid else "Background"),
+                latency_by_model=latencies(
+                    (m, self.usage.latency_percentiles(model=m))
+                    for m in self.usage.summarize(2)
+                ),
+                latency_by_command=latencies(
+                    (c, self.usage.latency_percentiles(command=c))
+                    for c in self.usage.summarize(3)
+                ),
+            ),
+            ephemeral=True,
+        )
+
     @gpt.command(guild_ids=util.guilds)
     async def translate(
         self,
@@ -506,32 +1154,68 @@ class ChatGPT(commands.Cog):
         text: Option(str, "The text to be translated", required=True),
         keep_going: Option(
             bool,
-            "Stay in translation mode after translating line (warning: resets conversation)",
+            "Stay in translation mode, translating everything you say to me (use /ai reset to stop)",
             default=False,
         ),
     ):
         """Translate across languages"""
         await ctx.defer()
-        prompt = (
-            f"You are an expert translator, fluent in both {from_language} and {to_language}. "
-            f"The user will say something in {from_language}, you should repeat it back to them, "
-            f"and then repeat it again in {to_language}."
+        session = TranslationSession(
+            from_language, to_language, self.translation_window
         )
-        gu = self.get_user_from_context(
-            ctx,
-            True,
-            sysprompt=prompt,
-            promptinfo=f"Translator: {from_language} -> {to_language}",
+        model = self.get_model(ctx.guild)
+        verdict = await self.check_estimated_quota(
+            ctx, model, TranslationEngine.prompt(session, False), text
         )
-        gu.push_conversation({"role": "user", "content": text})
+        if verdict == QuotaVerdict.REFUSE:
+            await ctx.respond(QUOTA_MESSAGE)
+            return
+        if verdict == QuotaVerdict.DEGRADE:
+            model = self.models.degraded
         async with ctx.channel.typing():
-            response = await self.send_to_model(gu)
-            if not response:
-                response = "Sorry, could not communicate with OpenAI. Please try again."
-                gu.pop_conversation()
-            await ctx.respond(response)
-            if keep_going:
-                self.users[ctx.author.id] = gu
+            translation = await self.translator.translate(session, text, model, ctx)
+        if not translation:
+            await ctx.respond(
+                "Sorry, could not communicate with OpenAI. Please try again."
+            )
+            return
+        await ctx.respond(f"{text}\n\n{translation}")
+        if keep_going:
+            self.translations[ctx.author.id] = session
+
+    async def continue_translation(self, message: discord.Message):
+        """Translate a message from someone in translation mode"""
+        session = self.translations[message.author.id]
+        text = self.remove_bot_mention(message.content)
+        model = self.get_model(message.guild)
+        verdict = await self.check_estimated_quota(
+            message, model, TranslationEngine.prompt(session, False), text
+        )
+        if verdict == QuotaVerdict.REFUSE:
+            await message.reply(QUOTA_MESSAGE)
+            return
+        if verdict == QuotaVerdict.DEGRADE:
+            model = self.models.degraded
+        async with message.channel.typing():
+            translation = await self.translator.translate(session, text, model, message)
+        await self.reply(
+            message, translation or "Sorry, can't talk to OpenAI right now.", None
+        )
+
+    @gpt.command(guild_ids=util.guilds)
+    async def translation_stats(self, ctx: discord.ApplicationContext):
+        """Show how often translations are served from memory"""
+        await ctx.respond(
+            embed=util.mkembed(
+                "info",
+                "Translation memory statistics",
+                hits=self.translator.hits,
+                misses=self.translator.misses,
+                language_pairs=len(self.translator.memory),
+                active_sessions=len(self.translations),
+            ),
+            ephemeral=True,
+        )
 
 
 def setup(bot):
@@ -5,13 +5,16 @@ import pytz
 
 import aiohttp
 import discord
-from blitzdb import Document, FileBackend
-from bs4 import BeautifulSoup
+from blitzdb import Document
 from discord import ApplicationContext
 from discord.commands import SlashCommandGroup
 from discord.ext import commands
 
-from util import guilds
+from util import guilds, metrics, workers
+from util.startup import lazy_import
+from util.tracing import TracedBackend
+
+bs4 = lazy_import("bs4")
 
 
 class CrumblFlavor(Document):
@@ -40,11 +43,18 @@ def ingredients_to_emoji(ingredients):
 
 
 async def get_cookie_content(url) -> list[dict[str, str]]:
-    async with aiohttp.ClientSession(timeout=ClientTimeout(total=60)) as session:
+    async with aiohttp.ClientSession(
+        timeout=ClientTimeout(total=60), trace_configs=[metrics.trace_config("crumbl")]
+    ) as session:
         async with session.get(url) as response:
             html_content = await response.text()
 
-    soup = BeautifulSoup(html_content, "html.parser")
+    return await workers.run(parse_cookie_content, html_content)
+
+
+def parse_cookie_content(html_content: str) -> list[dict[str, str]]:
+    """Pick the flavors out of the nutrition page. Runs in a worker process, parsing the page takes a while."""
+    soup = bs4.BeautifulSoup(html_content, "html.parser")
 
     names = [name.text.strip() for name in soup.select("b.text-lg.sm\:text-xl")]
     descriptions = [
@@ -86,12 +96,18 @@ class CrumblWatch(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.bot.logger.info("Starting CrumblWatch")
-        self.backend = FileBackend("db")
+        self.backend = TracedBackend("db")
         self.backend.autocommit = True
         self.url = "https://crumblcookies.com/nutrition/regular"
 
-        # Start the background task to monitor the website content
-        self.bot.loop.create_task(self.check_website_content(self.url))
+        # Start the background task to monitor the website content, in one process only when sharded
+        self.task = None
+        if bot.runs_background_tasks:
+            self.task = self.bot.loop.create_task(self.check_website_content(self.url))
+
+    def cog_unload(self):
+        if self.task:
+            self.task.cancel()
 
     async def check_website_content(self, url):
         while True:
@@ -139,8 +155,11 @@ class CrumblWatch(commands.Cog):
                 value=f"{flavor['description']}\n{flavor['ingredients']}",
             )
         for channel_doc in notification_channels:
-            channel = self.bot.get_channel(channel_doc["channel_id"])
             try:
+                # The channel's guild may be on a shard another process runs, and so not in the cache
+                channel = self.bot.get_channel(
+                    channel_doc["channel_id"]
+                ) or await self.bot.fetch_channel(channel_doc["channel_id"])
                 await channel.send(embed=embed)
             except discord.NotFound:
                 pass
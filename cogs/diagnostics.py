@@ -0,0 +1,189 @@
+import time
+from typing import TYPE_CHECKING
+
+import discord
+from discord.commands import Option, SlashCommandGroup
+from discord.ext import commands
+
+import util
+from util import cachepolicy, commandsync, metrics, reload, startup
+
+if TYPE_CHECKING:
+    from main import PixlBot
+
+
+class Diagnostics(commands.Cog):
+    """Admin commands for looking into the health of the bot process"""
+
+    diag = SlashCommandGroup("diag", "Bot diagnostics", guild_ids=util.guilds)
+
+    def __init__(self, bot):
+        self.bot: PixlBot = bot
+        self.bot.logger.info("Diagnostics ready")
+
+    @diag.command(guild_ids=util.guilds)
+    async def loop(self, ctx: discord.ApplicationContext):
+        """Show event loop lag and the callbacks that blocked it most recently (admin only)"""
+        if not util.is_admin(ctx.author, self.bot.config):
+            await ctx.respond("Access denied", ephemeral=True)
+            return
+        monitor = self.bot.loop_monitor
+        if not monitor or not monitor.running:
+            await ctx.respond("The event loop monitor is not running.", ephemeral=True)
+            return
+        stalls = "\n".join(
+            f"<t:{int(stall.started)}:R> {stall.duration:.2f}s `{stall.location}`"
+            + (f" ({stall.event})" if stall.event else "")
+            for stall in reversed(list(monitor.stalls)[-10:])
+        )
+        await ctx.respond(
+            embed=util.mkembed(
+                "info",
+                stalls or "No stalls seen yet.",
+                title="Event loop health",
+                gateway_latency_ms=round(self.bot.latency * 1000, 1),
+                **monitor.stats(),
+                footer=f"Callbacks blocking the loop for over {monitor.threshold}s count as stalls",
+            ),
+            ephemeral=True,
+        )
+
+    @diag.command(guild_ids=util.guilds)
+    async def stall(self, ctx: discord.ApplicationContext):
+        """Show the full stack of the most recent stall (admin only)"""
+        if not util.is_admin(ctx.author, self.bot.config):
+            await ctx.respond("Access denied", ephemeral=True)
+            return
+        monitor = self.bot.loop_monitor
+        if not monitor or not monitor.stalls:
+            await ctx.respond("No stalls seen yet.", ephemeral=True)
+            return
+        stall = monitor.stalls[-1]
+        age = int(time.time() - stall.started)
+        await ctx.respond(
+            f"{stall.duration:.2f}s in `{stall.location}`, {age}s ago\n"
+            f"```{stall.stack[-(util.MAX_MESSAGE_LENGTH - 200):]}```",
+            ephemeral=True,
+        )
+
+    @diag.command(guild_ids=util.guilds)
+    async def errors(
+        self,
+        ctx: discord.ApplicationContext,
+        fingerprint: Option(
+            str, description="Show the full stack of this error", default=None
+        ),
+    ):
+        """Show the most recent errors, or the details of one of them (admin only)"""
+        if not util.is_admin(ctx.author, self.bot.config):
+            await ctx.respond("Access denied", ephemeral=True)
+            return
+        reporter = self.bot.errors
+        if fingerprint:
+            group = reporter.groups.get(fingerprint)
+            if not group:
+                await ctx.respond("No such error.", ephemeral=True)
+                return
+            await ctx.respond(
+                f"`{group.type}` in {group.event} at `{group.location}`, seen {group.count} times\n"
+                f"```{group.stack[-(util.MAX_MESSAGE_LENGTH - 200):]}```",
+                ephemeral=True,
+            )
+            return
+        errors = "\n".join(
+            f"`{group.fingerprint}` <t:{int(group.last_seen)}:R> **{group.count}x** {group.type} in "
+            f"{group.event} at `{group.location}`: {group.message[:100]}"
+            for group in reporter.recent()
+        )
+        await ctx.respond(
+            embed=util.mkembed(
+                "info",
+                errors or "No errors seen yet.",
+                title="Recent errors",
+                footer=f"{reporter.dropped} reports dropped while Sentry was falling behind",
+            ),
+            ephemeral=True,
+        )
+
+    @diag.command(guild_ids=util.guilds)
+    async def startup(self, ctx: discord.ApplicationContext):
+        """Show how long each cog and each deferred import took to load (admin only)"""
+        if not util.is_admin(ctx.author, self.bot.config):
+            await ctx.respond("Access denied", ephemeral=True)
+            return
+        await ctx.respond(
+            f"```{startup.report(self.bot.startup_timings)}```", ephemeral=True
+        )
+
+    @diag.command(guild_ids=util.guilds)
+    async def cache(self, ctx: discord.ApplicationContext):
+        """Show what each guild holds in the cache and roughly how much memory it takes (admin only)"""
+        if not util.is_admin(ctx.author, self.bot.config):
+            await ctx.respond("Access denied", ephemeral=True)
+            return
+        report = cachepolicy.report(self.bot)
+        await ctx.respond(f"```{report[:1990]}```", ephemeral=True)
+
+    @diag.command(guild_ids=util.guilds)
+    async def shards(self, ctx: discord.ApplicationContext):
+        """Show the latency and event count of each shard this process runs (admin only)"""
+        if not util.is_admin(ctx.author, self.bot.config):
+            await ctx.respond("Access denied", ephemeral=True)
+            return
+        if not isinstance(self.bot, discord.AutoShardedClient):
+            await ctx.respond("The bot isn't sharded.", ephemeral=True)
+            return
+        lines = [f"{self.bot.shard_count} shards, this process runs:"]
+        for shard_id, shard in sorted(self.bot.shards.items()):
+            events = metrics.SHARD_EVENTS.values.get((str(shard_id),), 0)
+            state = "down" if shard.is_closed() else f"{shard.latency * 1000:.0f}ms"
+            lines.append(f"  shard {shard_id:<4} {state:>8}  {int(events)} events")
+        background = "runs" if self.bot.runs_background_tasks else "doesn't run"
+        lines.append(f"This process {background} the background tasks")
+        table = "\n".join(lines)
+        await ctx.respond(f"```{table}```", ephemeral=True)
+
+    @diag.command(guild_ids=util.guilds)
+    async def resync(self, ctx: discord.ApplicationContext):
+        """Sync every application command to Discord, changed or not (admin only)"""
+        if not util.is_admin(ctx.author, self.bot.config):
+            await ctx.respond("Access denied", ephemeral=True)
+            return
+        await ctx.defer(ephemeral=True)
+        synced, _ = await commandsync.sync_changed(
+            self.bot, self.bot.backend, force=True
+        )
+        await ctx.respond(
+            embed=util.mkembed(
+                "done", f"Synced commands for {', '.join(synced)}", title="Resynced"
+            ),
+            ephemeral=True,
+        )
+
+    @diag.command(guild_ids=util.guilds)
+    async def reload(self, ctx: discord.ApplicationContext):
+        """Re-read the config file and reload the cogs whose config or code changed (admin only)"""
+        if not util.is_admin(ctx.author, self.bot.config):
+            await ctx.respond("Access denied", ephemeral=True)
+            return
+        await ctx.defer(ephemeral=True)
+        try:
+            result = await self.bot.reloader.reload()
+        except Exception as e:
+            await ctx.respond(
+                embed=util.mkembed("error", f"Config not reloaded: {repr(e)}"),
+                ephemeral=True,
+            )
+            return
+        await ctx.respond(
+            embed=util.mkembed(
+                "error" if result.failed else "done",
+                reload.summary(result),
+                title="Reloaded",
+            ),
+            ephemeral=True,
+        )
+
+
+def setup(bot):
+    bot.add_cog(Diagnostics(bot))
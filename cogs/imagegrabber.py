@@ -2,11 +2,30 @@ import asyncio
 import re
 
 import discord
-import requests
 from discord.ext import commands
 
+from util import metrics, workers
+from util.startup import lazy_import
+
+requests = lazy_import("requests")
+
+URL_PATTERN = re.compile(
+    r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
+)
+
+# Messages longer than this are searched for URLs in a worker process. Shorter ones take less time to search than to
+# send there and back.
+WORKER_LENGTH = 1000
+
+
+def find_urls(text: str) -> list:
+    """The pattern backtracks a lot, so long messages are searched in a worker process"""
+    return URL_PATTERN.findall(text)
+
 
 class ImageGrabber(commands.Cog):
+    intents = ("message_content",)
+
     def __init__(self, bot):
         self.bot = bot
         self.config = bot.config["ImageGrabber"]
@@ -17,12 +36,13 @@ class ImageGrabber(commands.Cog):
             "https://us-west2-rgbcast-nsfw.cloudfunctions.net/pixl-nsfwgrab",
             params={"target": url},
         )
+        metrics.observe_response("imagegrabber", result)
         if result.ok:
-            self.bot.logger.debug(f"Archived {url}")
+            self.bot.logger.debug("Archived %s", url)
             return True
         else:
             self.bot.logger.debug(
-                f"Archive failed: {result.status_code} - {result.content}"
+                "Archive failed: %s - %s", result.status_code, result.content
             )
             return False
 
@@ -45,10 +65,10 @@ class ImageGrabber(commands.Cog):
             for a in message.attachments:
                 await self.add_status_react(message, self.archive_send(a.url))
         else:
-            urls = re.findall(
-                r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))",
-                message.content,
-            )
+            if len(message.content) > WORKER_LENGTH:
+                urls = await workers.run(find_urls, message.content)
+            else:
+                urls = find_urls(message.content)
             for u in urls:
                 if re.search(r".+\.(png|gif|jpeg|jpg|bmp|mp4|m4v)$", message.content):
                     await self.add_status_react(message, self.archive_send(u))
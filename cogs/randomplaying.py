@@ -9,9 +9,20 @@ class RandomNowPlaying(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.config = bot.config["RandomNowPlaying"]
-        bot.loop.create_task(self._setnowplaying())
+        self.task = None
+        if bot.runs_background_tasks:
+            self.task = bot.loop.create_task(self._setnowplaying())
         bot.logger.info(f"ready, playing {len(self.config['items'])} games")
 
+    def cog_unload(self):
+        if self.task:
+            self.task.cancel()
+
+    def apply_config(self, config) -> bool:
+        # The items and intervals are read on every change, so the new ones take over from the next one
+        self.config = config
+        return True
+
     async def _setnowplaying(self):
         await self.bot.wait_until_ready()
         while self.bot.is_ready():
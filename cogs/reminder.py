@@ -1,17 +1,21 @@
 from datetime import datetime
 from typing import List, Optional
 
-import dateparser
 import discord
 import pytz
-from recurrent.event_parser import RecurringEvent
 from dateutil import rrule
-from blitzdb import Document, FileBackend
+from blitzdb import Document
 from discord import SlashCommandGroup, Option
 from discord.ext import commands, tasks
 
 import util
-from util import mkembed
+from util import metrics, mkembed, workers
+from util.settings import SettingsCache
+from util.startup import lazy_import
+from util.tracing import TracedBackend
+
+dateparser = lazy_import("dateparser")
+event_parser = lazy_import("recurrent.event_parser")
 
 
 class ReminderEntry(Document):
@@ -60,7 +64,7 @@ def _parse_convert_dates(when, now, tz):
     :raises ValueError:  if the provided time string cannot be parsed
     """
     reminder_time = dateparser.parse(when)  # Time zone naïve
-    recurring_handler = RecurringEvent(now_date=now)
+    recurring_handler = event_parser.RecurringEvent(now_date=now)
     instances = []
 
     first_time = reminder_time if reminder_time else recurring_handler.parse(when)
@@ -95,35 +99,44 @@ class Reminder(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.backend = FileBackend("db")
+        self.backend = TracedBackend("db")
         self.backend.autocommit = True
-        self.check_reminders.start()
+        self.user_settings = SettingsCache(
+            self.backend,
+            ReminderInteractedUser,
+            "user_id",
+            {"tz": "UTC", "disclaimed": False},
+        )
+        self.user_settings.preload()
+        # Reminders waiting to be delivered, counted once and then kept up to date, so scrapes don't read the database
+        self.queued = len(self.backend.filter(ReminderEntry, {}))
+        # With sharding, reminders are only delivered from the process that has shard 0
+        if bot.runs_background_tasks:
+            self.check_reminders.start()
+        metrics.registry.gauge(
+            "pixlbot_reminders_queued",
+            "Reminders waiting to be delivered",
+            lambda: self.queued,
+        )
         bot.logger.info("Reminder ready")
 
+    def cog_unload(self):
+        self.check_reminders.cancel()
+
     async def init_user(
         self, ctx: discord.ApplicationContext
     ) -> Optional[ReminderInteractedUser]:
         # noinspection PyTypeChecker
         user: discord.Member = ctx.author
-        try:
-            interacted = self.backend.get(ReminderInteractedUser, {"user_id": user.id})
-        except ReminderInteractedUser.DoesNotExist:
-            if not await _send_disclaimer(user, True, ctx):
+        interacted = self.user_settings.find(user.id)
+        if not interacted or not interacted.disclaimed:
+            if not await _send_disclaimer(user, not interacted, ctx):
                 return None
-            interacted = ReminderInteractedUser(
-                {"user_id": user.id, "tz": "UTC", "disclaimed": True}
-            )
-            self.backend.save(interacted)
-        if not interacted.disclaimed:
-            if not await _send_disclaimer(user, False, ctx):
-                return None
-            interacted.disclaimed = True
-            self.backend.save(interacted)
+            interacted = self.user_settings.update(user.id, disclaimed=True)
         return interacted
 
     def get_user_tz(self, uid: int):
-        user = self.backend.get(ReminderInteractedUser, {"user_id": uid})
-        return pytz.timezone(user.tz)
+        return pytz.timezone(self.user_settings.get(uid).tz)
 
     def reschedule_reminder(self, reminder: ReminderEntry, new_time=0):
         """Reschedule the provided reminder. If any timestamp is provided, the reminder time will be set to that
@@ -137,6 +150,11 @@ class Reminder(commands.Cog):
             reminder.time = reminder.instances.pop(0)
         self.backend.save(reminder)
 
+    def delete_reminder(self, reminder: ReminderEntry):
+        """Delete a reminder that's been delivered, given up on or cleared"""
+        self.backend.delete(reminder)
+        self.queued -= 1
+
     async def get_due_reminders(self) -> List[ReminderEntry]:
         """Retrieves a list of all reminders due to be delivered (has a UNIX timestamp now or in the past)"""
         now_timestamp = int(datetime.now(tz=self.local_tzinfo).timestamp())
@@ -164,7 +182,7 @@ class Reminder(commands.Cog):
                     f"Reminder delivery failed: {e}, Failure count {reminder.fails}"
                 )
                 if reminder.fails >= 3:
-                    self.backend.delete(reminder)
+                    self.delete_reminder(reminder)
                     return
                 else:
                     self.reschedule_reminder(reminder, reminder.time + 600)
@@ -175,7 +193,7 @@ class Reminder(commands.Cog):
             elif reminder.instances:
                 self.reschedule_reminder(reminder)
             else:
-                self.backend.delete(reminder)
+                self.delete_reminder(reminder)
 
     @tasks.loop(seconds=10)
     async def check_reminders(self):
@@ -207,8 +225,9 @@ class Reminder(commands.Cog):
         now: datetime = datetime.now()
 
         try:
-            now_ts, reminder_ts, instances = _parse_convert_dates(
-                when, now, user_timezone
+            # Parsing natural language dates is slow enough to hold up everything else, so it's done in a worker
+            now_ts, reminder_ts, instances = await workers.run(
+                _parse_convert_dates, when, now, user_timezone
             )
         except ValueError:
             await ctx.respond(
@@ -232,6 +251,7 @@ class Reminder(commands.Cog):
         )
         friendly = datetime.fromtimestamp(reminder_ts, user_timezone).strftime("%c %Z")
         self.backend.save(reminder)
+        self.queued += 1
         await ctx.respond(
             embed=mkembed("done", f"Reminder set for {friendly}"),
             ephemeral=True,
@@ -242,7 +262,7 @@ class Reminder(commands.Cog):
         """Removes all your reminders"""
         user_id = ctx.author.id
         for reminder in self.backend.filter(ReminderEntry, {"user_id": user_id}):
-            self.backend.delete(reminder)
+            self.delete_reminder(reminder)
         await ctx.respond(
             embed=mkembed("done", "All your reminders have been cleared."),
             ephemeral=True,
@@ -255,7 +275,8 @@ class Reminder(commands.Cog):
         zone: Option(str, description="A time zone name like 'America/Chicago'"),
     ):
         """Set your time zone for reminder messages"""
-        user = await self.init_user(ctx)
+        if not await self.init_user(ctx):
+            return
         try:
             pytz.timezone(zone)
         except pytz.UnknownTimeZoneError:
@@ -269,8 +290,7 @@ class Reminder(commands.Cog):
             )
             return
         else:
-            user.tz = zone
-            self.backend.save(user)
+            self.user_settings.update(ctx.author.id, tz=zone)
             await ctx.respond(
                 embed=mkembed("done", "Time zone updated successfully", zone=zone),
                 ephemeral=True,
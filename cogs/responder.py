@@ -1,12 +1,13 @@
 from typing import Optional
 
 import discord
-from blitzdb import Document, FileBackend
+from blitzdb import Document
 from discord.commands import Option, SlashCommandGroup
 from discord.ext import commands
 
 import util
 from util import mkembed
+from util.tracing import TracedBackend
 
 respond_to = Option(str, name="respond_to", description="Text to respond to")
 response = Option(str, name="response", description="Text to reply with")
@@ -30,10 +31,11 @@ class Responder(commands.Cog):
     autoresponder = SlashCommandGroup(
         "autoresponder", "Set automatic replies to certain text", guild_ids=util.guilds
     )
+    intents = ("message_content",)
 
     def __init__(self, bot):
         self.bot = bot
-        self.backend = FileBackend("db")
+        self.backend = TracedBackend("db")
         self.backend.autocommit = True
         bot.logger.info("ready")
 
@@ -57,7 +59,7 @@ class Responder(commands.Cog):
         In general, if a user or channel restriction is set on a command, it can only be used when called in the
         listed channel or by the listed user.
         """
-        self.bot.logger.debug(f"Restriction dump: {comm.get('restrictions')}")
+        self.bot.logger.debug("Restriction dump: %s", comm.get("restrictions"))
         if not comm.get("restrictions"):
             # No restrictions on this command, we can respond without doing anything else.
             return True
@@ -175,7 +177,9 @@ class Responder(commands.Cog):
             )
             self.backend.save(comm)
             display_users = [
-                self.bot.get_user(u).display_name for u in comm["restrictions"]["users"]
+                # Users aren't necessarily cached without the members intent
+                getattr(self.bot.get_user(u), "display_name", f"<@{u}>")
+                for u in comm["restrictions"]["users"]
             ]
             await ctx.send(
                 embed=mkembed(
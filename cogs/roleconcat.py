@@ -16,12 +16,18 @@ class RoleConcat(commands.Cog):
         description="Takes all the people here and puts them over there",
         guild_ids=util.guilds,
     )
+    # Role membership comes from the member cache
+    intents = ("members",)
 
     def __init__(self, bot):
         self.bot: PixlBot = bot
         self.config = bot.config["RoleConcat"]
         self.bot.logger.info("ready")
 
+    def apply_config(self, config) -> bool:
+        self.config = config
+        return True
+
     @roleconcat.command(
         name="reconcile_roles",
         description="Re-evaluate all roleconcat rules",
@@ -34,6 +40,9 @@ class RoleConcat(commands.Cog):
             f"Reconciled, made {chgcount} change{'s' if chgcount > 1 else ''}"
         )
 
+    def member_guilds(self):
+        return self.config["servers"].keys()
+
     async def reconcile_roles(self, server: discord.Guild) -> int:
         if server.id not in self.config["servers"]:
             return 0
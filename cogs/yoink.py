@@ -2,10 +2,13 @@ import re
 from typing import List, Optional
 
 import discord
-import requests
 from discord.ext import commands
 
 import util
+from util import metrics
+from util.startup import lazy_import
+
+requests = lazy_import("requests")
 
 
 class Yoink(commands.Cog):
@@ -31,13 +34,14 @@ class Yoink(commands.Cog):
                 "data": None,
                 "animated": rd.get("animated"),
             }
-            self.bot.logger.debug(emo)
+            self.bot.logger.debug("Found emoji %s", emo)
             outputs.append(emo)
         return outputs
 
     def _download_emoji(self, e: dict) -> Optional[dict]:
-        self.bot.logger.debug(f"Downloading emoji from {e['url']}")
+        self.bot.logger.debug("Downloading emoji from %s", e["url"])
         r = requests.get(e["url"])
+        metrics.observe_response("yoink", r)
         if r.ok:
             e["data"] = r.content
             return e
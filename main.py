@@ -1,15 +1,71 @@
 # -*- coding: UTF-8 -*-
+import asyncio
 import atexit
+import math
 import sys
-import traceback
+import time
 from abc import ABC
+from typing import Optional
 
+import aiohttp
 import discord
-import yaml
-from discord.ext.commands.bot import Bot
+from blitzdb import FileBackend
+from discord.gateway import DiscordClientWebSocketResponse
+from discord.http import HTTPClient, Route
+from discord.ext.commands import Cog
+from discord.ext.commands.bot import AutoShardedBot, Bot
 
-from util import log
-from util import update_guilds
+from util import (
+    cachepolicy,
+    commandsync,
+    log,
+    metrics,
+    sharding,
+    startup,
+    tracing,
+    workers,
+)
+from util.errors import ErrorReporter
+from util.loopmon import LoopMonitor
+from util.reload import Reloader
+from util import update_guilds, load_config
+
+
+def _event_guild(args) -> Optional[int]:
+    """The ID of the guild an event happened in, if it has one"""
+    for arg in args:
+        guild = arg if isinstance(arg, discord.Guild) else getattr(arg, "guild", None)
+        if isinstance(guild, discord.Guild):
+            return guild.id
+    return None
+
+
+class InstrumentedHTTPClient(HTTPClient):
+    """py-cord's HTTP client, with its requests timed through an aiohttp trace config. py-cord has no way to pass trace
+    configs, so the two places it creates its session are overridden."""
+
+    def _new_session(self) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            connector=self.connector,
+            ws_response_class=DiscordClientWebSocketResponse,
+            trace_configs=[metrics.trace_config("discord", by_route=True)],
+        )
+
+    def recreate(self):
+        if self._HTTPClient__session.closed:
+            self._HTTPClient__session = self._new_session()
+
+    async def static_login(self, token: str):
+        self._HTTPClient__session = self._new_session()
+        old_token = self.token
+        self.token = token
+        try:
+            return await self.request(Route("GET", "/users/@me"))
+        except discord.HTTPException as exc:
+            self.token = old_token
+            if exc.status == 401:
+                raise discord.LoginFailure("Improper token has been passed.") from exc
+            raise
 
 
 # noinspection PyDunderSlots
@@ -21,59 +77,202 @@ class PixlBot(Bot, ABC):
 
     # noinspection PyUnresolvedReferences
     def __init__(self, bot_config: dict = None):
-        i = discord.Intents()
-        i.guilds = True
-        i.members = True
-        i.messages = True
-        i.message_content = True
         self.loaded = False
-        super().__init__(bot_config["system"]["command_prefix"], intents=i)
+        self.startup_timings = []
+        update_guilds(bot_config["system"]["guilds"])
+        # Only the intents the configured cogs declare, and member lists only for the guilds that need them
+        self.declared_intents = cachepolicy.declared_intents(
+            bot_config["system"]["plugins"]
+        )
+        max_messages = bot_config["system"].get("max_messages", 1000)
+        super().__init__(
+            bot_config["system"]["command_prefix"],
+            intents=cachepolicy.make_intents(self.declared_intents),
+            chunk_guilds_at_startup=False,
+            max_messages=max_messages or None,
+            **sharding.options(bot_config),
+        )
         self.config = bot_config
-        self.logger = log.init_logger("bot", bot_config["system"]["log_level"])
+        self.logger = log.init_logger(
+            "bot",
+            bot_config["system"]["log_level"],
+            bot_config["system"].get("log_format", "text"),
+            bot_config["system"].get("log_rate_limit"),
+        )
         self.logger.info("Ohai! Initializing..")
         self.atshutdown = []
-        update_guilds(bot_config["system"]["guilds"])
+        self.backend = FileBackend("db")
+        for intent, cogs in self.declared_intents.items():
+            self.logger.info(f"Intent {intent} enabled for {', '.join(cogs)}")
         # Sentry.io integration
         if "sentry" in self.config.keys():
             import sentry_sdk
 
             self.sentry = sentry_sdk
             self.sentry.init(
-                self.config["sentry"]["init_url"], environment="production"
+                self.config["sentry"]["init_url"],
+                environment="production",
+                **tracing.init_options(self.config["sentry"]),
             )
             self.logger.warning("sentry.io integration enabled")
+            if "traces_sample_rate" in self.config["sentry"]:
+                tracing.enable(self.sentry)
+                self.logger.warning("sentry.io performance tracing enabled")
+        # Grouping, rate limiting and history for errors raised by event listeners
+        self.errors = ErrorReporter(
+            self.logger, self.sentry, **self.config["system"].get("errors", {})
+        )
+        # Reloading config and cogs without reconnecting
+        reload_config = dict(self.config["system"].get("reload", {}))
+        self.watch_files = reload_config.pop("watch", False)
+        self.reloader = Reloader(self, **reload_config)
+        # Event loop lag monitoring, on unless `loop_monitor: false` is set
+        monitor_config = self.config["system"].get("loop_monitor", {})
+        self.loop_monitor = None
+        if monitor_config is not False:
+            self.loop_monitor = LoopMonitor(
+                self.logger, self.sentry, **(monitor_config or {})
+            )
+        # Worker processes for CPU-heavy work, on unless `workers: false` is set
+        worker_config = self.config["system"].get("workers", {})
+        if worker_config is not False:
+            workers.pool = workers.WorkerPool(**(worker_config or {}))
+        # Prometheus metrics and liveness endpoint, only if configured
+        self.metrics_server = None
+        if "metrics" in self.config["system"]:
+            self.metrics_server = metrics.MetricsServer(
+                self, **self.config["system"]["metrics"]
+            )
+            self._register_metrics()
+            # Time every Discord API request by route. The connection state was handed the old client, so it gets the
+            # new one too. Sentry's aiohttp integration already traces these requests.
+            self.http = InstrumentedHTTPClient(
+                self.http.connector,
+                proxy=self.http.proxy,
+                proxy_auth=self.http.proxy_auth,
+                unsync_clock=not self.http.use_clock,
+                loop=self.loop,
+            )
+            self._connection.http = self.http
+
+    @property
+    def runs_background_tasks(self) -> bool:
+        """Whether this host runs the background tasks, which must only run once across all shards"""
+        return sharding.runs_background_tasks(getattr(self, "shard_ids", None))
+
+    def _register_metrics(self):
+        metrics.registry.gauge(
+            "pixlbot_gateway_latency_seconds",
+            "Discord gateway heartbeat latency",
+            lambda: None if math.isinf(self.latency) else self.latency,
+        )
+        metrics.registry.gauge(
+            "pixlbot_guilds", "Guilds in the cache", lambda: len(self.guilds)
+        )
+        metrics.registry.gauge(
+            "pixlbot_members",
+            "Members across all guilds, as reported by Discord",
+            lambda: sum(g.member_count or 0 for g in self.guilds),
+        )
+        metrics.registry.gauge(
+            "pixlbot_cached_users", "Users in the cache", lambda: len(self.users)
+        )
+        if self.loop_monitor:
+            metrics.registry.gauge(
+                "pixlbot_loop_lag_seconds",
+                "Event loop lag over recent heartbeats",
+                lambda: {
+                    ("0.5",): self.loop_monitor.stats()["lag_p50_ms"] / 1000,
+                    ("0.99",): self.loop_monitor.stats()["lag_p99_ms"] / 1000,
+                },
+                labels=["quantile"],
+            )
+
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        listener = getattr(coro, "__qualname__", str(coro))
+        owner = getattr(coro, "__self__", None)
+        started = time.perf_counter()
+        try:
+            with log.bound(
+                cog=owner.qualified_name if isinstance(owner, Cog) else None,
+                guild=_event_guild(args),
+            ):
+                if event_name == "interaction" and owner is self:
+                    # Application commands are traced on their own, in invoke_application_command
+                    await super()._run_event(coro, event_name, *args, **kwargs)
+                else:
+                    with tracing.transaction(
+                        listener, "discord.event", event=event_name
+                    ):
+                        await super()._run_event(coro, event_name, *args, **kwargs)
+        finally:
+            metrics.EVENTS.observe(
+                time.perf_counter() - started,
+                event=event_name,
+                listener=listener,
+            )
+
+    async def invoke_application_command(self, ctx: discord.ApplicationContext):
+        started = time.perf_counter()
+        status = "error"
+        try:
+            with log.bound(
+                cog=ctx.cog.qualified_name if ctx.cog else None,
+                guild=ctx.guild_id,
+                command=ctx.command.qualified_name,
+            ), tracing.transaction(
+                ctx.command.qualified_name, "discord.command"
+            ) as transaction:
+                await super().invoke_application_command(ctx)
+                status = "error" if getattr(ctx, "command_failed", False) else "ok"
+                if transaction:
+                    transaction.set_status("ok" if status == "ok" else "internal_error")
+        finally:
+            metrics.COMMANDS.observe(
+                time.perf_counter() - started,
+                command=ctx.command.qualified_name,
+                status=status,
+            )
 
     async def on_error(self, event, *args, **kwargs):
-        exc = sys.exc_info()
-        self.logger.error(f"{exc}: {event} -- {args} -- {kwargs}")
-        self.logger.error(f"{traceback.extract_tb(exc[2])}")
-        # Sentry.io integration
-        if self.sentry:
-            with self.sentry.configure_scope() as scope:
-                scope.set_tag("bot_event", event)
-                scope.set_extra("event_args", args)
-                scope.set_extra("event_kwargs", kwargs)
-                self.sentry.capture_exception(sys.exc_info())
+        # Logged and sent to Sentry (if set up) once per error per window, off the event loop
+        self.errors.report(sys.exc_info(), event, args, kwargs)
 
     async def on_connect(self):
         self.logger.info("Connected to Discord")
+        if self.loop_monitor:
+            self.loop_monitor.start()
+        if self.metrics_server:
+            await self.metrics_server.start()
         if not self.loaded:
             self.logger.info("Loading cogs..")
-            for ext in self.config["system"]["plugins"]:
-                try:
-                    self.logger.info(f"Attempting to load {ext}")
-                    self.load_extension(ext)
-                except Exception as e:
-                    self.logger.error(e)
-                    self.logger.error(f"Skipping {ext}")
-                    continue
+            startup_config = self.config["system"].get("startup", {})
+            self.startup_timings = await startup.load_extensions(
+                self, self.config["system"]["plugins"], startup_config.get("threads", 4)
+            )
             self.loaded = True
             self.logger.info("Cog loading completed")
+            self.logger.info(startup.report(self.startup_timings))
+            self.reloader.snapshot()
+            if self.watch_files:
+                self.reloader.watch()
+            if not startup_config.get("lazy", False):
+                # Import what the cogs deferred now, rather than when the first command needs it
+                asyncio.get_running_loop().run_in_executor(None, startup.preload)
+                if workers.pool:
+                    workers.pool.start()
 
     async def on_ready(self):
         self.logger.info("Ready!")
         self.logger.info("\n".join([f"{g.id}: {g.name}" for g in self.guilds]))
-        await self.sync_commands()
+        # Reconnects fire on_ready too, so only guilds whose commands changed since the last sync are synced
+        synced, skipped = await commandsync.sync_changed(self, self.backend)
+        self.logger.info(
+            f"Application commands synced: {len(synced)} changed, {skipped} unchanged"
+        )
+        chunked = await cachepolicy.chunk_required(self)
+        if chunked:
+            self.logger.info(f"Member lists requested for {len(chunked)} guild(s)")
 
     async def on_join_guild(self, guild):
         self.logger.info(f"Invited to a guild: {guild}")
@@ -89,14 +288,66 @@ class PixlBot(Bot, ABC):
 
     def shutdown(self):
         self.logger.warning("Shutting down")
+        if self.loop_monitor:
+            self.loop_monitor.stop()
+        self.errors.stop()
+        self.reloader.stop()
+        if workers.pool:
+            workers.pool.stop()
         for f in self.atshutdown:
             self.logger.debug("Executing shutdown triggers: ")
             f()
+        log.stop()
+
+
+class ShardedPixlBot(PixlBot, AutoShardedBot):
+    """PixlBot running several gateway connections (shards) in one process, for when one isn't enough"""
+
+    def dispatch(self, event_name: str, *args, **kwargs):
+        if not event_name.startswith("socket_"):
+            metrics.SHARD_EVENTS.inc(
+                shard=sharding.event_shard(args, self.shard_count or 1)
+            )
+        super().dispatch(event_name, *args, **kwargs)
+
+    def _register_metrics(self):
+        super()._register_metrics()
+        metrics.registry.gauge(
+            "pixlbot_shard_latency_seconds",
+            "Gateway heartbeat latency of each shard",
+            lambda: {
+                (str(shard),): None if math.isinf(latency) else latency
+                for shard, latency in self.latencies
+            },
+            labels=["shard"],
+        )
+        metrics.registry.gauge(
+            "pixlbot_shard_up",
+            "Whether each shard is connected",
+            lambda: {
+                (str(shard),): 0 if info.is_closed() else 1
+                for shard, info in self.shards.items()
+            },
+            labels=["shard"],
+        )
+
+    async def on_shard_disconnect(self, shard_id: int):
+        self.logger.warning(f"Shard {shard_id} disconnected")
+
+    async def on_shard_resumed(self, shard_id: int):
+        self.logger.info(f"Shard {shard_id} resumed")
+
 
+def start(bot_config: dict):
+    """Run the bot, sharded if configured, until it stops"""
+    bot_class = ShardedPixlBot if sharding.enabled(bot_config) else PixlBot
+    bot = bot_class(bot_config=bot_config)
+    atexit.register(bot.shutdown)
+    bot.run(bot_config["system"]["bot_token"])
 
-with open("config.yml", "r") as file:
-    conf = yaml.safe_load(file)
 
-bot = PixlBot(bot_config=conf)
-atexit.register(bot.shutdown)
-bot.run(conf["system"]["bot_token"])
+if __name__ == "__main__":
+    conf = load_config()
+    if sharding.enabled(conf):
+        sharding.validate(conf["system"]["sharding"])
+    start(conf)
@@ -0,0 +1,32 @@
+from util.budget import BudgetPlanner, ContextPlan
+from util.chatgpt import Completion, Model
+
+
+class TestBudgetPlanner:
+    #  Tests that a conversation's first reply may use the model's whole reply length
+    def test_first_turn(self):
+        model = Model("gpt-4", max_tokens=768)
+        assert BudgetPlanner().plan(model, 10, []) == ContextPlan(1224, 768)
+
+    #  Tests that short turns after short replies get a small context and reply budget
+    def test_short_turns(self):
+        model = Model("gpt-4", max_tokens=768)
+        planner = BudgetPlanner(min_context=500, context_per_token=10, min_reply=100)
+        assert planner.plan(model, 5, [40, 80]) == ContextPlan(550, 120)
+        assert planner.plan(model, 200, [40]).max_tokens == 300
+
+    #  Tests that the plan never exceeds the model's limits
+    def test_limits(self):
+        model = Model("gpt-4", max_tokens=768, max_context=2000)
+        plan = BudgetPlanner(min_reply=1000).plan(model, 500, [600])
+        assert plan == ContextPlan(1232, 768)
+
+    #  Tests that the latency target caps the reply length using the model's observed speed
+    def test_latency_target(self):
+        model = Model("gpt-4", max_tokens=768)
+        planner = BudgetPlanner(min_reply=100, latency_target=5)
+        planner.observe(model, Completion("", 100, 100, 0, 2.0))
+        assert planner.seconds_per_token["gpt-4"] == 0.02
+        assert planner.plan(model, 10, []).max_tokens == 250
+        planner.observe(model, Completion("", 100, 100, 0, 20.0))
+        assert planner.plan(model, 10, []).max_tokens == 100
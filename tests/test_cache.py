@@ -0,0 +1,57 @@
+import time
+
+from blitzdb import FileBackend
+
+from util.cache import CachedResponse, ResponseCache
+from util.chatgpt import Model
+
+
+class TestResponseCache:
+    #  Tests that the key ignores whitespace differences but not the model or temperature
+    def test_key(self):
+        conversation = [{"role": "user", "content": "Hello  there "}]
+        key = ResponseCache.key(Model(), conversation)
+        assert key == ResponseCache.key(
+            Model(), [{"role": "user", "content": "Hello there"}]
+        )
+        assert key != ResponseCache.key(Model("gpt-4"), conversation)
+        assert key != ResponseCache.key(Model(temperature=1.0), conversation)
+
+    #  Tests hits, misses and least recently used eviction
+    def test_lru(self):
+        cache = ResponseCache(max_entries=2)
+        cache.set("a", "A")
+        cache.set("b", "B")
+        assert cache.get("a") == "A"
+        cache.set("c", "C")
+        assert cache.get("b") is None
+        assert cache.get("a") == "A"
+        assert cache.stats["hits"] == 2
+        assert cache.stats["misses"] == 1
+        assert cache.stats["evictions"] == 1
+
+    #  Tests that expired entries are not returned
+    def test_ttl(self):
+        cache = ResponseCache(ttl=60)
+        cache.set("a", "A")
+        cache._entries["a"] = ("A", time.time() - 1)
+        assert cache.get("a") is None
+        assert "a" not in cache._entries
+
+    #  Tests that expired entries are deleted from the on-disk tier, on lookup and when purging
+    def test_persistent_expiry(self, tmp_path):
+        backend = FileBackend(str(tmp_path))
+        backend.autocommit = True
+        cache = ResponseCache(ttl=60, backend=backend)
+        cache.set("a", "A")
+        cache.set("b", "B")
+        cache.set("c", "C")
+        for key in ("a", "b"):
+            doc = backend.get(CachedResponse, {"key": key})
+            doc.expires = time.time() - 1
+            backend.save(doc)
+        cache._entries["a"] = ("A", time.time() - 1)
+        assert cache.get("a") is None
+        assert len(backend.filter(CachedResponse, {"key": "a"})) == 0
+        assert cache.purge() == 1
+        assert [d.key for d in backend.filter(CachedResponse, {})] == ["c"]
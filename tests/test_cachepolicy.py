@@ -0,0 +1,103 @@
+import sys
+import types
+from unittest.mock import AsyncMock, MagicMock
+
+import discord
+import pytest
+from discord.ext import commands
+
+from util import cachepolicy
+
+COG = """
+from discord.ext import commands
+
+class {name}(commands.Cog):
+    intents = {intents}
+
+    def __init__(self, bot):
+        self.config = {{"servers": {{1: {{}}, 2: {{}}}}}}
+
+    def member_guilds(self):
+        return self.config["servers"].keys()
+"""
+
+
+@pytest.fixture
+def plugins(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / "needsmembers.py").write_text(
+        COG.format(name="NeedsMembers", intents='("members",)')
+    )
+    (tmp_path / "needscontent.py").write_text(
+        COG.format(name="NeedsContent", intents='("message_content", "members")')
+    )
+    yield ["needsmembers", "needscontent", "does.not.exist"]
+    for name in ("needsmembers", "needscontent"):
+        sys.modules.pop(name, None)
+
+
+def make_guild(guild_id, chunked=False):
+    guild = MagicMock(spec=discord.Guild)
+    guild.id = guild_id
+    guild.name = f"guild {guild_id}"
+    guild.chunked = chunked
+    guild.chunk = AsyncMock()
+    guild.members = [types.SimpleNamespace(name="x" * guild_id)] * (guild_id * 10)
+    guild.channels = []
+    guild.roles = [types.SimpleNamespace(name="everyone")]
+    return guild
+
+
+class TestCachePolicy:
+    #  Tests that intents are read from the cog classes without importing them, skipping modules that don't exist
+    def test_declared_intents(self, plugins):
+        declared = cachepolicy.declared_intents(plugins)
+        assert declared == {
+            "members": ["NeedsMembers", "NeedsContent"],
+            "message_content": ["NeedsContent"],
+        }
+        assert "needsmembers" not in sys.modules
+        intents = cachepolicy.make_intents(declared)
+        assert intents.members and intents.message_content and intents.guilds
+        assert not intents.presences
+        with pytest.raises(ValueError):
+            cachepolicy.make_intents(["everything"])
+
+    #  Tests that loaded cogs needing intents the bot hasn't got are reported
+    def test_missing_intents(self):
+        class Cog(commands.Cog):
+            intents = ("members", "guilds")
+
+        bot = MagicMock()
+        bot.intents = cachepolicy.make_intents([])
+        bot.cogs = {"Cog": Cog()}
+        assert cachepolicy.missing_intents(bot) == {"members": ["Cog"]}
+
+    #  Tests that only guilds a cog needs, and haven't been chunked yet, are chunked
+    @pytest.mark.asyncio
+    async def test_chunk_required(self, plugins):
+        module = __import__("needsmembers")
+        guilds = {1: make_guild(1), 2: make_guild(2, chunked=True), 3: make_guild(3)}
+        bot = MagicMock()
+        bot.intents = cachepolicy.make_intents(["members"])
+        bot.cogs = {"NeedsMembers": module.NeedsMembers(bot)}
+        bot.get_guild.side_effect = guilds.get
+        assert await cachepolicy.chunk_required(bot) == [1]
+        guilds[1].chunk.assert_awaited_once()
+        guilds[3].chunk.assert_not_called()
+        bot.intents = cachepolicy.make_intents([])
+        assert await cachepolicy.chunk_required(bot) == []
+
+    #  Tests that the report lists guilds by their estimated size, largest first
+    def test_report(self):
+        bot = MagicMock()
+        bot.intents = cachepolicy.make_intents(["members"])
+        bot.guilds = [make_guild(1), make_guild(30)]
+        bot.cached_messages = []
+        bot.users = []
+        footprints = cachepolicy.footprint(bot)
+        assert [f.id for f in footprints] == [30, 1]
+        assert footprints[0].members == 300 and footprints[0].size > 0
+        report = cachepolicy.report(bot)
+        assert "members" in report.splitlines()[0]
+        assert report.index("guild 30") < report.index("guild 1 ")
@@ -104,7 +104,7 @@ class TestChatGPTCommands:
         data.seek(0)
         discord_file = discord.File(data, filename="conversation.txt")
 
-        await cog.save_conversation(ctx)
+        await cog.save_conversation(ctx, "text")
 
         ctx.author.send.assert_called_once()
         assert ctx.author.send.call_args[0][0] == "Here is your conversation with Bot:"
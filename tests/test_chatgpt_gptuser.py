@@ -1,8 +1,11 @@
 from datetime import datetime, timedelta
 from hashlib import sha256
 
+import pytest
+
+from util import workers
 from util.souls import Soul
-from util.chatgpt import GPTUser, UserConfig
+from util.chatgpt import GPTUser, UserConfig, WORKER_LENGTH
 
 
 class TestGPTUser:
@@ -60,3 +63,34 @@ class TestGPTUser:
         for i in range(100):
             user.pop_conversation()
         assert user.oversized is False
+
+    #  Tests that the newest message and remembrance prompt are sent even if the system prompt fills the budget
+    def test_recent_conversation_keeps_newest(self):
+        user = GPTUser(1, "John", "A very long system prompt " * 50, None)
+        user.push_conversation({"role": "user", "content": "Old message"})
+        user.push_conversation({"role": "assistant", "content": "Old reply"})
+        user.push_conversation({"role": "user", "content": "New message"})
+        user.push_conversation({"role": "system", "content": "Remember who you are"})
+        recent = user.recent_conversation(10)
+        assert [line["content"] for line in recent[1:]] == [
+            "New message",
+            "Remember who you are",
+        ]
+
+    #  Tests that short texts are counted in place and only long ones go to a worker process
+    @pytest.mark.asyncio
+    async def test_count_tokens_offload(self, monkeypatch):
+        user = GPTUser(1, "John", "Hello", None)
+        offloaded = []
+
+        async def run(function, *args):
+            offloaded.append(args)
+            return function(*args)
+
+        monkeypatch.setattr(workers, "run", run)
+        assert await user.count_tokens("Hello there") == 2
+        assert not offloaded
+        assert (
+            await user.count_tokens(" ".join(["word"] * WORKER_LENGTH)) == WORKER_LENGTH
+        )
+        assert len(offloaded) == 1
@@ -0,0 +1,158 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from util.chatgpt import Model, Completion, ModelRegistry, model_info
+
+
+class TestModel:
+    @pytest.fixture
+    def anthropic_response(self):
+        response = MagicMock()
+        response.content[0].text = "Hi"
+        response.usage.input_tokens = 10
+        response.usage.output_tokens = 5
+        response.usage.cache_read_input_tokens = 1000
+        response.usage.cache_creation_input_tokens = 0
+        return response
+
+    #  Tests that the system prompt is marked cacheable and later system prompts follow it uncached
+    @pytest.mark.asyncio
+    async def test_anthropic_prompt_caching(self, mocker, anthropic_response):
+        create = mocker.patch(
+            "util.chatgpt.anthropic_api.messages.create",
+            new=mocker.AsyncMock(return_value=anthropic_response),
+        )
+        model = Model("claude-3-haiku-20240307", vendor="anthropic")
+        completion = await model.complete(
+            [
+                {"role": "system", "content": "Soul"},
+                {"role": "user", "content": "Hello"},
+                {"role": "system", "content": "Remember"},
+            ]
+        )
+        assert completion.latency > 0
+        assert completion._replace(latency=0) == Completion("Hi", 1010, 5, 1000)
+        kwargs = create.call_args.kwargs
+        assert kwargs["system"] == [
+            {"type": "text", "text": "Soul", "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": "Remember"},
+        ]
+        assert kwargs["messages"] == [{"role": "user", "content": "Hello"}]
+        assert "anthropic-beta" in kwargs["extra_headers"]
+
+    #  Tests that prompt caching can be turned off
+    @pytest.mark.asyncio
+    async def test_anthropic_no_prompt_caching(self, mocker, anthropic_response):
+        create = mocker.patch(
+            "util.chatgpt.anthropic_api.messages.create",
+            new=mocker.AsyncMock(return_value=anthropic_response),
+        )
+        model = Model(
+            "claude-3-haiku-20240307", vendor="anthropic", prompt_caching=False
+        )
+        assert await model.send([{"role": "system", "content": "Soul"}]) == "Hi"
+        assert create.call_args.kwargs["system"] == [{"type": "text", "text": "Soul"}]
+        assert create.call_args.kwargs["extra_headers"] == {}
+
+    #  Tests that a request can ask for a shorter reply than the model's, but not a longer one
+    @pytest.mark.asyncio
+    async def test_max_tokens_override(self, mocker, anthropic_response):
+        create = mocker.patch(
+            "util.chatgpt.anthropic_api.messages.create",
+            new=mocker.AsyncMock(return_value=anthropic_response),
+        )
+        model = Model("claude-3-haiku-20240307", vendor="anthropic", max_tokens=768)
+        await model.complete([{"role": "user", "content": "Hi"}], max_tokens=100)
+        assert create.call_args.kwargs["max_tokens"] == 100
+        await model.complete([{"role": "user", "content": "Hi"}], max_tokens=5000)
+        assert create.call_args.kwargs["max_tokens"] == 768
+
+    #  Tests that snapshots with their own context window aren't matched by their family's prefix
+    def test_model_info(self):
+        assert model_info("gpt-3.5-turbo-0613")[0] == 4096
+        assert model_info("gpt-3.5-turbo-0301")[0] == 4096
+        assert model_info("gpt-3.5-turbo-1106")[0] == 16385
+        assert model_info("gpt-3.5-turbo-16k-0613")[0] == 16385
+        assert model_info("gpt-4-vision-preview")[0] == 128000
+        assert model_info("gpt-4-0613")[0] == 8192
+        assert model_info("some-model")[0] == 4097
+
+
+class TestModelRegistry:
+    @pytest.fixture
+    def config(self):
+        return {
+            "api_key": "foo",
+            "models": {"gpt-4": {"max_tokens": 1024}},
+            "default": {"model_name": "gpt-3.5-turbo", "system_prompt": "Prompt"},
+            1: {"model_name": "gpt-4", "system_prompt": "Prompt"},
+            2: {"model_name": "gpt-4", "system_prompt": "Other prompt"},
+            3: {"model_name": "claude-3-opus-20240229", "vendor": "anthropic"},
+        }
+
+    #  Tests that models get their real context windows and per-model overrides
+    def test_model_settings(self, config):
+        registry = ModelRegistry(config)
+        assert registry.get().max_context == 16385
+        assert registry.get(1).max_context == 8192
+        assert registry.get(1).max_tokens == 1024
+        assert registry.get(3).max_context == 200000
+        assert registry.get(3).vendor == "anthropic"
+        assert registry.get(99) is registry.get()
+        assert registry.degraded is None
+
+    #  Tests that guilds with the same model settings share one immutable Model
+    def test_shared(self, config):
+        registry = ModelRegistry(config)
+        assert registry.get(1) is registry.get(2)
+        with pytest.raises(AttributeError):
+            registry.get(1).max_tokens = 5
+
+    #  Tests that the model for over-quota requests is built like any other
+    def test_degraded(self, config):
+        config["quotas"] = {"degrade": {"model_name": "gpt-3.5-turbo"}}
+        registry = ModelRegistry(config)
+        assert registry.degraded is registry.get()
+        assert registry.degraded in registry
+
+    #  Tests that reloading replaces the models and old ones are recognized as stale
+    def test_reload(self, config):
+        registry = ModelRegistry(config)
+        old = registry.get(1)
+        assert old in registry
+        config[1]["max_context"] = 4000
+        registry.load(config)
+        assert old not in registry
+        assert registry.get(1).max_context == 4000
+
+
+class TestApplyConfig:
+    @pytest.fixture
+    def cog(self):
+        from cogs.chatgpt import ChatGPT
+
+        bot = MagicMock()
+        bot.config = {
+            "ChatGPT": {
+                "openai_api_key": "foo",
+                "anthropic_api_key": "bar",
+                "default": {"system_prompt": "Prompt", "model_name": "gpt-3.5-turbo"},
+            }
+        }
+        return ChatGPT(bot)
+
+    #  Tests that new model settings are taken on in place
+    def test_models_in_place(self, cog):
+        config = dict(
+            cog.config, default={"system_prompt": "Prompt", "model_name": "gpt-4"}
+        )
+        assert cog.apply_config(config)
+        assert cog.models.get().model == "gpt-4"
+        assert cog.config is config
+
+    #  Tests that settings the cog only reads when it starts make it reload instead
+    def test_other_settings_reload(self, cog):
+        old = cog.models.get()
+        assert not cog.apply_config(dict(cog.config, summary_channels=[1]))
+        assert cog.models.get() is old
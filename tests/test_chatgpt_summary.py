@@ -0,0 +1,114 @@
+import datetime
+from unittest.mock import AsyncMock, MagicMock, Mock
+
+import discord
+import pytest
+
+from cogs.chatgpt import ChatGPT, QUOTA_MESSAGE
+from util.history import MessageRecord
+
+
+def record(message_id, author, content):
+    return MessageRecord(message_id, author, content, datetime.datetime.now())
+
+
+class TestChannelSummary:
+    @pytest.fixture
+    def cog(self):
+        bot = MagicMock()
+        bot.config = {
+            "ChatGPT": {
+                "openai_api_key": "foo",
+                "anthropic_api_key": "bar",
+                "default": {
+                    "system_prompt": "System prompt",
+                    "model_name": "gpt-3.5-turbo",
+                },
+            }
+        }
+        cog = ChatGPT(bot)
+        cog.summarize_chat.cog = cog
+        cog.send_to_model = AsyncMock(return_value="Summary")
+        cog.get_user_from_context = Mock(return_value=MagicMock())
+        return cog
+
+    @pytest.fixture
+    def ctx(self):
+        ctx = MagicMock(spec=discord.ApplicationContext)
+        ctx.channel.id = 1
+        ctx.channel.is_nsfw.return_value = False
+        ctx.respond = AsyncMock()
+        ctx.send = AsyncMock(return_value=Mock(spec=discord.Message, id=100))
+        return ctx
+
+    #  Tests that the summary is posted after summarizing, and isn't summarized itself the next time
+    @pytest.mark.asyncio
+    async def test_summary_not_summarized(self, cog, ctx):
+        cog.history.history = AsyncMock(return_value=[record(10, "User", "Hello")])
+        await cog.summarize_chat(ctx, 50, None)
+        assert "User: Hello" in cog.send_to_model.call_args.args[1][0]["content"]
+        ctx.send.assert_called_once_with("Summary of the last 50 messages:\n\nSummary")
+        assert cog.summaries[1].last_message_id == 10
+        assert cog.summaries[1].summary_message_id == 100
+
+        # Nothing new but our own summary: answered from the cached summary
+        cog.history.history.return_value = [record(100, "Bot", "Summary of...")]
+        await cog.summarize_chat(ctx, 50, None)
+        cog.send_to_model.assert_called_once()
+        assert cog.history.history.call_args.args[2] == 10
+        assert ctx.send.call_count == 2
+
+    #  Tests that asking for more messages than the cached summary covers summarizes them all again
+    @pytest.mark.asyncio
+    async def test_summary_grows(self, cog, ctx):
+        cog.history.history = AsyncMock(return_value=[record(10, "User", "Hello")])
+        await cog.summarize_chat(ctx, 5, None)
+        cog.history.history.return_value = [
+            record(5, "User", "Earlier"),
+            record(10, "User", "Hello"),
+        ]
+        await cog.summarize_chat(ctx, 50, None)
+        assert cog.history.history.call_args.args[1:] == (50, None)
+        assert "User: Earlier" in cog.send_to_model.call_args.args[1][0]["content"]
+        assert cog.summaries[1].message_count == 50
+
+        cog.history.history.return_value = [record(11, "User", "Later")]
+        await cog.summarize_chat(ctx, 50, None)
+        assert cog.history.history.call_args.args[1:] == (50, 10)
+        assert cog.summaries[1].message_count == 51
+
+    #  Tests that nothing is posted but an apology when the model can't be reached
+    @pytest.mark.asyncio
+    async def test_summary_failed(self, cog, ctx):
+        cog.history.history = AsyncMock(return_value=[record(10, "User", "Hello")])
+        cog.send_to_model.return_value = None
+        await cog.summarize_chat(ctx, 50, None)
+        ctx.send.assert_called_once_with("Sorry, can't generate a summary right now.")
+        assert 1 not in cog.summaries
+
+    #  Tests that the quota is checked against the estimated size of the summary, not nothing
+    @pytest.mark.asyncio
+    async def test_summary_quota(self, cog, ctx, monkeypatch):
+        monkeypatch.setattr("util.chatgpt.count_tokens", lambda encoding, texts: 10)
+        cog.quota.configure({"user": {"daily": 1000}})
+        cog.get_user_from_context.return_value.model = cog.models.get()
+        ctx.guild = None
+        ctx.author.id = 7
+        cog.history.history = AsyncMock(return_value=[record(10, "User", "Hello")])
+        await cog.summarize_chat(ctx, 50, None)
+        ctx.respond.assert_called_once_with(QUOTA_MESSAGE, ephemeral=True)
+        cog.send_to_model.assert_not_called()
+
+        await cog.summarize_chat(ctx, 1, None)
+        cog.send_to_model.assert_called_once()
+
+    #  Tests that a channel that can't be read doesn't stop the others from being refreshed
+    @pytest.mark.asyncio
+    async def test_refresh_continues(self, cog):
+        cog.config["summary_channels"] = [1, 2]
+        cog.update_summary = AsyncMock(
+            side_effect=[discord.Forbidden(Mock(status=403), "no"), None]
+        )
+        await cog.refresh_summaries.coro(cog)
+        assert cog.update_summary.call_count == 2
+        cog.bot.logger.error.assert_called_once()
@@ -0,0 +1,150 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, Mock
+
+import discord
+import pytest
+
+from cogs.chatgpt import ChatGPT
+
+
+class TestThreadMode:
+    @pytest.fixture
+    def cog(self):
+        bot = MagicMock()
+        bot.config = {
+            "system": {"admin_roles": []},
+            "ChatGPT": {
+                "openai_api_key": "foo",
+                "anthropic_api_key": "bar",
+                "default": {
+                    "system_prompt": "System prompt",
+                    "model_name": "gpt-3.5-turbo",
+                },
+            },
+        }
+        cog = ChatGPT(bot)
+        cog.thread_mode.cog = cog
+        cog.history = MagicMock()
+        cog.should_reply = Mock(return_value=True)
+        cog.remove_bot_mention = Mock(side_effect=lambda content: content)
+        cog.reply = AsyncMock()
+        return cog
+
+    @pytest.fixture
+    def thread(self):
+        thread = MagicMock(spec=discord.Thread)
+        thread.id = 5
+        thread.owner_id = 1
+        thread.name = "Thread"
+        thread.guild = None
+        thread.typing.return_value.__aenter__ = AsyncMock()
+        thread.typing.return_value.__aexit__ = AsyncMock()
+        return thread
+
+    def ctx(self, thread, author_id):
+        ctx = MagicMock(spec=discord.ApplicationContext)
+        ctx.channel = thread
+        ctx.author.id = author_id
+        ctx.respond = AsyncMock()
+        return ctx
+
+    def message(self, thread, author_id, name, content):
+        message = MagicMock(spec=discord.Message)
+        message.channel = thread
+        message.author.id = author_id
+        message.author.display_name = name
+        message.content = content
+        return message
+
+    #  Tests that only the thread owner can turn a shared conversation on and off
+    @pytest.mark.asyncio
+    async def test_toggle(self, cog, thread):
+        ctx = self.ctx(MagicMock(spec=discord.TextChannel), 1)
+        await cog.thread_mode(ctx)
+        ctx.respond.assert_called_once_with(
+            "This only works in threads.", ephemeral=True
+        )
+
+        ctx = self.ctx(thread, 2)
+        await cog.thread_mode(ctx)
+        ctx.respond.assert_called_once_with("Access denied", ephemeral=True)
+        assert thread.id not in cog.threads
+
+        ctx = self.ctx(thread, 1)
+        await cog.thread_mode(ctx)
+        assert cog.threads[thread.id].prompt_info == "Thread"
+        await cog.thread_mode(ctx)
+        assert thread.id not in cog.threads
+
+    #  Tests that each line of a shared conversation is attributed to whoever said it
+    @pytest.mark.asyncio
+    async def test_speaker_attribution(self, cog, thread):
+        await cog.thread_mode(self.ctx(thread, 1))
+        cog.send_to_model = AsyncMock(return_value="Hi")
+        await cog.on_message(self.message(thread, 1, "Alice", "Hello"))
+        await cog.on_message(self.message(thread, 2, "Bob", "Hey"))
+        sent = cog.send_to_model.call_args.args[1]
+        assert [line["content"] for line in sent[1:]] == [
+            "Alice: Hello",
+            "Hi",
+            "Bob: Hey",
+        ]
+
+    #  Tests that a failed reply only forgets its own speaker's line, even if someone else spoke in the meantime
+    @pytest.mark.asyncio
+    async def test_failure_keeps_others(self, cog, thread):
+        await cog.thread_mode(self.ctx(thread, 1))
+        gu = cog.threads[thread.id]
+
+        async def send_to_model(*args, **kwargs):
+            gu.push_conversation({"role": "user", "content": "Bob: Hey"})
+            return None
+
+        cog.send_to_model = send_to_model
+        await cog.on_message(self.message(thread, 1, "Alice", "Hello"))
+        assert [line["content"] for line in gu.conversation[1:]] == ["Bob: Hey"]
+
+    #  Tests that a message arriving while another is answered waits, so each reply follows its own line
+    @pytest.mark.asyncio
+    async def test_concurrent_messages(self, cog, thread):
+        await cog.thread_mode(self.ctx(thread, 1))
+        gu = cog.threads[thread.id]
+        answer = asyncio.Event()
+
+        async def send_to_model(user, conversation, **kwargs):
+            if conversation[-1]["content"] == "Alice: Hello":
+                await answer.wait()
+            return f"Re {conversation[-1]['content']}"
+
+        cog.send_to_model = send_to_model
+        first = asyncio.create_task(
+            cog.on_message(self.message(thread, 1, "Alice", "Hello"))
+        )
+        await asyncio.sleep(0)
+        second = asyncio.create_task(
+            cog.on_message(self.message(thread, 2, "Bob", "Hey"))
+        )
+        await asyncio.sleep(0)
+        answer.set()
+        await asyncio.gather(first, second)
+        assert [line["content"] for line in gu.conversation[1:]] == [
+            "Alice: Hello",
+            "Re Alice: Hello",
+            "Bob: Hey",
+            "Re Bob: Hey",
+        ]
+
+    #  Tests that a conversation too long for the model keeps its lines and still sends the newest one
+    @pytest.mark.asyncio
+    async def test_oversized_keeps_lines(self, cog, thread):
+        await cog.thread_mode(self.ctx(thread, 1))
+        gu = cog.threads[thread.id]
+        gu.conversation = [{"role": "system", "content": "prompt " * 20000}]
+        cog.send_to_model = AsyncMock(return_value="Hi")
+        await cog.on_message(self.message(thread, 1, "Alice", "Hello"))
+        assert cog.send_to_model.call_args.args[1][-1]["content"] == "Alice: Hello"
+        assert [line["content"] for line in gu.conversation[1:]] == [
+            "Alice: Hello",
+            "Hi",
+        ]
+        assert "forget" in cog.reply.call_args.args[1]
@@ -0,0 +1,87 @@
+from unittest.mock import AsyncMock
+
+import discord
+import pytest
+from blitzdb import FileBackend
+
+from util import commandsync
+
+
+def make_bot(description="Say hi"):
+    bot = discord.Bot()
+    bot._connection.application_id = 1234
+
+    @bot.slash_command(guild_ids=[1, 2], description=description)
+    async def hello(ctx):
+        pass
+
+    @bot.slash_command(guild_ids=[2], description="Say bye")
+    async def bye(ctx):
+        pass
+
+    @bot.slash_command(description="Everywhere")
+    async def ping(ctx):
+        pass
+
+    bot.register_commands = AsyncMock(
+        side_effect=lambda commands, guild_id=None, force=False: [
+            {"name": c.name, "type": 1, "id": hash((c.name, guild_id))}
+            for c in commands
+        ]
+    )
+    return bot
+
+
+def command(bot, name):
+    return next(c for c in bot.pending_application_commands if c.name == name)
+
+
+class TestCommandSync:
+    #  Tests that the command tree is split per guild, and hashes don't depend on order
+    @pytest.mark.asyncio
+    async def test_tree(self):
+        tree = commandsync.command_tree(make_bot())
+        assert {k: sorted(c.name for c in v) for k, v in tree.items()} == {
+            "global": ["ping"],
+            "1": ["hello"],
+            "2": ["bye", "hello"],
+        }
+        assert commandsync.command_hash(tree["2"]) == commandsync.command_hash(
+            list(reversed(tree["2"]))
+        )
+
+    #  Tests that a second sync with nothing changed makes no requests, and a change only syncs its guilds
+    @pytest.mark.asyncio
+    async def test_sync_changed(self, tmp_path):
+        backend = FileBackend(str(tmp_path))
+        bot = make_bot()
+        synced, skipped = await commandsync.sync_changed(bot, backend)
+        assert sorted(synced) == ["1", "2", "global"] and skipped == 0
+        assert command(bot, "bye").id == hash(("bye", 2))
+
+        bot = make_bot()
+        synced, skipped = await commandsync.sync_changed(bot, backend)
+        assert synced == [] and skipped == 3
+        bot.register_commands.assert_not_called()
+        # Skipped commands still get their IDs, so their interactions are dispatched
+        assert command(bot, "ping").id == hash(("ping", None))
+        assert bot._application_commands[hash(("hello", 1))] is command(bot, "hello")
+        assert bot._application_commands[hash(("hello", 2))] is command(bot, "hello")
+
+        bot = make_bot("Say hello")
+        synced, skipped = await commandsync.sync_changed(bot, backend)
+        assert sorted(synced) == ["1", "2"] and skipped == 1
+
+    #  Tests that forcing syncs everything, and guilds left without commands get them removed
+    @pytest.mark.asyncio
+    async def test_force_and_removed(self, tmp_path):
+        backend = FileBackend(str(tmp_path))
+        await commandsync.sync_changed(make_bot(), backend)
+        bot = make_bot()
+        bot.remove_application_command(command(bot, "bye"))
+        command(bot, "hello").guild_ids = [1]
+        synced, _ = await commandsync.sync_changed(bot, backend)
+        assert synced == ["2"]
+        assert bot.register_commands.call_args.args[0] == []
+        synced, _ = await commandsync.sync_changed(bot, backend, force=True)
+        assert sorted(synced) == ["1", "2", "global"]
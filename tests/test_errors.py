@@ -0,0 +1,89 @@
+import logging
+import sys
+from unittest.mock import MagicMock
+
+from util import log
+from util.errors import ErrorReporter, describe, fingerprint
+
+
+def fail(value):
+    raise ValueError(f"bad value {value}")
+
+
+def other_failure():
+    raise KeyError("missing")
+
+
+def capture(fn, *args):
+    try:
+        fn(*args)
+    except Exception:
+        return sys.exc_info()
+
+
+class TestErrors:
+    #  Tests that the same error gets the same fingerprint whatever its message, and other errors don't
+    def test_fingerprint(self):
+        assert fingerprint(capture(fail, 1), "message") == fingerprint(
+            capture(fail, 2), "message"
+        )
+        assert fingerprint(capture(fail, 1), "message") != fingerprint(
+            capture(fail, 1), "reaction_add"
+        )
+        assert fingerprint(capture(fail, 1), "message") != fingerprint(
+            capture(other_failure), "message"
+        )
+
+    #  Tests that repeats within the window are only counted, then reported with the count
+    def test_dedup(self, mocker):
+        logger = MagicMock()
+        reporter = ErrorReporter(logger, window=60)
+        for n in range(5):
+            group = reporter.report(capture(fail, n), "message")
+        assert group.count == 5
+        assert group.pending == 4
+        assert group.location == "tests/test_errors.py:fail:10"
+        assert logger.error.call_count == 1
+        mocker.patch("util.errors.time.time", return_value=group.window_start + 61)
+        reporter.report(capture(fail, 6), "message")
+        assert logger.error.call_count == 2
+        assert "4 more times" in logger.error.call_args.args[-1]
+        assert group.pending == 0
+
+    #  Tests that only the most recent error groups are kept
+    def test_history(self):
+        reporter = ErrorReporter(MagicMock(), history=2)
+        reporter.report(capture(fail, 1), "message")
+        reporter.report(capture(other_failure), "message")
+        reporter.report(capture(fail, 1), "reaction_add")
+        assert [g.event for g in reporter.recent()] == ["reaction_add", "message"]
+        assert [g.type for g in reporter.recent()] == ["ValueError", "KeyError"]
+
+    #  Tests that errors reach Sentry from the background thread, with context and compact arguments
+    def test_sentry(self):
+        sentry = MagicMock()
+        reporter = ErrorReporter(MagicMock(), sentry, window=0)
+        message = MagicMock(id=42)
+        with log.bound(cog="Responder", guild=1):
+            group = reporter.report(capture(fail, 1), "message", (message,))
+        reporter.stop()
+        sentry.capture_exception.assert_called_once()
+        scope = sentry.push_scope.return_value.__enter__.return_value
+        assert scope.fingerprint == [group.fingerprint]
+        scope.set_tag.assert_any_call("cog", "Responder")
+        scope.set_extra.assert_any_call("event_args", ["MagicMock(id=42)"])
+
+    #  Tests that reports are dropped rather than queued without limit
+    def test_queue_full(self):
+        sentry = MagicMock()
+        reporter = ErrorReporter(
+            MagicMock(), sentry, window=0, max_rate=0.001, queue_size=1
+        )
+        for n in range(5):
+            reporter.report(capture(fail, n), "message")
+        assert reporter.dropped >= 3
+
+    #  Tests that long values are cut short
+    def test_describe(self):
+        assert describe("x" * 500).endswith("...")
+        assert len(describe("x" * 500)) == 203
@@ -0,0 +1,20 @@
+import socket
+
+from util import healthcheck
+
+
+class TestHealthcheck:
+    #  Tests that the check passes without metrics, since there's nothing to probe
+    def test_no_metrics(self, tmp_path):
+        config = tmp_path / "config.yml"
+        config.write_text("system:\n  log_level: INFO\n")
+        assert healthcheck.main(str(config)) == 0
+
+    #  Tests that the check fails when metrics are configured but nothing answers
+    def test_unreachable(self, tmp_path):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        config = tmp_path / "config.yml"
+        config.write_text(f"system:\n  metrics:\n    port: {port}\n")
+        assert healthcheck.main(str(config)) == 1
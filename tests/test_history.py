@@ -0,0 +1,81 @@
+from unittest.mock import MagicMock, Mock
+
+import discord
+import discord.iterators
+import pytest
+
+from util.history import MessageBuffer
+
+
+def make_message(mid: int, channel_id: int = 1, guild_id: int = 10, content="Hi"):
+    message = Mock(spec=discord.Message)
+    message.id = mid
+    message.channel.id = channel_id
+    message.guild.id = guild_id
+    message.author.name = "User"
+    message.content = content
+    message.created_at = None
+    return message
+
+
+class TestMessageBuffer:
+    @pytest.fixture
+    def buffer(self):
+        return MessageBuffer(channels=[1, 2], per_channel=3, per_guild=5)
+
+    @pytest.fixture
+    def channel(self, mocker):
+        channel = MagicMock(spec=discord.TextChannel)
+        channel.id = 1
+        channel.history.return_value = mocker.AsyncMock(
+            spec=discord.iterators.HistoryIterator
+        )
+        channel.history.return_value.flatten.return_value = []
+        return channel
+
+    #  Tests that messages from channels that aren't configured are ignored
+    def test_untracked_channel(self, buffer):
+        buffer.add(make_message(100, channel_id=3))
+        assert len(buffer) == 0
+
+    #  Tests that the per channel and per guild caps evict the oldest messages
+    def test_caps(self, buffer):
+        for i in range(5):
+            buffer.add(make_message(100 + i))
+        assert [r.id for r in buffer._buffers[1]] == [102, 103, 104]
+        for i in range(3):
+            buffer.add(make_message(200 + i, channel_id=2))
+        assert len(buffer) == 5
+        assert [r.id for r in buffer._buffers[1]] == [103, 104]
+
+    #  Tests that edits and deletions are applied to buffered messages
+    def test_edit_delete(self, buffer):
+        buffer.add(make_message(100))
+        buffer.add(make_message(101))
+        buffer.edit(1, 100, "Edited")
+        buffer.delete(1, 101)
+        assert [(r.id, r.content) for r in buffer._buffers[1]] == [(100, "Edited")]
+
+    #  Tests that reads covered by the buffer never touch the REST API
+    @pytest.mark.asyncio
+    async def test_history_from_memory(self, buffer, channel):
+        for i in range(3):
+            buffer.add(make_message(100 + i))
+        records = await buffer.history(channel, 2)
+        assert [r.id for r in records] == [101, 102]
+        records = await buffer.history(channel, 50, after=100)
+        assert [r.id for r in records] == [101, 102]
+        channel.history.assert_not_called()
+
+    #  Tests that only the range not covered by the buffer is fetched over REST
+    @pytest.mark.asyncio
+    async def test_history_fallback(self, buffer, channel):
+        buffer.add(make_message(100))
+        channel.history.return_value.flatten.return_value = [
+            make_message(99),
+            make_message(98),
+        ]
+        records = await buffer.history(channel, 3)
+        assert [r.id for r in records] == [98, 99, 100]
+        assert channel.history.call_args.kwargs["limit"] == 2
+        assert channel.history.call_args.kwargs["before"].id == 100
@@ -0,0 +1,102 @@
+import io
+import json
+import logging
+
+import pytest
+
+from util import log
+
+
+@pytest.fixture
+def logger():
+    """A logger set up by init_logger, writing to a StringIO instead of stderr"""
+    stream = io.StringIO()
+    loggers = []
+
+    def make(level="INFO", log_format="text", rate_limit=None):
+        logger = log.init_logger(f"test{len(loggers)}", level, log_format, rate_limit)
+        log.listener.handlers[0].setStream(stream)
+        loggers.append(logger)
+        return logger, stream
+
+    yield make
+    log.stop()
+    for logger in loggers:
+        logger.handlers.clear()
+
+
+class TestLog:
+    #  Tests that records reach the stream through the writer thread, with their context
+    def test_text(self, logger):
+        bot_logger, stream = logger()
+        with log.bound(cog="Responder", guild=123):
+            bot_logger.info("Replied to %s", "someone")
+        bot_logger.info("Outside")
+        log.stop()
+        lines = stream.getvalue().splitlines()
+        assert lines[0].endswith("[cog=Responder guild=123]: Replied to someone")
+        assert lines[1].endswith("test_log: Outside")
+
+    #  Tests that a logger set up earlier keeps being written, in its own format, after another is set up
+    def test_several_loggers(self, logger):
+        first, stream = logger(log_format="json")
+        second, _ = logger()
+        first.info("From the first")
+        second.info("From the second")
+        log.stop()
+        lines = stream.getvalue().splitlines()
+        assert json.loads(lines[0])["message"] == "From the first"
+        assert lines[1].endswith("test_log: From the second")
+
+    #  Tests that JSON records carry the context as fields, and exceptions are kept
+    def test_json(self, logger):
+        bot_logger, stream = logger(log_format="json")
+        with log.bound(cog="ChatGPT", command="ai chat"):
+            try:
+                raise ValueError("nope")
+            except ValueError:
+                bot_logger.exception("Failed")
+        log.stop()
+        entry = json.loads(stream.getvalue().splitlines()[0])
+        assert entry["message"] == "Failed"
+        assert entry["cog"] == "ChatGPT"
+        assert entry["command"] == "ai chat"
+        assert "guild" not in entry
+        assert "ValueError: nope" in entry["exception"]
+
+    #  Tests that a disabled level never renders its arguments
+    def test_lazy(self, logger):
+        bot_logger, stream = logger()
+
+        class Expensive:
+            def __str__(self):
+                raise AssertionError("rendered")
+
+        bot_logger.debug("Dump: %s", Expensive())
+        log.stop()
+        assert stream.getvalue() == ""
+
+    #  Tests that chatty debug messages are limited per call site while other levels pass
+    def test_rate_limit(self, logger):
+        bot_logger, stream = logger(
+            level="DEBUG", rate_limit={"rate": 0.001, "burst": 3}
+        )
+        for n in range(10):
+            bot_logger.debug("Chatty %d", n)
+            bot_logger.info("Important %d", n)
+        log.stop()
+        output = stream.getvalue()
+        assert output.count("Chatty") == 3
+        assert output.count("Important") == 10
+
+    #  Tests that dropped messages are counted on the next one to get through
+    def test_suppressed_count(self):
+        limiter = log.RateLimitFilter(rate=0, burst=1)
+        records = [
+            logging.LogRecord("bot", logging.DEBUG, "cog.py", 1, "hi", None, None)
+            for _ in range(4)
+        ]
+        assert [limiter.filter(r) for r in records] == [True, False, False, False]
+        limiter._buckets[("bot", "cog.py", 1)][0] = 1
+        assert limiter.filter(records[0])
+        assert records[0].suppressed == 3
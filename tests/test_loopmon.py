@@ -0,0 +1,43 @@
+import asyncio
+import logging
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from util.loopmon import LoopMonitor
+
+
+def block_the_loop():
+    time.sleep(0.3)
+
+
+class TestLoopMonitor:
+    #  Tests that a blocking call is caught, attributed to the code that made it and reported to Sentry
+    @pytest.mark.asyncio
+    async def test_stall(self):
+        sentry = MagicMock()
+        monitor = LoopMonitor(
+            logging.getLogger("test"), sentry, interval=0.02, threshold=0.1
+        )
+        monitor.start()
+        await asyncio.sleep(0.1)
+        block_the_loop()
+        await asyncio.sleep(0.1)
+        monitor.stop()
+        assert len(monitor.stalls) == 1
+        stall = monitor.stalls[0]
+        assert stall.location.startswith("tests/test_loopmon.py:block_the_loop")
+        assert 0.2 < stall.duration < 0.5
+        assert monitor.stats()["lag_max_ms"] > 150
+        sentry.capture_message.assert_called_once()
+
+    #  Tests that a loop that keeps yielding has no stalls
+    @pytest.mark.asyncio
+    async def test_healthy(self):
+        monitor = LoopMonitor(logging.getLogger("test"), interval=0.02, threshold=0.1)
+        monitor.start()
+        await asyncio.sleep(0.2)
+        monitor.stop()
+        assert not monitor.stalls
+        assert monitor.stats()["lag_p50_ms"] < 50
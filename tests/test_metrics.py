@@ -0,0 +1,79 @@
+from unittest.mock import MagicMock
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from util.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    Metric,
+    MetricsServer,
+    Registry,
+    route_template,
+)
+
+
+class TestMetrics:
+    #  Tests the exposition format of each metric type
+    def test_render(self):
+        registry = Registry()
+        counter = registry.register(Counter("c_total", "A counter", ["kind"]))
+        counter.inc(kind="a")
+        counter.inc(2.5, kind='b"')
+        registry.register(Gauge("g", "A gauge", callback=lambda: 3))
+        histogram = registry.register(Histogram("h", "A histogram", buckets=(1, 5)))
+        histogram.observe(0.5)
+        histogram.observe(1)
+        histogram.observe(10)
+        text = registry.render()
+        assert "# TYPE c_total counter\n" in text
+        assert 'c_total{kind="a"} 1\n' in text
+        assert 'c_total{kind="b\\""} 2.5\n' in text
+        assert "g 3\n" in text
+        assert 'h_bucket{le="1"} 2\n' in text
+        assert 'h_bucket{le="5"} 2\n' in text
+        assert 'h_bucket{le="+Inf"} 3\n' in text
+        assert "h_sum 11.5\nh_count 3\n" in text
+
+    #  Tests that a failing gauge callback doesn't break the other metrics
+    def test_broken_gauge(self):
+        registry = Registry()
+        registry.gauge("broken", "Broken", lambda: 1 / 0)
+        registry.gauge("fine", "Fine", lambda: 1)
+        assert "fine 1" in registry.render()
+
+    #  Tests that a metric type can't be made without saying how it renders its samples
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            Metric("m", "M")
+
+    #  Tests that request paths are labelled by route, not by the objects in them
+    def test_route_template(self):
+        assert (
+            route_template(
+                "/api/v10/channels/123/messages/456/reactions/%F0%9F%91%8D/@me"
+            )
+            == "/api/v10/channels/{id}/messages/{id}/reactions/{emoji}/@me"
+        )
+        assert (
+            route_template(f"/api/v10/webhooks/123/{'a' * 68}")
+            == "/api/v10/webhooks/{id}/{token}"
+        )
+
+    #  Tests that the liveness probe follows the gateway connection
+    @pytest.mark.asyncio
+    async def test_healthz(self):
+        bot = MagicMock()
+        bot.is_closed.return_value = False
+        bot.is_ready.return_value = True
+        bot.latency = 0.1
+        server = MetricsServer(bot)
+        async with TestClient(TestServer(server.app)) as client:
+            response = await client.get("/healthz")
+            assert response.status == 200
+            bot.is_ready.return_value = False
+            response = await client.get("/healthz")
+            assert response.status == 503
+            response = await client.get("/metrics")
+            assert "pixlbot_llm_tokens_total" in await response.text()
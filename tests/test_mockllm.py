@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from util.chatgpt import Completion, Model
+from util.mockllm import Cassette, MockAPIError, MockVendor, exchange_key
+
+CONVERSATION = [
+    {"role": "system", "content": "Prompt"},
+    {"role": "user", "content": "Hello"},
+]
+
+
+class TestMockVendor:
+    #  Tests that the mock answers with token usage and without any delay by default
+    @pytest.mark.asyncio
+    async def test_complete(self):
+        completion = await MockVendor(reply_tokens=20).complete(Model(), CONVERSATION)
+        assert completion.text.startswith("Mock reply to: Hello")
+        assert completion.prompt_tokens > 0
+        assert completion.completion_tokens > 0
+
+    #  Tests that soul cores get a reply in their introspection format
+    @pytest.mark.asyncio
+    async def test_soul_format(self):
+        completion = await MockVendor().complete(
+            Model(), [{"role": "system", "content": "<root>"}]
+        )
+        assert completion.text.startswith("<root><FEELING>")
+
+    #  Tests error injection
+    @pytest.mark.asyncio
+    async def test_errors(self):
+        with pytest.raises(MockAPIError) as e:
+            await MockVendor(errors={429: 1.0}).complete(Model(), CONVERSATION)
+        assert e.value.status == 429
+        with pytest.raises(asyncio.TimeoutError):
+            await MockVendor(errors={"timeout": 1.0}, timeout=0).complete(
+                Model(), CONVERSATION
+            )
+
+    #  Tests that recorded exchanges are replayed
+    @pytest.mark.asyncio
+    async def test_cassette_replay(self, tmp_path):
+        path = str(tmp_path / "cassette.jsonl")
+        Cassette(path).record(
+            exchange_key(Model(), CONVERSATION), Completion("Recorded", 10, 2, 0)
+        )
+        vendor = MockVendor(cassette=path)
+        assert (await vendor.complete(Model(), CONVERSATION)).text == "Recorded"
+        assert (await Model(vendor="mock").complete(CONVERSATION)).text != "Recorded"
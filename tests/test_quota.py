@@ -0,0 +1,81 @@
+import pytest
+from blitzdb import FileBackend
+
+from util.quota import HOUR, QuotaTracker, QuotaVerdict
+
+NOW = 1000 * 24 * HOUR
+
+
+class TestQuotaTracker:
+    @pytest.fixture
+    def config(self):
+        return {
+            "guild": {"daily": 1000, "monthly": 5000},
+            "user": {"daily": 500},
+            "guilds": {2: {"daily": 10000}},
+            "grace": 0.5,
+            "degrade": {"model_name": "gpt-3.5-turbo"},
+        }
+
+    #  Tests that requests are degraded a little past the limit and refused beyond the grace
+    def test_check(self, config):
+        quota = QuotaTracker(config)
+        quota.spend(1, 10, 400, now=NOW)
+        assert quota.check(1, 10, 100, now=NOW) == QuotaVerdict.OK
+        assert quota.check(1, 10, 200, now=NOW) == QuotaVerdict.DEGRADE
+        assert quota.check(1, 10, 400, now=NOW) == QuotaVerdict.REFUSE
+        assert quota.check(1, 11, 400, now=NOW) == QuotaVerdict.OK
+        del config["degrade"]
+        quota.configure(config)
+        assert quota.check(1, 10, 200, now=NOW) == QuotaVerdict.REFUSE
+
+    #  Tests per-guild overrides
+    def test_guild_override(self, config):
+        quota = QuotaTracker(config)
+        quota.spend(2, None, 2000, now=NOW)
+        quota.spend(1, None, 2000, now=NOW)
+        assert quota.check(2, None, 0, now=NOW) == QuotaVerdict.OK
+        assert quota.check(1, None, 0, now=NOW) == QuotaVerdict.REFUSE
+
+    #  Tests that old usage slides out of the daily window but still counts for the month
+    def test_sliding_window(self, config):
+        quota = QuotaTracker(config)
+        quota.spend(1, None, 900, now=NOW)
+        later = NOW + 25 * HOUR
+        assert quota.used("guild:1", "daily", now=later) == 0
+        assert quota.used("guild:1", "monthly", now=later) == 900
+        assert quota.used("guild:1", "monthly", now=NOW + 31 * 24 * HOUR) == 0
+
+    #  Tests that counters survive a checkpoint and reload
+    def test_checkpoint(self, config, tmp_path):
+        backend = FileBackend(str(tmp_path))
+        backend.autocommit = True
+        quota = QuotaTracker(config)
+        quota.spend(1, 10, 300, now=NOW)
+        assert quota.checkpoint(backend) == 2
+        assert quota.checkpoint(backend) == 0
+        restored = QuotaTracker(config)
+        restored.load(backend)
+        assert restored.used("user:10", "daily", now=NOW) == 300
+
+    #  Tests that changed counters are copied, so later spending doesn't change what is being saved
+    def test_take_changed(self, config):
+        quota = QuotaTracker(config)
+        quota.spend(1, 10, 300, now=NOW)
+        windows = quota.take_changed()
+        quota.spend(1, 10, 200, now=NOW)
+        assert sorted(w.key for w in windows) == ["guild:1", "user:10"]
+        assert windows[0].buckets[0][1] == 300
+        assert quota.take_changed()[0].buckets[0][1] == 500
+
+    #  Tests that quotas turned on by a later configure pick up the stored counters instead of starting empty
+    def test_enable_later(self, config, tmp_path):
+        backend = FileBackend(str(tmp_path))
+        backend.autocommit = True
+        quota = QuotaTracker(config)
+        quota.spend(1, 10, 300, now=NOW)
+        quota.checkpoint(backend)
+        restored = QuotaTracker({}, backend=backend)
+        assert restored.used("user:10", "daily", now=NOW) == 0
+        restored.configure(config)
+        assert restored.used("user:10", "daily", now=NOW) == 300
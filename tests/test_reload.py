@@ -0,0 +1,132 @@
+import os
+import sys
+from unittest.mock import MagicMock
+
+import discord
+import pytest
+import pytest_asyncio
+
+from util.reload import Reloader, summary
+
+COG = """
+from discord.ext import commands
+
+class {name}(commands.Cog):
+    def __init__(self, bot):
+        self.config = bot.config["{name}"]
+        self.sessions = {{}}
+
+    {apply}
+
+    def export_state(self):
+        return {{"sessions": self.sessions}}
+
+    def import_state(self, state):
+        self.sessions.update(state["sessions"])
+
+def setup(bot):
+    bot.add_cog({name}(bot))
+"""
+
+
+@pytest.fixture
+def plugins(tmp_path, monkeypatch):
+    """Two cogs, one that takes config in place and one that has to be reloaded for it"""
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / "inplace.py").write_text(
+        COG.format(
+            name="InPlace",
+            apply="def apply_config(self, config):\n        self.config = config\n        return True",
+        )
+    )
+    (tmp_path / "stateful.py").write_text(COG.format(name="Stateful", apply=""))
+    (tmp_path / "extra.py").write_text(COG.format(name="Extra", apply=""))
+    yield tmp_path
+    for name in ("inplace", "stateful", "extra"):
+        sys.modules.pop(name, None)
+
+
+def make_config(**sections):
+    config = {
+        "system": {
+            "bot_token": "x",
+            "command_prefix": "!",
+            "log_level": "INFO",
+            "plugins": ["inplace", "stateful"],
+        },
+        "InPlace": {"items": [1]},
+        "Stateful": {"prompt": "hi"},
+        "Extra": {},
+    }
+    config.update(sections)
+    return config
+
+
+@pytest_asyncio.fixture
+async def bot(plugins):
+    bot = discord.Bot()
+    bot.config = make_config()
+    bot.logger = MagicMock()
+    for name in bot.config["system"]["plugins"]:
+        bot.load_extension(name)
+    bot.reloader = Reloader(bot, path=str(plugins / "config.yml"))
+    bot.reloader.snapshot()
+    return bot
+
+
+class TestReload:
+    #  Tests that nothing happens when nothing changed
+    @pytest.mark.asyncio
+    async def test_unchanged(self, bot):
+        result = await bot.reloader.reload(make_config())
+        assert summary(result) == "nothing changed"
+
+    #  Tests that a cog with apply_config takes its new config in place
+    @pytest.mark.asyncio
+    async def test_apply_config(self, bot):
+        cog = bot.get_cog("InPlace")
+        result = await bot.reloader.reload(make_config(InPlace={"items": [2]}))
+        assert result.applied == ["InPlace"] and result.reloaded == []
+        assert bot.get_cog("InPlace") is cog
+        assert cog.config == {"items": [2]}
+
+    #  Tests that a cog without apply_config is reloaded for new config, keeping its state
+    @pytest.mark.asyncio
+    async def test_reload_keeps_state(self, bot):
+        bot.get_cog("Stateful").sessions[1] = "conversation"
+        result = await bot.reloader.reload(make_config(Stateful={"prompt": "bye"}))
+        assert result.reloaded == ["stateful"]
+        cog = bot.get_cog("Stateful")
+        assert cog.config == {"prompt": "bye"}
+        assert cog.sessions == {1: "conversation"}
+
+    #  Tests that changed code is reloaded even when its config is the same
+    @pytest.mark.asyncio
+    async def test_code_change(self, bot, plugins):
+        path = plugins / "inplace.py"
+        os.utime(path, (path.stat().st_atime, path.stat().st_mtime + 10))
+        assert bot.reloader.changed()
+        result = await bot.reloader.reload(make_config())
+        assert result.reloaded == ["inplace"]
+        assert not bot.reloader.changed()
+
+    #  Tests that plugins are loaded and unloaded to match the config
+    @pytest.mark.asyncio
+    async def test_plugins(self, bot):
+        config = make_config()
+        config["system"]["plugins"] = ["inplace", "extra"]
+        result = await bot.reloader.reload(config)
+        assert result.loaded == ["extra"] and result.unloaded == ["stateful"]
+        assert sorted(bot.cogs) == ["Extra", "InPlace"]
+
+    #  Tests that an invalid config changes nothing
+    @pytest.mark.asyncio
+    async def test_invalid(self, bot):
+        config = make_config(InPlace={"items": [3]})
+        config["system"]["plugins"].append("does.not.exist")
+        with pytest.raises(ValueError):
+            await bot.reloader.reload(config)
+        del config["system"]["bot_token"]
+        with pytest.raises(ValueError):
+            await bot.reloader.reload(config)
+        assert bot.get_cog("InPlace").config == {"items": [1]}
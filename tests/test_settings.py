@@ -0,0 +1,46 @@
+import pytest
+from blitzdb import Document, FileBackend
+
+from util.settings import SettingsCache
+
+
+class Settings(Document):
+    pass
+
+
+class TestSettingsCache:
+    @pytest.fixture
+    def backend(self, tmp_path, mocker):
+        backend = FileBackend(str(tmp_path))
+        backend.autocommit = True
+        mocker.spy(backend, "save")
+        mocker.spy(backend, "get")
+        return backend
+
+    @pytest.fixture
+    def cache(self, backend):
+        return SettingsCache(backend, Settings, "uid", {"flags": 1})
+
+    #  Tests that unknown users get the defaults without anything being written
+    def test_defaults(self, cache, backend):
+        assert cache.find(1) is None
+        assert cache.get(1).flags == 1
+        cache.update(1, flags=1)
+        backend.save.assert_not_called()
+
+    #  Tests that settings are only written when they change, and reads are served from memory
+    def test_update(self, cache, backend):
+        cache.update(1, flags=2)
+        cache.update(1, flags=2)
+        assert backend.save.call_count == 1
+        assert cache.get(1).flags == 2
+        backend.get.assert_called_once()
+
+    #  Tests that preloading makes every later lookup skip the backend
+    def test_preload(self, cache, backend):
+        backend.save(Settings({"uid": 1, "flags": 3}))
+        fresh = SettingsCache(backend, Settings, "uid", {"flags": 1})
+        assert fresh.preload() == 1
+        assert fresh.get(1).flags == 3
+        assert fresh.find(2) is None
+        backend.get.assert_not_called()
@@ -0,0 +1,48 @@
+import types
+
+import pytest
+
+from util import sharding
+
+
+def make_config(**section):
+    return {
+        "system": {
+            "sharding": section,
+            "metrics": {"host": "127.0.0.1", "port": 9100},
+        }
+    }
+
+
+class TestSharding:
+    #  Tests that unusable sharding sections are refused
+    @pytest.mark.parametrize(
+        "section",
+        [
+            {"shard_count": 0},
+            {"shard_ids": [0]},
+            {"shard_count": 2, "shard_ids": [2]},
+            {"shard_count": 4, "processes": 2},
+        ],
+    )
+    def test_validate(self, section):
+        with pytest.raises(ValueError):
+            sharding.validate(section)
+
+    #  Tests that only the host with shard 0 runs the background tasks, and which shards the bot is asked to run
+    def test_background_tasks(self):
+        assert sharding.runs_background_tasks([0, 2])
+        assert not sharding.runs_background_tasks([1, 3])
+        assert sharding.runs_background_tasks(None)
+        config = make_config(shard_count=4, shard_ids=[1, 3])
+        assert sharding.options(config) == {"shard_count": 4, "shard_ids": [1, 3]}
+        assert sharding.options({"system": {}}) == {}
+
+    #  Tests that events are put down to the shard of their guild, and to shard 0 without one
+    def test_event_shard(self):
+        guild_id = 5 << 22
+        raw = types.SimpleNamespace(guild_id=guild_id)
+        message = types.SimpleNamespace(guild=types.SimpleNamespace(id=guild_id))
+        assert sharding.event_shard([raw], 4) == 1
+        assert sharding.event_shard(["x", message], 4) == 1
+        assert sharding.event_shard([types.SimpleNamespace(guild=None)], 4) == 0
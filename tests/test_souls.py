@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from util.souls import SoulRegistry
+
+CORE = """name: {name}
+short_personality: short
+long_personality: long
+initial_plan: plan
+"""
+
+
+class TestSoulRegistry:
+    @pytest.fixture
+    def registry(self, tmp_path):
+        (tmp_path / "asriel.yml").write_text(CORE.format(name="Asriel"))
+        (tmp_path / "dustin.yml").write_text(CORE.format(name="Dustin"))
+        return SoulRegistry(str(tmp_path), check_interval=0)
+
+    #  Tests that cores are looked up by file name or autocomplete choice
+    def test_get(self, registry):
+        core = registry.get("asriel.yml (Asriel)")
+        assert core.soul.name == "Asriel"
+        with pytest.raises(KeyError):
+            registry.get("nobody.yml")
+
+    #  Tests that autocomplete filters by file or soul name prefix
+    def test_autocomplete(self, registry):
+        assert registry.autocomplete("") == [
+            "asriel.yml (Asriel)",
+            "dustin.yml (Dustin)",
+        ]
+        assert registry.autocomplete("dus") == ["dustin.yml (Dustin)"]
+        assert registry.autocomplete("ASR") == ["asriel.yml (Asriel)"]
+
+    #  Tests that changed and removed files are picked up
+    def test_refresh(self, registry, tmp_path):
+        registry.refresh()
+        path = tmp_path / "asriel.yml"
+        path.write_text(CORE.format(name="Chara"))
+        os.utime(path, (0, 0))
+        os.remove(tmp_path / "dustin.yml")
+        assert registry.autocomplete("") == ["asriel.yml (Chara)"]
+
+    #  Tests that a broken file is skipped without losing the other cores
+    def test_refresh_broken(self, registry, tmp_path):
+        (tmp_path / "broken.yml").write_text("name: [unclosed")
+        (tmp_path / "partial.yml").write_text("name: Partial")
+        assert registry.autocomplete("") == [
+            "asriel.yml (Asriel)",
+            "dustin.yml (Dustin)",
+        ]
+        with pytest.raises(KeyError):
+            registry.get("broken.yml")
@@ -0,0 +1,70 @@
+import sys
+import types
+from unittest.mock import MagicMock
+
+import pytest
+
+from util import startup
+
+
+@pytest.fixture
+def fake_module(monkeypatch):
+    """A module that counts how often it's imported"""
+    imports = []
+
+    def import_module(name):
+        imports.append(name)
+        return types.SimpleNamespace(value=42, name=name)
+
+    monkeypatch.setattr(startup.importlib, "import_module", import_module)
+    monkeypatch.setattr(startup, "_deferred", {})
+    monkeypatch.setattr(startup, "import_times", {})
+    return imports
+
+
+class TestStartup:
+    #  Tests that a lazy import happens on first use, once
+    def test_lazy_import(self, fake_module):
+        module = startup.lazy_import("heavy")
+        assert not module.loaded and fake_module == []
+        assert module.value == 42
+        assert module.value == 42
+        assert module.loaded and fake_module == ["heavy"]
+        assert "heavy" in startup.import_times
+
+    #  Tests that setting an attribute sets it on the real module
+    def test_setattr(self, fake_module):
+        module = startup.lazy_import("heavy")
+        module.api_key = "secret"
+        assert module._resolve().api_key == "secret"
+
+    #  Tests that preloading imports everything that is still deferred, and skips what fails
+    def test_preload(self, fake_module):
+        first = startup.lazy_import("first")
+        startup.Lazy("broken", lambda: 1 / 0)
+        startup.preload()
+        assert first.loaded
+        assert fake_module == ["first"]
+        assert "broken" in startup.report([])
+
+    #  Tests that cogs are imported in threads, then loaded in order, with failures skipped
+    @pytest.mark.asyncio
+    async def test_load_extensions(self, monkeypatch):
+        monkeypatch.setattr(startup, "_deferred", {})
+        bot = MagicMock()
+        loaded = []
+
+        def load_extension(name):
+            if name == "cogs.broken":
+                raise RuntimeError("no")
+            loaded.append(name)
+
+        bot.load_extension.side_effect = load_extension
+        timings = await startup.load_extensions(
+            bot, ["json", "cogs.broken", "tests.test_util"]
+        )
+        assert loaded == ["json", "tests.test_util"]
+        assert "tests.test_util" in sys.modules
+        assert [t.error for t in timings] == [None, "no", None]
+        report = startup.report(timings)
+        assert "cogs.broken" in report and "FAILED" in report
@@ -0,0 +1,89 @@
+import pytest
+import sentry_sdk
+from blitzdb import Document, FileBackend
+
+from util import tracing
+
+
+class Thing(Document):
+    pass
+
+
+@pytest.fixture
+def traced(monkeypatch):
+    """Tracing turned on against a Sentry client that keeps its envelopes in a list"""
+    monkeypatch.setattr(tracing, "sentry_sdk", None)
+    events = []
+
+    class Transport(sentry_sdk.Transport):
+        def capture_envelope(self, envelope):
+            events.extend(item.payload.json for item in envelope.items)
+
+    sentry_sdk.init(
+        "https://key@sentry.invalid/1",
+        transport=Transport(),
+        default_integrations=False,
+        auto_enabling_integrations=False,
+        **tracing.init_options({"traces_sample_rate": 1.0}),
+    )
+    tracing.enable(sentry_sdk)
+    yield events
+    sentry_sdk.Hub.current.bind_client(None)
+
+
+class TestTracing:
+    #  Tests that nothing happens, and nothing breaks, while tracing is off
+    def test_disabled(self, monkeypatch):
+        monkeypatch.setattr(tracing, "sentry_sdk", None)
+        assert not tracing.enabled()
+        with tracing.transaction("ai chat", "discord.command") as transaction:
+            with tracing.span("db.blitzdb", "get"):
+                assert transaction is None
+
+    #  Tests that tracing needs a sample rate to turn on
+    def test_init_options(self):
+        assert tracing.init_options({"init_url": "https://..."}) == {}
+        assert "traces_sampler" in tracing.init_options({"traces_sample_rate": 0.5})
+
+    #  Tests that sample rates are picked by transaction name, then by event, then the default
+    def test_sampler(self):
+        tracing.init_options(
+            {
+                "traces_sample_rate": 0.25,
+                "traces_sample_rates": {"ai chat": 1, "on_message": 0.01},
+            }
+        )
+
+        def rate(name, op="discord.event", event=None):
+            return tracing.sampler(
+                {"transaction_context": {"name": name, "op": op}, "event": event}
+            )
+
+        assert rate("ai chat", "discord.command") == 1.0
+        assert rate("ChatGPT.on_message", event="message") == 0.01
+        assert rate("Responder.on_reaction_add", event="reaction_add") == 0.25
+        assert rate("generic AIOHTTP request", "http.server") == 0.0
+
+    #  Tests that storage calls and explicit spans land in the running transaction, for traced backends only
+    def test_spans(self, traced, tmp_path):
+        backend = tracing.TracedBackend(str(tmp_path / "traced"))
+        untraced = FileBackend(str(tmp_path / "untraced"))
+        with tracing.transaction("reminder add", "discord.command"):
+            with tracing.span("ai.request", "openai gpt-4"):
+                pass
+            backend.save(Thing({"pk": "a"}))
+            backend.commit()
+            untraced.filter(Thing, {})
+        sentry_sdk.flush()
+        [transaction] = [e for e in traced if e.get("type") == "transaction"]
+        assert transaction["transaction"] == "reminder add"
+        spans = [(s["op"], s["description"]) for s in transaction["spans"]]
+        assert ("ai.request", "openai gpt-4") in spans
+        assert ("db.blitzdb", "save") in spans
+        assert ("db.blitzdb", "commit") in spans
+        assert ("db.blitzdb", "filter") not in spans
+
+    #  Tests that spans outside of a transaction are skipped
+    def test_no_transaction(self, traced):
+        with tracing.span("db.blitzdb", "get") as span:
+            assert span is None
@@ -0,0 +1,61 @@
+import gzip
+import io
+import json
+
+import pytest
+
+from util import transcript
+from util.chatgpt import Model, UserConfig
+from util.souls import Soul
+
+
+class FakeUser:
+    """Just the parts of a GPTUser an export reads, so no tokenizer is needed"""
+
+    name = "Alice"
+    model = Model("gpt-4")
+    prompt_info = None
+    config = UserConfig.SHOWSTATS | UserConfig.NAMESUFFIX
+    soul = Soul("Bob", "a bot", "Long", "Plan")
+    conversation = [
+        {"role": "system", "content": "Prompt"},
+        {"role": "user", "content": "Hello\nthere"},
+        {"role": "assistant", "content": "Hi"},
+    ]
+
+
+class TestTranscript:
+    #  Tests that exports read back exactly, whatever the compression
+    @pytest.mark.parametrize("compression", transcript.compressions())
+    def test_round_trip(self, compression):
+        file = io.BytesIO()
+        transcript.write_export(FakeUser(), file, compression)
+        header, conversation = transcript.read_export(file.getvalue())
+        assert conversation == FakeUser.conversation
+        assert header["model"] == "gpt-4"
+        assert UserConfig(header["config"]) == FakeUser.config
+        assert Soul(**header["soul"]) == FakeUser.soul
+
+    #  Tests that gzip exports are actually compressed
+    def test_gzip(self):
+        file = io.BytesIO()
+        transcript.write_export(FakeUser(), file, "gzip")
+        assert gzip.decompress(file.getvalue()).startswith(b'{"version": 1')
+
+    #  Tests that broken or oversized exports are rejected
+    def test_invalid(self):
+        header = json.dumps({"version": 1}) + "\n"
+        with pytest.raises(ValueError):
+            transcript.read_export(b"")
+        with pytest.raises(ValueError):
+            transcript.read_export(header.encode())
+        with pytest.raises(ValueError):
+            transcript.read_export(
+                (header + json.dumps({"role": "robot", "content": "x"})).encode()
+            )
+        with pytest.raises(ValueError):
+            transcript.read_export(
+                (header + json.dumps({"role": "user", "content": "x"})).encode()
+            )
+        with pytest.raises(ValueError):
+            transcript.read_export(gzip.compress(b"x" * 2000), limit=1000)
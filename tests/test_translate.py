@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from util.chatgpt import Model
+from util.translate import TranslationEngine, TranslationSession
+
+
+class FakeModel:
+    """Translates by upper-casing, numbered or not, and counts requests"""
+
+    def __init__(self, numbered=True):
+        self.requests = []
+        self.sent = []
+        self.numbered = numbered
+
+    async def __call__(self, conversation, model, contexts):
+        self.requests.append(conversation)
+        self.sent.append((model, contexts))
+        text = conversation[-1]["content"]
+        if not self.numbered and "\n" in text:
+            return "Not what you asked for"
+        return text.upper()
+
+
+class TestTranslationEngine:
+    #  Tests that each request carries only the prompt, the recent lines and the new line
+    @pytest.mark.asyncio
+    async def test_stateless(self):
+        send = FakeModel()
+        engine = TranslationEngine(send, max_batch=1)
+        session = TranslationSession("English", "Shouting", window=2)
+        for line in ["one", "two", "three", "four"]:
+            assert await engine.translate(session, line, Model()) == line.upper()
+        last = send.requests[-1]
+        assert len(last) == 2
+        assert "three => THREE" in last[0]["content"]
+        assert "one => ONE" not in last[0]["content"]
+
+    #  Tests that repeated lines come from the language pair's memory
+    @pytest.mark.asyncio
+    async def test_memory(self):
+        send = FakeModel()
+        engine = TranslationEngine(send, max_batch=1, memory_size=1)
+        await engine.translate(TranslationSession("en", "de"), "Hello  there", Model())
+        other = TranslationSession("EN", "DE")
+        assert await engine.translate(other, "Hello there", Model()) == "HELLO  THERE"
+        assert len(send.requests) == 1 and engine.hits == 1
+        await engine.translate(TranslationSession("de", "en"), "Hello there", Model())
+        assert len(send.requests) == 2
+        await engine.translate(other, "Bye", Model())
+        await engine.translate(other, "Hello there", Model())
+        assert len(send.requests) == 4
+
+    #  Tests that a lone line goes out at once and the lines right behind it share one request
+    @pytest.mark.asyncio
+    async def test_batching(self):
+        send = FakeModel()
+        engine = TranslationEngine(send, batch_window=0.01)
+        session = TranslationSession("en", "de")
+        model = Model()
+        results = await asyncio.gather(
+            *(engine.translate(session, line, model) for line in ["a", "b", "c"])
+        )
+        assert results == ["A", "B", "C"]
+        assert [r[-1]["content"] for r in send.requests] == ["a", "1. b\n2. c"]
+        await asyncio.sleep(0.05)
+        assert not engine._flushes
+        assert await engine.translate(session, "d", model) == "D"
+        assert len(send.requests) == 3
+
+    #  Tests that a lone line doesn't wait for the batch window
+    @pytest.mark.asyncio
+    async def test_no_wait(self):
+        engine = TranslationEngine(FakeModel(), batch_window=60)
+        session = TranslationSession("en", "de")
+        model = Model()
+        translation = engine.translate(session, "a", model)
+        assert await asyncio.wait_for(translation, 1) == "A"
+        engine._flushes[(id(session), model)].cancel()
+
+    #  Tests that a reply in the wrong format falls back to one request per line
+    @pytest.mark.asyncio
+    async def test_batch_fallback(self):
+        send = FakeModel(numbered=False)
+        engine = TranslationEngine(send, batch_window=0.01)
+        session = TranslationSession("en", "de")
+        model = Model()
+        results = await asyncio.gather(
+            engine.translate(session, "a", model),
+            engine.translate(session, "b", model),
+            engine.translate(session, "c", model),
+        )
+        assert results == ["A", "B", "C"]
+        assert len(send.requests) == 4
+
+    #  Tests that lines for different models are batched apart, and each batch carries its own lines' contexts
+    @pytest.mark.asyncio
+    async def test_batch_per_model(self):
+        send = FakeModel()
+        engine = TranslationEngine(send, batch_window=0.01)
+        session = TranslationSession("en", "de")
+        full, degraded = Model("gpt-4"), Model()
+        results = await asyncio.gather(
+            engine.translate(session, "a", full, "ctx a"),
+            engine.translate(session, "b", full, "ctx b"),
+            engine.translate(session, "c", degraded, "ctx c"),
+            engine.translate(session, "d", full, "ctx d"),
+        )
+        assert results == ["A", "B", "C", "D"]
+        assert sorted((model.model, contexts) for model, contexts in send.sent) == [
+            ("gpt-3.5-turbo", ["ctx c"]),
+            ("gpt-4", ["ctx a"]),
+            ("gpt-4", ["ctx b", "ctx d"]),
+        ]
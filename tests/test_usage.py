@@ -0,0 +1,67 @@
+import pytest
+from blitzdb import FileBackend
+
+from util.chatgpt import Completion
+from util.usage import UsageRecord, UsageTracker, split_completion
+
+
+class TestUsageTracker:
+    @pytest.fixture
+    def tracker(self):
+        tracker = UsageTracker(latency_samples=100)
+        tracker.record(1, 10, "gpt-4", "chat", Completion("a", 100, 20, 50, 1.0), 1.0)
+        tracker.record(1, 11, "gpt-4", "chat", Completion("b", 200, 30, 0, 2.0), 2.0)
+        tracker.record(2, 10, "gpt-3.5-turbo", "translate", None, 0.5)
+        return tracker
+
+    #  Tests that totals can be broken down by guild, user, model and command
+    def test_summarize(self, tracker):
+        by_guild = tracker.summarize(0)
+        assert by_guild[1]["prompt_tokens"] == 300
+        assert by_guild[1]["cached_tokens"] == 50
+        assert by_guild[2]["errors"] == 1
+        assert tracker.summarize(1)[10]["requests"] == 2
+        assert tracker.grand_total()["completion_tokens"] == 50
+
+    #  Tests latency percentiles and that only the most recent samples are kept
+    def test_latency(self, tracker):
+        assert tracker.latency_percentiles(model="gpt-4")["p50"] == 2.0
+        assert tracker.latency_percentiles(command="translate")["p99"] == 0.5
+        for _ in range(200):
+            tracker.record(1, 10, "gpt-4", "chat", None, 9.0)
+        assert tracker.latency_percentiles(model="gpt-4") == {
+            "p50": 9.0,
+            "p95": 9.0,
+            "p99": 9.0,
+        }
+
+    #  Tests that flushing adds only the new usage to the stored daily totals
+    def test_flush(self, tracker, tmp_path):
+        backend = FileBackend(str(tmp_path))
+        backend.autocommit = True
+        assert tracker.flush(backend) == 3
+        assert tracker.flush(backend) == 0
+        tracker.record(1, 10, "gpt-4", "chat", Completion("c", 5, 5, 0), 1.0)
+        tracker.flush(backend)
+        record = backend.get(UsageRecord, {"user_id": 10, "model": "gpt-4"})
+        assert record.requests == 2
+        assert record.prompt_tokens == 105
+
+    #  Tests that taken usage is cleared from memory and can be saved later, while totals are kept per key part
+    def test_take_pending(self, tracker, tmp_path):
+        pending = tracker.take_pending()
+        assert len(pending) == 3
+        assert tracker.take_pending() == {}
+        tracker.record(1, 10, "gpt-4", "chat", None, 1.0)
+        backend = FileBackend(str(tmp_path))
+        backend.autocommit = True
+        assert UsageTracker.save(backend, pending) == 3
+        assert len(tracker.totals[1]) == 2
+        assert tracker.summarize(0)[1]["requests"] == 3
+
+    #  Tests that a shared request's tokens are split without losing any
+    def test_split_completion(self):
+        shares = split_completion(Completion("a", 10, 5, 0, 1.0), 3)
+        assert [s.prompt_tokens for s in shares] == [4, 3, 3]
+        assert [s.completion_tokens for s in shares] == [2, 2, 1]
+        assert all(s.text == "a" and s.latency == 1.0 for s in shares)
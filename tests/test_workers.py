@@ -0,0 +1,31 @@
+import math
+import operator
+
+import pytest
+
+from util import metrics, workers
+
+
+class TestWorkers:
+    #  Tests that without a pool, functions run in place
+    @pytest.mark.asyncio
+    async def test_inline(self, monkeypatch):
+        monkeypatch.setattr(workers, "pool", None)
+        assert await workers.run(operator.mul, 6, 7) == 42
+
+    #  Tests that jobs run in a worker process, errors come back, and both are timed
+    @pytest.mark.asyncio
+    async def test_pool(self, monkeypatch):
+        pool = workers.WorkerPool(processes=1, warmup=["json", "does.not.exist"])
+        monkeypatch.setattr(workers, "pool", pool)
+        try:
+            pool.start()
+            assert await workers.run(operator.mul, 6, 7) == 42
+            assert await workers.run(sorted, [3, 1, 2], reverse=True) == [3, 2, 1]
+            with pytest.raises(ValueError):
+                await workers.run(math.sqrt, -1)
+        finally:
+            pool.stop()
+        assert pool.pending == 0
+        assert ("_operator.mul",) in metrics.WORKER_WAIT.values
+        assert ("math.sqrt", "error") in metrics.WORKER_DURATION.values
@@ -1,4 +1,5 @@
 import discord
+import yaml
 
 guilds = []
 MAX_MESSAGE_LENGTH = 2000
@@ -41,6 +42,18 @@ def has_roles(user: discord.Member, roles: list[str]) -> bool:
     return any(has_role(user, rolestr) for rolestr in roles)
 
 
+def is_admin(user: discord.abc.User, bot_config: dict) -> bool:
+    """Whether the user holds one of the admin roles from the bot config"""
+    if not isinstance(user, discord.Member):
+        return False
+    return has_roles(user, bot_config["system"].get("admin_roles", []))
+
+
+def load_config(path: str = "config.yml") -> dict:
+    with open(path, "r") as file:
+        return yaml.safe_load(file)
+
+
 def update_guilds(guildlist: list):
     global guilds
     guilds = guildlist
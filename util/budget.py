@@ -0,0 +1,72 @@
+from collections import namedtuple
+from typing import Dict, Iterable, Optional
+
+from util.chatgpt import Completion, Model
+
+# How much of the conversation to send (in tokens, including the system prompt) and how long the reply may be
+ContextPlan = namedtuple("ContextPlan", ["context_tokens", "max_tokens"])
+
+
+class BudgetPlanner:
+    """Decides how much conversation history to send and how long a reply to ask for, per request. Short
+    conversational turns only need the last few exchanges and a short reply, so they get a smaller prompt and finish
+    sooner; longer messages get more of both. Configured in the `context_budget` section of the ChatGPT config:
+
+        context_budget:
+          min_context: 1024  # the least history (in tokens) ever sent
+          context_per_token: 20  # extra history sent per token of the new message
+          min_reply: 256  # the shortest reply ever asked for
+          headroom: 1.5  # how much longer than recent replies the next one may be
+          latency_target: 10  # seconds, caps reply length using the model's observed speed
+    """
+
+    def __init__(
+        self,
+        min_context: int = 1024,
+        context_per_token: int = 20,
+        min_reply: int = 256,
+        headroom: float = 1.5,
+        latency_target: Optional[float] = None,
+    ):
+        self.min_context = min_context
+        self.context_per_token = context_per_token
+        self.min_reply = min_reply
+        self.headroom = headroom
+        self.latency_target = latency_target
+        # Moving average of seconds per reply token for each model name
+        self.seconds_per_token: Dict[str, float] = {}
+
+    def observe(self, model: Model, completion: Completion):
+        """Learn how fast a model replies from a finished request"""
+        if not completion.completion_tokens:
+            return
+        rate = completion.latency / completion.completion_tokens
+        previous = self.seconds_per_token.get(model.model)
+        self.seconds_per_token[model.model] = (
+            rate if previous is None else previous * 0.8 + rate * 0.2
+        )
+
+    def plan(
+        self, model: Model, message_tokens: int, recent_replies: Iterable[int]
+    ) -> ContextPlan:
+        """
+        :param model: The model the request goes to
+        :param message_tokens: The length of the message being replied to
+        :param recent_replies: The lengths of the model's latest replies in this conversation
+        """
+        recent_replies = list(recent_replies)
+        if recent_replies:
+            expected = max(max(recent_replies), message_tokens)
+            max_tokens = int(expected * self.headroom)
+        else:
+            max_tokens = model.max_tokens
+        seconds_per_token = self.seconds_per_token.get(model.model)
+        if self.latency_target and seconds_per_token:
+            max_tokens = min(max_tokens, int(self.latency_target / seconds_per_token))
+        max_tokens = max(
+            min(max_tokens, model.max_tokens), min(self.min_reply, model.max_tokens)
+        )
+
+        context_tokens = self.min_context + message_tokens * self.context_per_token
+        context_tokens = min(context_tokens, model.max_context - max_tokens)
+        return ContextPlan(context_tokens, max_tokens)
@@ -0,0 +1,111 @@
+import json
+import re
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from typing import List, Optional
+
+from blitzdb import Document
+
+from util.chatgpt import ConversationLine, Model
+
+
+class CachedResponse(Document):
+    class Meta(Document.Meta):
+        primary_key = "key"
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class ResponseCache:
+    """A content-addressed cache of model responses, for commands where the same request always deserves the same
+    answer (translations, summaries). Never use this for regular chat, where the conversation is stateful.
+
+    Entries live in an in-memory LRU, optionally backed by a blitzdb backend so they survive restarts.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: int = 86400, backend=None):
+        """
+        :param max_entries: The maximum number of responses kept in memory
+        :param ttl: How long a response stays valid, in seconds
+        :param backend: A blitzdb backend used as the on-disk tier, or None to only cache in memory
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self._entries: OrderedDict[str, tuple] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(model: Model, conversation: List[ConversationLine]) -> str:
+        """Returns the cache key for sending the given conversation to the given model"""
+        payload = json.dumps(
+            [
+                model.model,
+                model.temperature,
+                [[line["role"], _normalize(line["content"])] for line in conversation],
+            ]
+        )
+        return sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached response for a key, or None if there isn't a valid one"""
+        entry = self._entries.get(key)
+        if entry is None and self.backend:
+            try:
+                doc = self.backend.get(CachedResponse, {"key": key})
+                entry = (doc.response, doc.expires)
+                self._store(key, entry)
+            except CachedResponse.DoesNotExist:
+                pass
+        if entry is None or entry[1] < time.time():
+            if self._entries.pop(key, None) and self.backend:
+                self.backend.filter(CachedResponse, {"key": key}).delete()
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, response: str):
+        """Caches a response"""
+        entry = (response, time.time() + self.ttl)
+        self._store(key, entry)
+        if self.backend:
+            self.backend.save(
+                CachedResponse({"key": key, "response": response, "expires": entry[1]})
+            )
+
+    def purge(self) -> int:
+        """Deletes the expired responses from the on-disk tier
+        :return: The number of responses deleted
+        """
+        if not self.backend:
+            return 0
+        expired = self.backend.filter(CachedResponse, {"expires": {"$lt": time.time()}})
+        count = len(expired)
+        if count:
+            expired.delete()
+        return count
+
+    def _store(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    @property
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": f"{self.hits / lookups:.0%}" if lookups else "n/a",
+        }
@@ -0,0 +1,196 @@
+"""Gateway intents and cache policy, worked out from what the cogs say they need.
+
+A cog declares what it needs with a class attribute and, if it needs member lists, a method:
+
+    class RoleConcat(commands.Cog):
+        # Intents on top of guilds and messages that the cog can't work without
+        intents = ("members",)
+
+        def member_guilds(self) -> Iterable[int]:
+            # The guilds whose full member list the cog needs in the cache
+            return self.config["servers"].keys()
+
+Intents are sent when connecting, before any cog is loaded, so they're read from the source of the plugin modules
+rather than by importing them, which would hold up startup and leave nothing for the threaded cog import to do. The
+`intents` attribute must be a literal to be found this way; cogs loaded without an intent they declare are reported
+by `missing_intents`. Member lists are never requested for every guild at startup, only for the guilds a loaded
+cog asks for.
+"""
+
+import ast
+import importlib.util
+import random
+import sys
+from collections import namedtuple
+from typing import Dict, Iterable, List, Set
+
+import discord
+
+# Every cog gets these: guild, channel and role events, and message events
+BASE_INTENTS = ("guilds", "messages")
+# How many objects of each kind are measured to estimate the size of them all
+SAMPLE_SIZE = 200
+
+# What one guild holds in the cache, and an estimate of how much memory that takes, in bytes
+GuildFootprint = namedtuple(
+    "GuildFootprint", ["id", "name", "members", "channels", "roles", "messages", "size"]
+)
+
+
+def declared_intents(plugins: Iterable[str]) -> Dict[str, List[str]]:
+    """The intents the classes in these plugin modules declare, with the classes that need each one. Modules that
+    can't be found or parsed are skipped; loading them will fail, and be reported, later on.
+    """
+    needed: Dict[str, List[str]] = {}
+    for plugin in plugins:
+        try:
+            spec = importlib.util.find_spec(plugin)
+        except (ImportError, ValueError):
+            continue
+        if not spec or not spec.origin or not spec.origin.endswith(".py"):
+            continue
+        try:
+            with open(spec.origin, encoding="utf-8") as file:
+                module = ast.parse(file.read(), spec.origin)
+        except (OSError, SyntaxError, ValueError):
+            continue
+        for cls in module.body:
+            if not isinstance(cls, ast.ClassDef):
+                continue
+            for intent in _literal_intents(cls):
+                needed.setdefault(intent, []).append(cls.name)
+    return needed
+
+
+def _literal_intents(cls: ast.ClassDef) -> Iterable[str]:
+    for statement in cls.body:
+        if not isinstance(statement, ast.Assign):
+            continue
+        if not any(
+            isinstance(t, ast.Name) and t.id == "intents" for t in statement.targets
+        ):
+            continue
+        try:
+            return ast.literal_eval(statement.value)
+        except ValueError:
+            return ()
+    return ()
+
+
+def make_intents(names: Iterable[str]) -> discord.Intents:
+    """:raises ValueError: If one of the names isn't an intent"""
+    intents = discord.Intents.none()
+    for name in (*BASE_INTENTS, *names):
+        if name not in discord.Intents.VALID_FLAGS:
+            raise ValueError(f"Unknown intent {name}")
+        setattr(intents, name, True)
+    return intents
+
+
+def missing_intents(bot) -> Dict[str, List[str]]:
+    """The intents loaded cogs declare that the bot connected without, with the cogs that need each one"""
+    missing: Dict[str, List[str]] = {}
+    for cog in bot.cogs.values():
+        for intent in getattr(cog, "intents", ()):
+            if not getattr(bot.intents, intent, False):
+                missing.setdefault(intent, []).append(cog.qualified_name)
+    return missing
+
+
+def member_guilds(bot) -> Set[int]:
+    """The guilds whose member list a loaded cog needs"""
+    guild_ids = set()
+    for cog in bot.cogs.values():
+        if hasattr(cog, "member_guilds"):
+            guild_ids.update(int(g) for g in cog.member_guilds())
+    return guild_ids
+
+
+async def chunk_required(bot) -> List[int]:
+    """Request the member list of each guild a cog needs that hasn't got one yet
+    :return: The IDs of the guilds that were chunked
+    """
+    if not bot.intents.members:
+        return []
+    chunked = []
+    for guild_id in sorted(member_guilds(bot)):
+        guild = bot.get_guild(guild_id)
+        if guild is None or guild.chunked:
+            continue
+        await guild.chunk()
+        chunked.append(guild_id)
+    return chunked
+
+
+def _sizeof(obj) -> int:
+    # The object itself, plus the plain values it holds. Other Discord objects it refers to are counted on their own.
+    size = sys.getsizeof(obj)
+    for cls in type(obj).__mro__:
+        for slot in getattr(cls, "__slots__", ()):
+            value = getattr(obj, slot, None)
+            if value is None or isinstance(value, bool):
+                continue
+            if type(value).__module__ in ("builtins", "array"):
+                size += sys.getsizeof(value)
+    return size
+
+
+def estimate(objects: list) -> int:
+    """The size of a list of objects, estimated from a sample of them"""
+    if not objects:
+        return 0
+    sample = (
+        random.sample(objects, SAMPLE_SIZE) if len(objects) > SAMPLE_SIZE else objects
+    )
+    return sum(_sizeof(obj) for obj in sample) * len(objects) // len(sample)
+
+
+def footprint(bot) -> List[GuildFootprint]:
+    """What each guild holds in the cache, largest first. Runs on the event loop, since the cache can't be read
+    safely from anywhere else, but only measures a sample of each kind of object."""
+    messages: Dict[int, list] = {}
+    for message in bot.cached_messages:
+        if message.guild:
+            messages.setdefault(message.guild.id, []).append(message)
+    footprints = []
+    for guild in bot.guilds:
+        members = list(guild.members)
+        channels = list(guild.channels)
+        roles = list(guild.roles)
+        cached = messages.get(guild.id, [])
+        size = (
+            _sizeof(guild)
+            + estimate(members)
+            + estimate(channels)
+            + estimate(roles)
+            + estimate(cached)
+        )
+        footprints.append(
+            GuildFootprint(
+                guild.id,
+                guild.name,
+                len(members),
+                len(channels),
+                len(roles),
+                len(cached),
+                size,
+            )
+        )
+    return sorted(footprints, key=lambda f: f.size, reverse=True)
+
+
+def report(bot) -> str:
+    """A table of what each guild holds in the cache, and the estimated memory it takes"""
+    intents = [name for name, enabled in bot.intents if enabled]
+    lines = [
+        f"Intents: {', '.join(intents)}",
+        f"Message cache: {bot._connection.max_messages or 'off'}, "
+        f"users cached: {len(bot.users)}",
+        f"{'guild':<24} {'members':>8} {'channels':>8} {'roles':>6} {'messages':>8} {'KiB':>8}",
+    ]
+    for guild in footprint(bot):
+        lines.append(
+            f"{guild.name[:24]:<24} {guild.members:>8} {guild.channels:>8} {guild.roles:>6} "
+            f"{guild.messages:>8} {guild.size / 1024:>8.1f}"
+        )
+    return "\n".join(lines)
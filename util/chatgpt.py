@@ -1,15 +1,42 @@
+from collections import deque, namedtuple
 from datetime import datetime, timedelta
 from hashlib import sha256
-from typing import List, Optional, TypedDict, Literal
+import importlib
+import time
+from typing import Deque, List, Optional, TypedDict, Literal
 from enum import Flag, auto
 
-from util.souls import Soul, SOUL_PROMPT
+from util import tracing, workers
+from util.souls import Soul, render_soul_prompt
+from util.startup import Lazy, lazy_import
 
-import tiktoken
-import openai
-import anthropic
+# The vendor libraries take about a second to import between them, so they're only imported once needed. Their API
+# keys are kept here until then.
+api_keys = {}
 
-anthropic_api = anthropic.AsyncAnthropic()
+
+def _openai():
+    module = importlib.import_module("openai")
+    if api_keys.get("openai"):
+        module.api_key = api_keys["openai"]
+    return module
+
+
+def set_api_keys(openai_key: Optional[str], anthropic_key: Optional[str]):
+    api_keys.update(openai=openai_key, anthropic=anthropic_key)
+    if openai.loaded:
+        openai.api_key = openai_key
+    if anthropic_api.loaded:
+        anthropic_api.api_key = anthropic_key
+
+
+tiktoken = lazy_import("tiktoken")
+openai = Lazy("openai", _openai)
+anthropic = lazy_import("anthropic")
+anthropic_api = Lazy(
+    "anthropic client",
+    lambda: anthropic.AsyncAnthropic(api_key=api_keys.get("anthropic")),
+)
 
 
 class ConversationLine(TypedDict):
@@ -26,53 +53,267 @@ class UserConfig(Flag):
 
 DEFAULT_FLAGS = UserConfig.SHOWSTATS | UserConfig.NAMESUFFIX
 
+# What a model said in reply, along with the vendor-reported token usage. cached_tokens is the part of prompt_tokens
+# that was served from the vendor's prompt cache, and latency is how long the request took in seconds.
+Completion = namedtuple(
+    "Completion",
+    ["text", "prompt_tokens", "completion_tokens", "cached_tokens", "latency"],
+    defaults=[0.0],
+)
+
+# A channel's most recent summary. last_message_id is the watermark: the newest message the summary covers.
+# message_count is how many messages back it reaches.
+ChannelSummary = namedtuple(
+    "ChannelSummary",
+    ["last_message_id", "summary", "summary_message_id", "message_count"],
+    defaults=[0],
+)
+
+
+# Texts longer than this, in characters, are tokenized in a worker process. Shorter ones take less time to tokenize
+# than to send there and back.
+WORKER_LENGTH = 1000
+
+# Context window, default reply size and tokenizer for the models we know about, matched by longest name prefix.
+# Claude doesn't have a public tokenizer, cl100k_base is close enough for budgeting purposes.
+KNOWN_MODELS = {
+    # Snapshots that don't share their family's context window
+    "gpt-3.5-turbo-0301": (4096, 768, "cl100k_base"),
+    "gpt-3.5-turbo-0613": (4096, 768, "cl100k_base"),
+    "gpt-4-vision-preview": (128000, 1024, "cl100k_base"),
+    # Families
+    "gpt-3.5-turbo": (16385, 768, "cl100k_base"),
+    "gpt-3.5-turbo-16k": (16385, 768, "cl100k_base"),
+    "gpt-4": (8192, 768, "cl100k_base"),
+    "gpt-4-32k": (32768, 768, "cl100k_base"),
+    "gpt-4-turbo": (128000, 1024, "cl100k_base"),
+    "gpt-4-1106": (128000, 1024, "cl100k_base"),
+    "gpt-4-0125": (128000, 1024, "cl100k_base"),
+    # gpt-4o really uses o200k_base, which the pinned tiktoken 0.4 doesn't have; cl100k_base is close enough to budget with
+    "gpt-4o": (128000, 1024, "cl100k_base"),
+    "claude-2": (100000, 1024, "cl100k_base"),
+    "claude-2.1": (200000, 1024, "cl100k_base"),
+    "claude-instant": (100000, 1024, "cl100k_base"),
+    "claude-3": (200000, 1024, "cl100k_base"),
+}
+UNKNOWN_MODEL = (4097, 768, "cl100k_base")
+
+
+def model_info(model: str) -> tuple:
+    """Returns (max_context, max_tokens, encoding) for a model name"""
+    matches = [k for k in KNOWN_MODELS if model.startswith(k)]
+    return KNOWN_MODELS[max(matches, key=len)] if matches else UNKNOWN_MODEL
+
 
 class Model:
+    """The settings used to talk to a model. Models are shared between every user of a guild, so they are immutable;
+    get a different one from the ModelRegistry instead of changing one."""
+
+    __slots__ = [
+        "model",
+        "max_tokens",
+        "temperature",
+        "max_context",
+        "vendor",
+        "prompt_caching",
+        "encoding",
+    ]
+
     def __init__(
         self,
         model: str = "gpt-3.5-turbo",
-        max_tokens: int = 768,
+        max_tokens: Optional[int] = None,
         temperature: float = 0.5,
-        max_context: int = 4097,
-        vendor: Literal["openai", "anthropic"] = "openai",
+        max_context: Optional[int] = None,
+        vendor: Literal["openai", "anthropic", "mock"] = "openai",
+        prompt_caching: bool = True,
+        encoding: Optional[str] = None,
     ):
-        self.model = model
-        self.max_tokens = max_tokens
-        self.temperature = temperature
-        self.max_context = max_context
-        self.vendor = vendor
+        """
+        :param max_tokens: The maximum length of a reply. Defaults to a sensible value for the model.
+        :param max_context: The size of the model's context window. Defaults to the model's actual context window.
+        :param prompt_caching: Ask the vendor to cache the stable prefix of each conversation (the system prompt,
+         which includes any soul background), so it doesn't have to be processed again on every turn.
+        :param encoding: The tiktoken encoding used to count tokens. Defaults to the one matching the model.
+        """
+        known_context, known_max_tokens, known_encoding = model_info(model)
+        for name, value in (
+            ("model", model),
+            ("max_tokens", max_tokens or known_max_tokens),
+            ("temperature", temperature),
+            ("max_context", max_context or known_context),
+            ("vendor", vendor),
+            ("prompt_caching", prompt_caching),
+            ("encoding", encoding or known_encoding),
+        ):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Model is immutable")
+
+    def __repr__(self):
+        return f"Model({self.model!r}, vendor={self.vendor!r}, max_context={self.max_context})"
 
     async def send(self, conversation: List[ConversationLine]) -> Optional[str]:
-        if self.vendor == "openai":
-            return await self._openai_send(conversation)
-        elif self.vendor == "anthropic":
-            return await self._anthropic_send(conversation)
-
-    async def _openai_send(self, conversation: List[ConversationLine]) -> Optional[str]:
+        completion = await self.complete(conversation)
+        return completion.text if completion else None
+
+    async def complete(
+        self, conversation: List[ConversationLine], max_tokens: Optional[int] = None
+    ) -> Optional[Completion]:
+        """Like send, but also returns the token usage reported by the vendor and the request latency
+        :param max_tokens: The maximum length of this reply, if it should be shorter than the model's max_tokens
+        """
+        max_tokens = min(max_tokens or self.max_tokens, self.max_tokens)
+        started = time.perf_counter()
+        with tracing.span("ai.request", f"{self.vendor} {self.model}"):
+            if self.vendor == "openai":
+                completion = await self._openai_send(conversation, max_tokens)
+            elif self.vendor == "anthropic":
+                completion = await self._anthropic_send(conversation, max_tokens)
+            elif self.vendor == "mock":
+                from util import mockllm
+
+                completion = await mockllm.vendor.complete(
+                    self, conversation, max_tokens
+                )
+            else:
+                return None
+        if completion:
+            completion = completion._replace(latency=time.perf_counter() - started)
+        return completion
+
+    async def _openai_send(
+        self, conversation: List[ConversationLine], max_tokens: int
+    ) -> Optional[Completion]:
+        # OpenAI caches prompt prefixes automatically. All we have to do is keep the prefix stable, which is why the
+        # system prompt always comes first and per-turn reminders are appended at the end of the conversation.
         response = await openai.ChatCompletion.acreate(
             model=self.model,
-            max_tokens=self.max_tokens,
+            max_tokens=max_tokens,
             temperature=self.temperature,
             messages=conversation,
             n=1,
             stop=None,
         )
-        return response.choices[0]["message"]["content"]
+        usage = response.usage
+        details = getattr(usage, "prompt_tokens_details", None)
+        return Completion(
+            response.choices[0]["message"]["content"],
+            usage.prompt_tokens,
+            usage.completion_tokens,
+            getattr(details, "cached_tokens", 0) or 0,
+        )
 
     async def _anthropic_send(
-        self, conversation: List[ConversationLine]
-    ) -> Optional[str]:
-        sysprompt = [l for l in conversation if l["role"] == "system"][0]
+        self, conversation: List[ConversationLine], max_tokens: int
+    ) -> Optional[Completion]:
+        sysprompts = [l["content"] for l in conversation if l["role"] == "system"]
         conversation = [l for l in conversation if l["role"] != "system"]
+        # The first system prompt is stable across turns and gets cached. Anything after it (like soul remembrance
+        # prompts) changes from turn to turn, so it follows the cached block rather than invalidating it.
+        system = [{"type": "text", "text": text} for text in sysprompts]
+        extra_headers = {}
+        if self.prompt_caching and system:
+            system[0]["cache_control"] = {"type": "ephemeral"}
+            extra_headers["anthropic-beta"] = "prompt-caching-2024-07-31"
         # noinspection PyTypeChecker
         response = await anthropic_api.messages.create(
             model=self.model,
-            max_tokens=self.max_tokens,
+            max_tokens=max_tokens,
             temperature=self.temperature,
             messages=conversation,
-            system=sysprompt["content"],
+            system=system,
+            extra_headers=extra_headers,
+        )
+        usage = response.usage
+        cached_tokens = getattr(usage, "cache_read_input_tokens", 0) or 0
+        return Completion(
+            response.content[0].text,
+            usage.input_tokens
+            + cached_tokens
+            + (getattr(usage, "cache_creation_input_tokens", 0) or 0),
+            usage.output_tokens,
+            cached_tokens,
         )
-        return response.content[0].text
+
+
+class ModelRegistry:
+    """Holds one shared Model per guild, built from the ChatGPT config. Guilds with identical model settings share the
+    same Model object. Call `load` again with a new config to hot-reload the models.
+
+    Model settings are read from each guild's config (or the default config): `model_name`, `vendor`, and optionally
+    `max_context`, `max_tokens`, `temperature` and `encoding`. Settings for a model name can also be given for every
+    guild at once in the `models` section of the ChatGPT config. The model that over-quota requests are degraded to
+    is read from `quotas.degrade` in the same way.
+    """
+
+    def __init__(self, config: dict):
+        self._models = {}
+        self._default = None
+        self.degraded: Optional[Model] = None
+        self.load(config)
+
+    def load(self, config: dict):
+        models = {}
+        shared = {}
+        overrides = config.get("models", {})
+        server_configs = list(config.items())
+        if "degrade" in config.get("quotas", {}):
+            server_configs.append(("degraded", config["quotas"]["degrade"]))
+        for key, server_config in server_configs:
+            if key not in ("default", "degraded") and not isinstance(key, int):
+                continue
+            name = server_config["model_name"]
+            settings = {**overrides.get(name, {}), **server_config}
+            spec = (
+                name,
+                settings.get("vendor", "openai"),
+                settings.get("max_tokens"),
+                settings.get("temperature", 0.5),
+                settings.get("max_context"),
+                settings.get("prompt_caching", True),
+                settings.get("encoding"),
+            )
+            if spec not in shared:
+                shared[spec] = Model(
+                    name,
+                    vendor=spec[1],
+                    max_tokens=spec[2],
+                    temperature=spec[3],
+                    max_context=spec[4],
+                    prompt_caching=spec[5],
+                    encoding=spec[6],
+                )
+            models[key] = shared[spec]
+        self._default = models.pop("default")
+        self.degraded = models.pop("degraded", None)
+        self._models = models
+
+    def get(self, guild_id: Optional[int] = None) -> Model:
+        """Returns the model for a guild, or the default model"""
+        return self._models.get(guild_id, self._default)
+
+    def __contains__(self, model: Model) -> bool:
+        """Whether the given model is one of the models currently loaded, as opposed to one from an earlier load"""
+        return (
+            model is self._default
+            or model is self.degraded
+            or any(model is m for m in self._models.values())
+        )
+
+
+def count_tokens(encoding: str, texts: List[str]) -> int:
+    """The number of tokens in all of `texts`. Runs in a worker process for long texts, see `measure`."""
+    tokenizer = tiktoken.get_encoding(encoding)
+    return sum(len(tokenizer.encode(text)) for text in texts)
+
+
+async def measure(encoding: str, *texts: str) -> int:
+    """The number of tokens in all of `texts`, counted in a worker process if they're long enough to be worth it"""
+    if sum(len(text) for text in texts) <= WORKER_LENGTH:
+        return count_tokens(encoding, list(texts))
+    return await workers.run(count_tokens, encoding, list(texts))
 
 
 class GPTUser:
@@ -89,6 +330,8 @@ class GPTUser:
         "_encoding",
         "_conversation_len",
         "prompt_info",
+        "last_completion",
+        "recent_replies",
     ]
     id: int
     name: str
@@ -99,9 +342,11 @@ class GPTUser:
     _soul: Optional[Soul]
     _model: Model
     config: UserConfig
-    _encoding: tiktoken.Encoding
+    _encoding: "tiktoken.Encoding"
     _conversation_len: int
     prompt_info: Optional[str]
+    last_completion: Optional[Completion]
+    recent_replies: Deque[int]
 
     def __init__(
         self,
@@ -109,7 +354,7 @@ class GPTUser:
         uname: str,
         sysprompt: str,
         prompt_info: Optional[str],
-        model: Model,
+        model: Optional[Model] = None,
         config: UserConfig = DEFAULT_FLAGS,
     ):
         """
@@ -118,7 +363,7 @@ class GPTUser:
         :param uname: The username of the user.
         :param sysprompt: The system prompt to be used for conversation generation.
         :param prompt_info: A very short description of the system prompt.
-        :param model: The model object to be used for conversation generation.
+        :param model: The model object to be used for conversation generation. Defaults to the default Model.
         """
         self.id = uid
         self.name = uname
@@ -129,13 +374,14 @@ class GPTUser:
         self.last = datetime.utcnow()
         self._soul = None
         self.prompt_info = prompt_info
-        self._model = model
-        self._encoding = tiktoken.encoding_for_model("gpt-4")
+        self.last_completion = None
+        # Token counts of the model's latest replies, for planning how long the next one may be
+        self.recent_replies = deque(maxlen=5)
+        self._model = model or Model()
+        self._encoding = tiktoken.get_encoding(self._model.encoding)
         self._conversation_len = self._calculate_conversation_len()
         if UserConfig.NAMESUFFIX in config:
             self._add_namesuffix()
-        if not model:
-            self._model = Model()
 
     @property
     def conversation(self):
@@ -185,7 +431,7 @@ class GPTUser:
     def soul(self, new_soul: Soul):
         self._soul = new_soul
         self.conversation = [
-            {"role": "system", "content": SOUL_PROMPT.format(**new_soul._asdict())}
+            {"role": "system", "content": render_soul_prompt(new_soul)}
         ]
         self.prompt_info = "Soul"
 
@@ -198,13 +444,53 @@ class GPTUser:
         else:
             return 0
 
-    def push_conversation(self, utterance: ConversationLine, copy=False):
-        """Append the given line of dialogue to this user's conversation"""
+    async def count_tokens(self, *texts: str) -> int:
+        """The number of tokens in `texts` for this user's model, counted in a worker process if they're long"""
+        return await measure(self._model.encoding, *texts)
+
+    def push_conversation(
+        self, utterance: ConversationLine, copy=False, tokens: Optional[int] = None
+    ):
+        """Append the given line of dialogue to this user's conversation
+        :param tokens: The length of the line in tokens, if it has been counted already
+        """
         if copy:
             self._conversation.insert(-1, utterance)
         else:
             self._conversation.append(utterance)
-        self._conversation_len += len(self._encoding.encode(utterance["content"]))
+        if tokens is None:
+            tokens = len(self._encoding.encode(utterance["content"]))
+        self._conversation_len += tokens
+
+    def recent_conversation(self, max_tokens: int) -> List[ConversationLine]:
+        """The system prompt followed by as many of the most recent lines of the conversation as fit in `max_tokens`.
+        The newest user line, and anything after it such as the remembrance prompt, is always included, even if that
+        goes over."""
+        if max_tokens >= self._conversation_len:
+            # A copy, since the conversation goes on changing while this is being sent
+            return list(self._conversation)
+        recent = []
+        budget = max_tokens - len(
+            self._encoding.encode(self._conversation[0]["content"])
+        )
+        required = True
+        for line in reversed(self._conversation[1:]):
+            budget -= len(self._encoding.encode(line["content"]))
+            if budget < 0 and not required:
+                break
+            recent.insert(0, line)
+            if line["role"] == "user":
+                required = False
+        return self._conversation[:1] + recent
+
+    def remove_conversation(self, *lines: ConversationLine):
+        """Remove these exact lines of dialogue from this user's conversation, wherever they are now. Other lines
+        with the same content, and lines added since, are left alone."""
+        for line in lines:
+            for index, existing in enumerate(self._conversation):
+                if existing is line:
+                    self.pop_conversation(index)
+                    break
 
     def pop_conversation(self, index: int = -1) -> ConversationLine:
         """Pop lines of dialogue from this user's conversation"""
@@ -228,7 +514,7 @@ class GPTUser:
 
     @model.setter
     def model(self, new_model: Model):
-        self._encoding = tiktoken.encoding_for_model(new_model.model)
+        self._encoding = tiktoken.get_encoding(new_model.encoding)
         self._model = new_model
         self._conversation_len = self._calculate_conversation_len()
 
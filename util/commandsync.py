@@ -0,0 +1,108 @@
+import hashlib
+import json
+from typing import Dict, List, Optional
+
+from blitzdb import Document
+
+GLOBAL = "global"
+
+
+class CommandHash(Document):
+    """The hash of the application commands last synced to one guild (or globally), for one application, and the
+    names, types and IDs Discord gave them"""
+
+    class Meta(Document.Meta):
+        primary_key = "key"
+
+
+def command_hash(commands) -> str:
+    """A stable hash of command definitions, as they are sent to Discord"""
+    definitions = sorted(
+        (command.to_dict() for command in commands),
+        key=lambda d: (d.get("type", 1), d["name"]),
+    )
+    return hashlib.sha256(
+        json.dumps(definitions, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def command_tree(bot) -> Dict[str, list]:
+    """The registered application commands, by guild ID (as a string), or GLOBAL for global commands"""
+    tree = {GLOBAL: []}
+    for command in bot.pending_application_commands:
+        if command.guild_ids is None:
+            tree[GLOBAL].append(command)
+            continue
+        for guild_id in command.guild_ids:
+            tree.setdefault(str(guild_id), []).append(command)
+    return tree
+
+
+def _key(application_id: int, scope: str) -> str:
+    return f"{application_id}:{scope}"
+
+
+async def sync_changed(bot, backend, force: bool = False) -> (List[str], int):
+    """Sync the command tree to Discord, skipping the guilds whose commands haven't changed since the last sync
+    :param force: Sync everything, whether or not it changed
+    :return: The guild IDs (or GLOBAL) that were synced, and the number that were skipped
+    """
+    tree = command_tree(bot)
+    stored = {
+        doc.key: doc
+        for doc in backend.filter(CommandHash, {"application": bot.application_id})
+    }
+    # Guilds that had commands before but have none now still need them removed
+    for key in stored:
+        tree.setdefault(key.split(":", 1)[1], [])
+    synced, skipped = [], 0
+    for scope, commands in tree.items():
+        digest = command_hash(commands)
+        key = _key(bot.application_id, scope)
+        previous = stored.get(key)
+        # Hashes saved without the command IDs can't be skipped, the IDs are needed to dispatch interactions
+        if (
+            not force
+            and previous is not None
+            and previous.hash == digest
+            and "registered" in previous
+        ):
+            _map_ids(bot, commands, previous.registered)
+            skipped += 1
+            continue
+        guild_id: Optional[int] = None if scope == GLOBAL else int(scope)
+        registered = await bot.register_commands(
+            commands, guild_id=guild_id, force=force
+        )
+        _map_ids(bot, commands, registered)
+        backend.save(
+            CommandHash(
+                {
+                    "key": key,
+                    "application": bot.application_id,
+                    "scope": scope,
+                    "hash": digest,
+                    "registered": [
+                        {
+                            "name": data["name"],
+                            "type": data.get("type"),
+                            "id": data["id"],
+                        }
+                        for data in registered or []
+                    ],
+                }
+            )
+        )
+        synced.append(scope)
+    backend.commit()
+    return synced, skipped
+
+
+def _map_ids(bot, commands, registered):
+    # What sync_commands does after registering, so interactions find their command by ID
+    for data in registered or []:
+        for command in commands:
+            if command.name == data["name"] and command.type == data.get("type"):
+                command.id = data["id"]
+                bot._application_commands[command.id] = command
+                break
@@ -0,0 +1,198 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from util import log, metrics
+from util.loopmon import ROOT
+
+
+class ErrorGroup:
+    """Every occurrence of one kind of error: the same exception type, raised through the same functions, while
+    handling the same event"""
+
+    __slots__ = [
+        "fingerprint",
+        "type",
+        "message",
+        "location",
+        "event",
+        "stack",
+        "first_seen",
+        "last_seen",
+        "count",
+        "window_start",
+        "pending",
+    ]
+
+    def __init__(self, fingerprint: str, exc_info, event: str):
+        self.fingerprint = fingerprint
+        self.type = exc_info[0].__name__
+        self.message = str(exc_info[1])[:500]
+        self.location = location(exc_info[2])
+        self.event = event
+        self.stack = "".join(traceback.format_exception(*exc_info))
+        self.first_seen = time.time()
+        self.last_seen = self.first_seen
+        self.count = 0
+        self.window_start = 0.0
+        # Occurrences since the last one that was logged and sent to Sentry
+        self.pending = 0
+
+
+def fingerprint(exc_info, event: str) -> str:
+    """Identify a kind of error by its type, the event and the functions it went through, ignoring line numbers and
+    the message so it stays the same across small edits and varying values"""
+    frames = [
+        f"{os.path.basename(frame.filename)}:{frame.name}"
+        for frame in traceback.extract_tb(exc_info[2])
+    ]
+    key = "|".join([exc_info[0].__qualname__, event or ""] + frames)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+
+
+def location(tb) -> str:
+    """The innermost frame of the project's own code in a traceback"""
+    found = "unknown"
+    for frame in traceback.extract_tb(tb):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(ROOT) and "site-packages" not in filename:
+            found = f"{os.path.relpath(filename, ROOT)}:{frame.name}:{frame.lineno}"
+    return found
+
+
+def describe(value) -> str:
+    """A short description of an event argument. Discord objects are described by their ID, rather than dumping the
+    whole object (and everything it refers to)."""
+    if hasattr(value, "id"):
+        return f"{type(value).__name__}(id={value.id})"
+    text = repr(value)
+    return text if len(text) <= 200 else text[:200] + "..."
+
+
+class ErrorReporter:
+    """Collects the errors raised by event listeners. Occurrences of an error are grouped by fingerprint; the first
+    one in each `window` is logged (with its stack) and sent to Sentry, and the rest are only counted, with the count
+    added to the next report. Sentry events are sent from a background thread, at most `max_rate` a minute, and are
+    dropped when `queue_size` of them are already waiting. The most recent `history` error groups are kept for
+    the diagnostics command.
+    """
+
+    def __init__(
+        self,
+        logger,
+        sentry=None,
+        window: float = 60,
+        max_rate: float = 30,
+        history: int = 100,
+        queue_size: int = 100,
+    ):
+        """
+        :param window: How long occurrences of the same error are only counted after one is reported, in seconds
+        :param max_rate: The most events sent to Sentry per minute
+        :param history: How many error groups are kept
+        :param queue_size: How many Sentry events may wait to be sent
+        """
+        self.logger = logger
+        self.sentry = sentry
+        self.window = window
+        self.max_rate = max_rate
+        self.history = history
+        self.groups: Dict[str, ErrorGroup] = OrderedDict()
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+
+    def report(self, exc_info, event: str, args=(), kwargs=None) -> ErrorGroup:
+        """Record an error raised while handling an event
+        :param exc_info: As returned by `sys.exc_info()`
+        """
+        fp = fingerprint(exc_info, event)
+        group = self.groups.get(fp)
+        if group is None:
+            group = ErrorGroup(fp, exc_info, event)
+            self.groups[fp] = group
+            while len(self.groups) > self.history:
+                self.groups.popitem(last=False)
+        else:
+            self.groups.move_to_end(fp)
+        now = time.time()
+        group.count += 1
+        group.last_seen = now
+        group.message = str(exc_info[1])[:500]
+        metrics.ERRORS.inc(event=event)
+        if now - group.window_start < self.window:
+            group.pending += 1
+            return group
+        repeats, group.pending, group.window_start = group.pending, 0, now
+        self.logger.error(
+            "Error in %s [%s] at %s: %s: %s%s",
+            event,
+            fp,
+            group.location,
+            group.type,
+            group.message,
+            f" (and {repeats} more times since the last report)" if repeats else "",
+            exc_info=exc_info,
+        )
+        if self.sentry:
+            self._enqueue(exc_info, group, repeats, args, kwargs or {})
+        return group
+
+    def recent(self, limit: int = 10) -> List[ErrorGroup]:
+        """The most recently seen error groups, newest first"""
+        return list(reversed(self.groups.values()))[:limit]
+
+    def _enqueue(self, exc_info, group: ErrorGroup, repeats: int, args, kwargs):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._send_loop, name="error-reporter", daemon=True
+            )
+            self._thread.start()
+        extras = {
+            "event_args": [describe(arg) for arg in args],
+            "event_kwargs": {key: describe(value) for key, value in kwargs.items()},
+            "repeats_since_last_report": repeats,
+            "total_occurrences": group.count,
+        }
+        try:
+            self._queue.put_nowait((exc_info, group, log.current(), extras))
+        except queue.Full:
+            self.dropped += 1
+
+    def _send_loop(self):
+        interval = 60 / self.max_rate
+        last = 0.0
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            wait = last + interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            last = time.monotonic()
+            exc_info, group, context, extras = item
+            try:
+                with self.sentry.push_scope() as scope:
+                    scope.fingerprint = [group.fingerprint]
+                    scope.set_tag("bot_event", group.event)
+                    for key, value in context.items():
+                        scope.set_tag(key, value)
+                    for key, value in extras.items():
+                        scope.set_extra(key, value)
+                    self.sentry.capture_exception(exc_info)
+            except Exception:
+                self.logger.exception("Could not send an error to Sentry")
+
+    def stop(self, timeout: float = 2):
+        """Send whatever is queued, waiting up to `timeout` seconds"""
+        if self._thread and self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self._thread.join(timeout)
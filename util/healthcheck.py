@@ -0,0 +1,34 @@
+"""Liveness probe for containers, run by the Docker HEALTHCHECK:
+
+    python -m util.healthcheck
+
+Asks the bot's /healthz endpoint whether it's up. Metrics are opt-in and /healthz is only served along with them, so
+without a metrics section in config.yml there's nothing to ask and the check passes.
+"""
+
+import sys
+import urllib.error
+import urllib.request
+
+import util
+
+
+def main(path: str = "config.yml") -> int:
+    system = util.load_config(path)["system"]
+    if "metrics" not in system:
+        return 0
+    metrics = system["metrics"] or {}
+    host = metrics.get("host", "127.0.0.1")
+    if host in ("", "0.0.0.0", "::"):
+        host = "127.0.0.1"
+    url = f"http://{host}:{metrics.get('port', 9100)}/healthz"
+    try:
+        urllib.request.urlopen(url, timeout=5)
+    except (urllib.error.URLError, OSError) as e:
+        print(f"{url}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+from collections import deque, namedtuple
+from typing import Deque, Dict, Iterable, List, Optional, Set
+
+import discord
+
+# A compact copy of a Discord message, enough to rebuild chat history without keeping whole Message objects around
+MessageRecord = namedtuple(
+    "MessageRecord", ["id", "author_name", "content", "created_at"]
+)
+
+
+def record_from_message(message: discord.Message) -> MessageRecord:
+    return MessageRecord(
+        message.id, message.author.name, message.content, message.created_at
+    )
+
+
+class MessageBuffer:
+    """Per-channel ring buffers of recent messages, fed from gateway events so history reads don't have to go through
+    the (heavily rate limited, paginated) REST API.
+
+    A channel's buffer is contiguous: once we start watching a channel, every message newer than the oldest record
+    we hold has been seen, so any read that fits in that range is served from memory. Reads reaching further back fall
+    back to REST for just the part that isn't covered.
+    """
+
+    def __init__(
+        self,
+        channels: Iterable[int] = (),
+        per_channel: int = 1000,
+        per_guild: int = 5000,
+    ):
+        """
+        :param channels: IDs of the channels to buffer. Messages from any other channel are ignored.
+        :param per_channel: The maximum number of messages kept for a single channel
+        :param per_guild: The maximum number of messages kept across all the channels of a single guild
+        """
+        self.channels: Set[int] = set(channels)
+        self.per_channel = per_channel
+        self.per_guild = per_guild
+        self._buffers: Dict[int, Deque[MessageRecord]] = {}
+        # Everything in a channel newer than this message ID is in its buffer
+        self._covered_after: Dict[int, int] = {}
+        self._guild_channels: Dict[int, Set[int]] = {}
+
+    def __len__(self):
+        return sum(len(b) for b in self._buffers.values())
+
+    def tracks(self, channel_id: int) -> bool:
+        return channel_id in self.channels
+
+    def clear(self):
+        """Forget everything. Must be called whenever we may have missed gateway events (i.e. a new session), since
+        the buffers would no longer be contiguous."""
+        self._buffers.clear()
+        self._covered_after.clear()
+        self._guild_channels.clear()
+
+    def add(self, message: discord.Message):
+        """Record a newly created message"""
+        channel_id = message.channel.id
+        if not self.tracks(channel_id):
+            return
+        buf = self._buffers.get(channel_id)
+        if buf is None:
+            buf = self._buffers[channel_id] = deque()
+            self._covered_after[channel_id] = message.id - 1
+        buf.append(record_from_message(message))
+        if len(buf) > self.per_channel:
+            self._evict(channel_id)
+        if message.guild:
+            guild_channels = self._guild_channels.setdefault(message.guild.id, set())
+            guild_channels.add(channel_id)
+            while sum(len(self._buffers[c]) for c in guild_channels) > self.per_guild:
+                self._evict(
+                    min(
+                        (c for c in guild_channels if self._buffers[c]),
+                        key=lambda c: self._buffers[c][0].id,
+                    )
+                )
+
+    def edit(self, channel_id: int, message_id: int, content: str):
+        """Update the content of a buffered message"""
+        buf = self._buffers.get(channel_id)
+        if not buf:
+            return
+        for i, record in enumerate(buf):
+            if record.id == message_id:
+                buf[i] = record._replace(content=content)
+                return
+
+    def delete(self, channel_id: int, message_id: int):
+        """Drop a deleted message from the buffer"""
+        buf = self._buffers.get(channel_id)
+        if not buf:
+            return
+        for record in buf:
+            if record.id == message_id:
+                buf.remove(record)
+                return
+
+    def _evict(self, channel_id: int):
+        evicted = self._buffers[channel_id].popleft()
+        self._covered_after[channel_id] = evicted.id
+
+    async def history(
+        self, channel, limit: int, after: Optional[int] = None
+    ) -> List[MessageRecord]:
+        """Return up to `limit` of the most recent messages in a channel in chronological order, from memory where
+        possible.
+        :param channel: The channel to read history from
+        :param limit: The maximum number of messages to return
+        :param after: If given, only messages newer than this message ID are returned
+        """
+        records = []
+        covered_after = self._covered_after.get(channel.id)
+        if covered_after is not None:
+            records = [
+                r for r in self._buffers[channel.id] if not after or r.id > after
+            ]
+            if len(records) >= limit or (after and after >= covered_after):
+                return records[-limit:]
+        missing = limit - len(records)
+        older = await channel.history(
+            limit=missing,
+            before=discord.Object(id=covered_after + 1) if covered_after else None,
+            after=discord.Object(id=after) if after else None,
+            oldest_first=False,
+        ).flatten()
+        older.reverse()
+        return [record_from_message(m) for m in older] + records
@@ -0,0 +1,140 @@
+"""Load test driver for the AI cog. Fires synthetic users at ChatGPT.on_message, backed by the mock vendor, and reports
+throughput, latency and token usage.
+
+    python -m util.loadtest --users 50 --messages 20 --concurrency 25
+
+The ChatGPT section of config.yml is used as the base configuration, with every server switched to the mock vendor.
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import statistics
+import time
+from types import SimpleNamespace
+from typing import List
+
+import util
+from util import mockllm
+from util.metrics import percentile
+
+_ids = itertools.count(1)
+
+
+class _Typing:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+
+    @staticmethod
+    def is_nsfw():
+        return False
+
+    @staticmethod
+    def typing():
+        return _Typing()
+
+    async def send(self, content, **kwargs):
+        pass
+
+
+class FakeMessage:
+    """Just enough of a discord.Message for the AI cog to handle it"""
+
+    def __init__(self, author, channel: FakeChannel, content: str):
+        self.id = next(_ids)
+        self.author = author
+        self.channel = channel
+        self.guild = None
+        self.content = content
+        self.reference = None
+        self.mention_everyone = False
+        self.created_at = None
+        self.replies: List[str] = []
+
+    @staticmethod
+    def is_system():
+        return False
+
+    async def reply(self, content, **kwargs):
+        self.replies.append(content)
+
+
+def make_bot(config: dict):
+    logger = logging.getLogger("loadtest")
+    user = SimpleNamespace(
+        id=0, mention="<@0>", display_name="Bot", mentioned_in=lambda m: True
+    )
+    return SimpleNamespace(config=config, logger=logger, user=user)
+
+
+async def run(users: int, messages: int, concurrency: int, ai_config: dict) -> dict:
+    from cogs.chatgpt import ChatGPT
+
+    for key, server_config in ai_config.items():
+        if key == "default" or isinstance(key, int):
+            server_config["vendor"] = "mock"
+    cog = ChatGPT(make_bot({"ChatGPT": ai_config}))
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    totals = {"prompt_tokens": 0, "completion_tokens": 0, "errors": 0}
+
+    async def user_session(n: int):
+        author = SimpleNamespace(
+            id=1000 + n, name=f"user{n}", display_name=f"User {n}", bot=False
+        )
+        channel = FakeChannel(n)
+        for i in range(messages):
+            message = FakeMessage(author, channel, f"Message {i} from user {n}")
+            async with semaphore:
+                started = time.perf_counter()
+                await cog.on_message(message)
+                latencies.append(time.perf_counter() - started)
+            gu = cog.users.get(author.id)
+            if gu and gu.last_completion:
+                totals["prompt_tokens"] += gu.last_completion.prompt_tokens
+                totals["completion_tokens"] += gu.last_completion.completion_tokens
+            if any("Sorry, can't talk" in r for r in message.replies):
+                totals["errors"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session(n) for n in range(users)))
+    elapsed = time.perf_counter() - started
+    return {
+        "messages": len(latencies),
+        "seconds": round(elapsed, 2),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        **totals,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--config", default="config.yml")
+    args = parser.parse_args()
+
+    ai_config = util.load_config(args.config)["ChatGPT"]
+    ai_config.setdefault("openai_api_key", "mock")
+    ai_config.setdefault("anthropic_api_key", "mock")
+    ai_config.pop("summary_channels", None)
+    mockllm.configure(**ai_config.pop("mock", {}))
+    report = asyncio.run(run(args.users, args.messages, args.concurrency, ai_config))
+    for k, v in report.items():
+        print(f"{k}: {v}")
+
+
+if __name__ == "__main__":
+    main()
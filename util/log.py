@@ -1,23 +1,193 @@
+import contextlib
+import contextvars
+import copy
+import json
 import logging
 import logging.handlers
+import queue
+import random
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# What the code logging right now is working on: the cog, guild and command. Set by the bot around every event
+# listener and application command, so cogs get this for free.
+CONTEXT_FIELDS = ("cog", "guild", "command")
+_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default={})
+
+# Every logger hands its records to this one queue, and a single writer thread drains it
+records: queue.SimpleQueue = queue.SimpleQueue()
+listener: Optional[logging.handlers.QueueListener] = None
+
+
+@contextlib.contextmanager
+def bound(**values):
+    """Attach context to everything logged inside the block"""
+    token = _context.set(
+        {**_context.get(), **{k: v for k, v in values.items() if v is not None}}
+    )
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def current() -> dict:
+    """The context bound right now"""
+    return dict(_context.get())
+
+
+class ContextFilter(logging.Filter):
+    """Copies the current context onto each record, in the thread that logged it"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _context.get()
+        for field in CONTEXT_FIELDS:
+            setattr(record, field, context.get(field))
+        record.context = (
+            " [" + " ".join(f"{k}={v}" for k, v in context.items()) + "]"
+            if context
+            else ""
+        )
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Thins out chatty messages at or below `level`: a `sample` fraction of them is kept, then each call site of each
+    logger gets a token bucket of `burst` messages, refilled at `rate` per second. The number of messages dropped
+    since the last one that got through is noted on that one.
+    """
+
+    def __init__(
+        self,
+        rate: float = 10,
+        burst: int = 100,
+        sample: float = 1.0,
+        level: str = "DEBUG",
+    ):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.level = logging.getLevelName(level)
+        self._buckets: Dict[Tuple[str, str, int], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.level:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                # tokens, last refill, suppressed
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1 or (self.sample < 1 and random.random() >= self.sample):
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hands records over to the writer thread. Only the message itself is rendered here, since its arguments may
+    change once the logging code yields; timestamps, formatting and the write all happen on the writer thread, with
+    this handler's formatter.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.formatter = self.formatter
+        record.msg = record.getMessage()
+        record.args = None
+        if getattr(record, "suppressed", 0):
+            record.msg += f" ({record.suppressed} similar messages suppressed)"
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class StreamWriter(logging.StreamHandler):
+    """Writes records on the writer thread, each formatted the way the logger that queued it asked for"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        formatter = getattr(record, "formatter", None) or self.formatter
+        return formatter.format(record) if formatter else super().format(record)
 
 
 # Copied from https://stackoverflow.com/questions/37958568/how-to-implement-a-global-python-logger
-def init_logger(name, level: str):
+def init_logger(
+    name,
+    level: str,
+    log_format: str = "text",
+    rate_limit: Optional[dict] = None,
+):
+    """Set up a logger whose records are written by a background thread, so logging never blocks the event loop
+    :param log_format: "text", or "json" for one JSON object per line
+    :param rate_limit: Options for a `RateLimitFilter`, if chatty messages should be thinned out
+    """
+    global listener
     # logger settings
-    if logging.getLevelName(level) is logging.DEBUG:
-        log_format = "%(asctime)s [%(levelname)s] %(filename)s(%(funcName)s:%(lineno)s): %(message)s"
+    if log_format == "json":
+        formatter = JsonFormatter()
+    elif logging.getLevelName(level) is logging.DEBUG:
+        formatter = logging.Formatter(
+            "%(asctime)s [%(levelname)s] %(filename)s(%(funcName)s:%(lineno)s)%(context)s: %(message)s"
+        )
     else:
-        log_format = "%(asctime)s [%(levelname)s] %(module)s: %(message)s"
-    formatter = logging.Formatter(log_format)
+        formatter = logging.Formatter(
+            "%(asctime)s [%(levelname)s] %(module)s%(context)s: %(message)s"
+        )
 
     # setup logger
     logger = logging.getLogger(name)
-    logger.level = logging.getLevelName(level)
+    logger.setLevel(level)
 
-    streamhandler = logging.StreamHandler()
-    streamhandler.setFormatter(formatter)
+    queuehandler = QueueHandler(records)
+    queuehandler.setFormatter(formatter)
+    if rate_limit is not None:
+        queuehandler.addFilter(RateLimitFilter(**rate_limit))
+    queuehandler.addFilter(ContextFilter())
+    logger.addHandler(queuehandler)
 
-    logger.addHandler(streamhandler)
+    if listener is None:
+        listener = logging.handlers.QueueListener(records, StreamWriter())
+        listener.start()
 
     return logger
+
+
+def stop():
+    """Write out whatever is still queued and stop the writer thread. The next init_logger starts it again."""
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
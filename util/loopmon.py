@@ -0,0 +1,153 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque, namedtuple
+from typing import Deque, Dict, Optional
+
+from util.metrics import percentile
+
+# A stretch of time the event loop spent running one callback without yielding. location is the cog (or other
+# project) code that was running when the watchdog noticed, and event is the Discord event being dispatched, if any.
+Stall = namedtuple("Stall", ["started", "duration", "location", "event", "stack"])
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COGS = os.path.join(ROOT, "cogs")
+
+
+def attribute(frame) -> (str, Optional[str]):
+    """Find the code to blame for a blocked loop in a stack, preferring cogs over the rest of the project
+    :return: The location ("cogs/foo.py:function:line") and the Discord event being dispatched, if any
+    """
+    event = None
+    location = None
+    fallback = None
+    for frame, lineno in traceback.walk_stack(frame):
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if frame.f_code.co_name == "_run_event" and not event:
+            event = frame.f_locals.get("event_name")
+        where = f"{os.path.relpath(filename, ROOT)}:{frame.f_code.co_name}:{lineno}"
+        if not location and filename.startswith(COGS):
+            location = where
+        if not fallback and filename.startswith(ROOT):
+            fallback = where
+    return location or fallback or "unknown", event
+
+
+class LoopMonitor:
+    """Measures event loop lag with a heartbeat task, and watches for callbacks that block the loop from a separate
+    thread. When the heartbeat is late by more than `threshold` seconds, the watchdog grabs the loop thread's stack to
+    find out which cog is to blame; the finished stall is logged, kept for the diagnostics command and, if Sentry is
+    set up, reported there (at most once per location every `report_interval` seconds).
+    """
+
+    def __init__(
+        self,
+        logger,
+        sentry=None,
+        interval: float = 0.5,
+        threshold: float = 0.5,
+        report_interval: float = 600,
+        history: int = 50,
+    ):
+        """
+        :param interval: How often the heartbeat runs, in seconds
+        :param threshold: How long a callback may block the loop before it counts as a stall, in seconds
+        :param report_interval: The shortest time between two Sentry reports for the same location, in seconds
+        :param history: How many stalls are kept for the diagnostics command
+        """
+        self.logger = logger
+        self.sentry = sentry
+        self.interval = interval
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self.lag: Deque[float] = deque(maxlen=1200)
+        self.stalls: Deque[Stall] = deque(maxlen=history)
+        self._reported: Dict[str, float] = {}
+        self._beat = time.monotonic()
+        self._current: Optional[Stall] = None
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Start monitoring the running event loop"""
+        if self.running:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(
+            target=self._watchdog, name="loop-watchdog", daemon=True
+        ).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.lag.append(max(0.0, now - expected))
+            self._beat = now
+            if self._current:
+                self._finish_stall()
+
+    def _watchdog(self):
+        while not self._stop.wait(self.interval / 2):
+            blocked = time.monotonic() - self._beat - self.interval
+            if blocked < self.threshold or self._current:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            location, event = attribute(frame)
+            self._current = Stall(
+                time.time() - blocked,
+                blocked,
+                location,
+                event,
+                "".join(traceback.format_stack(frame)),
+            )
+
+    def _finish_stall(self):
+        stall = self._current._replace(duration=time.time() - self._current.started)
+        self._current = None
+        self.stalls.append(stall)
+        self.logger.warning(
+            f"Event loop blocked for {stall.duration:.2f}s by {stall.location}"
+            + (f" while handling {stall.event}" if stall.event else "")
+        )
+        last = self._reported.get(stall.location)
+        if self.sentry and (
+            last is None or time.monotonic() - last > self.report_interval
+        ):
+            self._reported[stall.location] = time.monotonic()
+            with self.sentry.push_scope() as scope:
+                scope.set_tag("blocked_location", stall.location)
+                scope.set_tag("bot_event", stall.event)
+                scope.set_extra("stack", stall.stack)
+                scope.set_extra("duration", stall.duration)
+                self.sentry.capture_message(
+                    f"Event loop blocked for {stall.duration:.2f}s by {stall.location}",
+                    level="warning",
+                )
+
+    def stats(self) -> dict:
+        """Lag percentiles over the recent heartbeats, in milliseconds"""
+        return {
+            "lag_p50_ms": round(percentile(self.lag, 50) * 1000, 1),
+            "lag_p99_ms": round(percentile(self.lag, 99) * 1000, 1),
+            "lag_max_ms": round(max(self.lag, default=0) * 1000, 1),
+            "stalls": len(self.stalls),
+        }
@@ -0,0 +1,346 @@
+"""Process metrics in the Prometheus text format, served over HTTP along with a liveness probe.
+
+Metrics are module-level objects, so any cog can record to them without a reference to the bot:
+
+    from util import metrics
+    metrics.LLM_TOKENS.inc(120, model="gpt-4", kind="prompt")
+
+Gauges that are cheaper to compute on demand take a callback instead, see `Registry.gauge`.
+"""
+
+import bisect
+import math
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from aiohttp import TraceConfig, web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def percentile(samples, pct: float) -> float:
+    """The nearest-rank percentile of some samples, or 0 if there are none"""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def _key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """The metric's sample lines in the text format"""
+
+    def render(self) -> str:
+        return (
+            f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+            + "".join(line + "\n" for line in self.samples())
+        )
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[self._key(labels)] += amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in self.values.items()
+        ]
+
+
+class Gauge(Metric):
+    """A value that goes up and down. Either set it, or give a callback that returns the value (or a dict of label
+    value tuples to values) whenever metrics are collected."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        callback: Optional[Callable[[], Union[float, dict]]] = None,
+    ):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        values = self.values
+        if self.callback:
+            result = self.callback()
+            values = result if isinstance(result, dict) else {(): result}
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in values.items()
+            if value is not None
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: a count per bucket (plus one for +Inf), the sum and the total count
+        self.values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        counts[0][bisect.bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+        counts[2] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (buckets, total, count) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), buckets):
+                cumulative += n
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}"
+                )
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric, replacing any earlier one with the same name (such as one from before a cog reload)"""
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels=()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, callback=None, labels=()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels, callback))
+
+    def histogram(
+        self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        out = []
+        for metric in list(self.metrics.values()):
+            try:
+                out.append(metric.render())
+            except Exception:
+                # A broken gauge callback shouldn't take every other metric down with it
+                continue
+        return "".join(out)
+
+
+registry = Registry()
+
+EVENTS = registry.histogram(
+    "pixlbot_event_duration_seconds",
+    "Time spent in each event listener",
+    ["event", "listener"],
+)
+COMMANDS = registry.histogram(
+    "pixlbot_command_duration_seconds",
+    "Time spent running each application command",
+    ["command", "status"],
+)
+LLM_REQUESTS = registry.histogram(
+    "pixlbot_llm_request_duration_seconds",
+    "Latency of requests to AI models",
+    ["model", "command", "status"],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120),
+)
+LLM_TOKENS = registry.counter(
+    "pixlbot_llm_tokens_total",
+    "Tokens sent to and received from AI models",
+    ["model", "kind"],
+)
+HTTP_REQUESTS = registry.histogram(
+    "pixlbot_http_request_duration_seconds",
+    "Outbound HTTP requests, by target (the Discord API route or the calling cog)",
+    ["target", "method", "status"],
+)
+
+WORKER_WAIT = registry.histogram(
+    "pixlbot_worker_wait_seconds",
+    "Time jobs spent queued for a worker process",
+    ["function"],
+)
+WORKER_DURATION = registry.histogram(
+    "pixlbot_worker_duration_seconds",
+    "Time from handing a job to the worker pool to getting its result",
+    ["function", "status"],
+)
+SHARD_EVENTS = registry.counter(
+    "pixlbot_shard_events_total",
+    "Events dispatched, by the shard they came in on (sharded mode only)",
+    ["shard"],
+)
+ERRORS = registry.counter(
+    "pixlbot_errors_total",
+    "Unhandled exceptions in event listeners, by event",
+    ["event"],
+)
+
+
+def route_template(path: str) -> str:
+    """A request path with its IDs, tokens and emoji taken out, so a route gets one label rather than one per object"""
+    parts = path.split("/")
+    for i, part in enumerate(parts):
+        if part.isdigit():
+            parts[i] = "{id}"
+        elif i and parts[i - 1] == "reactions":
+            parts[i] = "{emoji}"
+        elif len(part) > 32:
+            # Webhook and interaction tokens
+            parts[i] = "{token}"
+    return "/".join(parts)
+
+
+def trace_config(target: str, by_route: bool = False) -> TraceConfig:
+    """Times the requests of an aiohttp ClientSession: pass it in `trace_configs`
+    :param target: What the requests are labelled with, such as the name of the cog making them
+    :param by_route: Add the route template of each request to its label
+    """
+
+    def label(params) -> str:
+        return f"{target}:{route_template(params.url.path)}" if by_route else target
+
+    async def on_request_start(session, context, params):
+        context.started = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        HTTP_REQUESTS.observe(
+            time.perf_counter() - context.started,
+            target=label(params),
+            method=params.method,
+            status="ok" if params.response.ok else "error",
+        )
+
+    async def on_request_exception(session, context, params):
+        HTTP_REQUESTS.observe(
+            time.perf_counter() - context.started,
+            target=label(params),
+            method=params.method,
+            status="error",
+        )
+
+    trace = TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_exception)
+    return trace
+
+
+def observe_response(target: str, response):
+    """Record a finished `requests` response"""
+    HTTP_REQUESTS.observe(
+        response.elapsed.total_seconds(),
+        target=target,
+        method=response.request.method,
+        status="ok" if response.ok else "error",
+    )
+
+
+class MetricsServer:
+    """Serves /metrics for Prometheus and /healthz for container liveness checks"""
+
+    def __init__(self, bot, host: str = "127.0.0.1", port: int = 9100):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.started = time.time()
+        self._runner: Optional[web.AppRunner] = None
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics)
+        app.router.add_get("/healthz", self.healthz)
+        self.app = app
+
+    async def start(self):
+        if self._runner:
+            return
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.bot.logger.info(
+            f"Serving metrics on http://{self.host}:{self.port}/metrics"
+        )
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=registry.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        # Answering at all proves the event loop is running; the gateway connection has to be up too
+        healthy = not self.bot.is_closed() and self.bot.is_ready()
+        return web.json_response(
+            {
+                "healthy": healthy,
+                "uptime": round(time.time() - self.started),
+                "latency": None if math.isinf(self.bot.latency) else self.bot.latency,
+            },
+            status=200 if healthy else 503,
+        )
@@ -0,0 +1,183 @@
+"""An offline stand-in for the LLM vendors, for load testing the AI cog without spending money or touching the network.
+
+Set a server's `vendor` to `mock` in the ChatGPT config, and configure the mock itself with a `mock` section:
+
+    ChatGPT:
+      mock:
+        latency: {distribution: lognormal, median: 0.8, sigma: 0.4}  # seconds until the first token
+        tokens_per_second: 60
+        reply_tokens: 80
+        errors: {429: 0.01, 500: 0.005, timeout: 0.001}  # probability of each failure per request
+        cassette: db/cassette.jsonl
+        mode: replay  # or record, which sends requests to `upstream` and saves the exchanges
+        upstream: openai
+"""
+
+import asyncio
+import json
+import random
+import time
+from hashlib import sha256
+from typing import Dict, List, Optional
+
+from util.chatgpt import Completion, ConversationLine, Model
+
+
+class MockAPIError(Exception):
+    """Raised for injected vendor errors, carrying the HTTP status a real vendor would have returned"""
+
+    def __init__(self, status: int):
+        self.status = status
+        super().__init__(f"Mock vendor returned HTTP {status}")
+
+
+def estimate_tokens(text: str) -> int:
+    """A rough token count (about four characters per token) that doesn't need a tokenizer"""
+    return max(1, len(text) // 4)
+
+
+def exchange_key(model: Model, conversation: List[ConversationLine]) -> str:
+    payload = json.dumps([model.model, model.temperature, conversation])
+    return sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """Recorded model exchanges, stored one JSON object per line"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.exchanges: Dict[str, Completion] = {}
+        try:
+            with open(path) as file:
+                for line in file:
+                    entry = json.loads(line)
+                    key = entry.pop("key")
+                    self.exchanges[key] = Completion(**entry)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[Completion]:
+        return self.exchanges.get(key)
+
+    def record(self, key: str, completion: Completion):
+        self.exchanges[key] = completion
+        with open(self.path, "a") as file:
+            file.write(json.dumps({"key": key, **completion._asdict()}) + "\n")
+
+
+class MockVendor:
+    def __init__(
+        self,
+        latency: dict = None,
+        tokens_per_second: float = 60,
+        reply_tokens: int = 80,
+        errors: dict = None,
+        timeout: float = 30,
+        cassette: str = None,
+        mode: str = "replay",
+        upstream: str = "openai",
+    ):
+        """
+        :param latency: The delay before the first token: {"distribution": "fixed", "seconds": 0.5},
+         {"distribution": "uniform", "min": 0.2, "max": 1.5} or {"distribution": "lognormal", "median": 0.8,
+         "sigma": 0.4}
+        :param tokens_per_second: How fast the reply is generated after the first token
+        :param reply_tokens: The length of generated replies, for requests not found in the cassette
+        :param errors: The probability of each injected failure per request, keyed by HTTP status or "timeout"
+        :param timeout: How long an injected timeout hangs before raising
+        :param cassette: Path of a cassette file to replay exchanges from (or record them to)
+        :param mode: "replay" to answer from the cassette when possible, "record" to send requests to the upstream
+         vendor and save them to the cassette
+        :param upstream: The real vendor used in record mode
+        """
+        self.latency = latency or {"distribution": "fixed", "seconds": 0}
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.errors = errors or {}
+        self.timeout = timeout
+        self.cassette = Cassette(cassette) if cassette else None
+        self.mode = mode
+        self.upstream = upstream
+
+    def _first_token_delay(self) -> float:
+        kind = self.latency.get("distribution", "fixed")
+        if kind == "uniform":
+            return random.uniform(self.latency["min"], self.latency["max"])
+        elif kind == "lognormal":
+            sigma = self.latency.get("sigma", 0.5)
+            return self.latency["median"] * random.lognormvariate(0, sigma)
+        return self.latency.get("seconds", 0)
+
+    async def _inject_errors(self):
+        for kind, probability in self.errors.items():
+            if random.random() < probability:
+                if kind == "timeout":
+                    await asyncio.sleep(self.timeout)
+                    raise asyncio.TimeoutError("Mock vendor timed out")
+                raise MockAPIError(int(kind))
+
+    def _generate(
+        self, conversation: List[ConversationLine], max_tokens: Optional[int] = None
+    ) -> str:
+        last = next(
+            (l["content"] for l in reversed(conversation) if l["role"] == "user"), ""
+        )
+        reply_tokens = min(self.reply_tokens, max_tokens or self.reply_tokens)
+        words = " ".join(["lorem"] * max(0, reply_tokens - 8))
+        text = f"Mock reply to: {last[:40]} {words}".strip()
+        if any("<root>" in l["content"] for l in conversation if l["role"] == "system"):
+            # Soul cores expect their introspection format back
+            text = (
+                f"<root><FEELING>I feel fine</FEELING><THOUGHT>I want to reply</THOUGHT>"
+                f"<MESSAGE>{text}</MESSAGE><ANALYSIS>I think this is a test</ANALYSIS></root>"
+            )
+        return text
+
+    async def complete(
+        self,
+        model: Model,
+        conversation: List[ConversationLine],
+        max_tokens: Optional[int] = None,
+    ) -> Completion:
+        key = exchange_key(model, conversation)
+        if self.mode == "record":
+            upstream = Model(
+                model.model,
+                max_tokens=model.max_tokens,
+                temperature=model.temperature,
+                max_context=model.max_context,
+                vendor=self.upstream,
+                prompt_caching=model.prompt_caching,
+                encoding=model.encoding,
+            )
+            completion = await upstream.complete(conversation, max_tokens)
+            if self.cassette and completion:
+                self.cassette.record(key, completion)
+            return completion
+
+        started = time.monotonic()
+        await self._inject_errors()
+        completion = self.cassette.get(key) if self.cassette else None
+        if not completion:
+            text = self._generate(conversation, max_tokens)
+            completion = Completion(
+                text,
+                sum(estimate_tokens(l["content"]) for l in conversation),
+                estimate_tokens(text),
+                0,
+            )
+        duration = (
+            self._first_token_delay()
+            + completion.completion_tokens / self.tokens_per_second
+        )
+        await asyncio.sleep(max(0.0, duration - (time.monotonic() - started)))
+        return completion
+
+
+vendor = MockVendor()
+
+
+def configure(**kwargs):
+    """Replace the mock vendor's settings"""
+    global vendor
+    vendor = MockVendor(**kwargs)
@@ -0,0 +1,156 @@
+import time
+from collections import deque
+from enum import Enum
+from typing import Deque, Dict, List, Optional
+
+from blitzdb import Document
+
+HOUR = 3600
+WINDOWS = {"daily": 24, "monthly": 30 * 24}  # in hours
+
+
+class QuotaWindow(Document):
+    """Hourly token counts for one guild or user, covering the longest quota window"""
+
+    class Meta(Document.Meta):
+        primary_key = "key"
+
+
+class QuotaVerdict(Enum):
+    OK = "ok"
+    # Over quota, but may go ahead with a cheaper model and less context
+    DEGRADE = "degrade"
+    REFUSE = "refuse"
+
+
+class QuotaTracker:
+    """Sliding-window daily and monthly token quotas per guild and per user, configured in the `quotas` section of the
+    ChatGPT config:
+
+        quotas:
+          guild: {daily: 500000, monthly: 10000000}
+          user: {daily: 50000, monthly: 1000000}
+          guilds: {1234: {daily: 1000000}}  # per-guild overrides of the guild limits
+          grace: 0.2  # over-quota requests are degraded until usage is this much past the limit, then refused
+          degrade: {model_name: gpt-3.5-turbo, max_context: 4096}  # without this, over-quota requests are refused
+
+    Usage is counted in hourly buckets kept in memory, and written to storage by `checkpoint`.
+    """
+
+    def __init__(self, config: dict, backend=None):
+        """
+        :param backend: Where to restore the counters from once quotas are enabled, whether now or by a later
+         `configure`
+        """
+        self.buckets: Dict[str, Deque[List[int]]] = {}
+        self._dirty = set()
+        self.backend = backend
+        self._loaded = False
+        self.configure(config)
+
+    def configure(self, config: dict):
+        """Apply new limits, keeping the usage counted so far"""
+        self.limits = {
+            "guild": config.get("guild", {}),
+            "user": config.get("user", {}),
+        }
+        self.guild_overrides = config.get("guilds", {})
+        self.grace = config.get("grace", 0.2)
+        self.can_degrade = "degrade" in config
+        # Nothing is counted while quotas are off, so the stored counters only need restoring the first time
+        if self.enabled and self.backend is not None and not self._loaded:
+            self.load(self.backend)
+
+    @property
+    def enabled(self) -> bool:
+        return any(self.limits.values()) or bool(self.guild_overrides)
+
+    def _expire(self, key: str, now: float) -> Deque[List[int]]:
+        buckets = self.buckets.setdefault(key, deque())
+        oldest = int(now // HOUR) - WINDOWS["monthly"] + 1
+        while buckets and buckets[0][0] < oldest:
+            buckets.popleft()
+        return buckets
+
+    def used(self, key: str, window: str, now: Optional[float] = None) -> int:
+        """Tokens spent by a guild or user ("guild:<id>" or "user:<id>") within the last day or month"""
+        now = now or time.time()
+        start = int(now // HOUR) - WINDOWS[window] + 1
+        return sum(t for hour, t in self._expire(key, now) if hour >= start)
+
+    def _scopes(self, guild_id: Optional[int], user_id: Optional[int]):
+        if guild_id:
+            limits = {**self.limits["guild"], **self.guild_overrides.get(guild_id, {})}
+            yield f"guild:{guild_id}", limits
+        if user_id:
+            yield f"user:{user_id}", self.limits["user"]
+
+    def check(
+        self,
+        guild_id: Optional[int],
+        user_id: Optional[int],
+        tokens: int,
+        now: Optional[float] = None,
+    ) -> QuotaVerdict:
+        """Decide whether a request of about `tokens` tokens may be sent"""
+        verdict = QuotaVerdict.OK
+        for key, limits in self._scopes(guild_id, user_id):
+            for window, limit in limits.items():
+                if window not in WINDOWS:
+                    continue
+                used = self.used(key, window, now) + tokens
+                if used <= limit:
+                    continue
+                if not self.can_degrade or used > limit * (1 + self.grace):
+                    return QuotaVerdict.REFUSE
+                verdict = QuotaVerdict.DEGRADE
+        return verdict
+
+    def spend(
+        self,
+        guild_id: Optional[int],
+        user_id: Optional[int],
+        tokens: int,
+        now: Optional[float] = None,
+    ):
+        now = now or time.time()
+        hour = int(now // HOUR)
+        for key, _ in self._scopes(guild_id, user_id):
+            buckets = self._expire(key, now)
+            if buckets and buckets[-1][0] == hour:
+                buckets[-1][1] += tokens
+            else:
+                buckets.append([hour, tokens])
+            self._dirty.add(key)
+
+    def load(self, backend):
+        """Restore the counters saved by an earlier checkpoint"""
+        for window in backend.filter(QuotaWindow, {}):
+            self.buckets[window.key] = deque(window.buckets)
+        self._loaded = True
+
+    def take_changed(self) -> List[QuotaWindow]:
+        """Take copies of the counters that changed since the last call, to be written with `save`. Call this on the
+        event loop, so nothing is spent while they're being copied."""
+        dirty, self._dirty = self._dirty, set()
+        return [
+            QuotaWindow(
+                {"key": key, "buckets": [list(b) for b in self.buckets.get(key, [])]}
+            )
+            for key in dirty
+        ]
+
+    @staticmethod
+    def save(backend, windows: List[QuotaWindow]) -> int:
+        """Write counters taken with `take_changed`. This blocks on the database, so run it in a thread.
+        :return: The number of counters written
+        """
+        for window in windows:
+            backend.save(window)
+        return len(windows)
+
+    def checkpoint(self, backend) -> int:
+        """Save the counters that changed since the last checkpoint, right away
+        :return: The number of counters written
+        """
+        return self.save(backend, self.take_changed())
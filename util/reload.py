@@ -0,0 +1,253 @@
+"""Hot reload of the config file and of individual cogs, without reconnecting.
+
+A cog takes part through three optional hooks:
+
+    def apply_config(self, config) -> bool:
+        # Take on a new config section in place. Returning False means the cog has to be reloaded instead.
+    def export_state(self) -> dict:
+        # Whatever should survive a reload, such as sessions held in memory...
+    def import_state(self, state: dict):
+        # ...which the new instance of the cog is handed here.
+
+A cog's config section is the one named after it, or failing that the one its `config` attribute refers to. Cogs
+without `apply_config` are reloaded whenever their section changes, and every cog is reloaded when its code changes.
+"""
+
+import asyncio
+import importlib.util
+import os
+from collections import namedtuple
+from typing import Dict, Optional
+
+from util import cachepolicy, commandsync, load_config, sharding
+
+# What a reload did: the cogs that took on new config in place, the extensions that were reloaded, loaded and
+# unloaded, and the ones that failed with why
+ReloadResult = namedtuple(
+    "ReloadResult", ["applied", "reloaded", "loaded", "unloaded", "failed", "warnings"]
+)
+
+REQUIRED_SYSTEM_KEYS = ("bot_token", "command_prefix", "log_level", "plugins")
+# Settings that only take effect on a restart
+RESTART_SYSTEM_KEYS = (
+    "bot_token",
+    "command_prefix",
+    "guilds",
+    "max_messages",
+    "metrics",
+    "sharding",
+    "workers",
+)
+
+
+def validate_config(config):
+    """Check a freshly read config before anything uses it
+    :raises ValueError: If the config can't be used
+    """
+    if not isinstance(config, dict) or not isinstance(config.get("system"), dict):
+        raise ValueError("The config has no system section")
+    missing = [key for key in REQUIRED_SYSTEM_KEYS if key not in config["system"]]
+    if missing:
+        raise ValueError(f"The system section is missing {', '.join(missing)}")
+    if not isinstance(config["system"]["plugins"], list):
+        raise ValueError("system.plugins must be a list")
+    for plugin in config["system"]["plugins"]:
+        try:
+            spec = importlib.util.find_spec(plugin)
+        except ImportError:
+            spec = None
+        if spec is None:
+            raise ValueError(f"Plugin {plugin} does not exist")
+    if config["system"].get("sharding"):
+        sharding.validate(config["system"]["sharding"])
+
+
+def _mtime(module) -> Optional[float]:
+    path = getattr(module, "__file__", None)
+    try:
+        return os.stat(path).st_mtime if path else None
+    except OSError:
+        return None
+
+
+class Reloader:
+    """Re-reads the config file and reloads what changed, on request or, with `watch`, when files change"""
+
+    def __init__(self, bot, path: str = "config.yml", interval: float = 5):
+        """
+        :param path: The config file
+        :param interval: How often the watcher checks for changes, in seconds
+        """
+        self.bot = bot
+        self.path = path
+        self.interval = interval
+        self.mtimes: Dict[str, Optional[float]] = {}
+        self.config_mtime = self._config_mtime()
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _config_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def snapshot(self):
+        """Remember the code of the loaded extensions as it is now"""
+        self.mtimes = {
+            name: _mtime(module) for name, module in self.bot.extensions.items()
+        }
+
+    def section_for(self, cog, config: dict) -> Optional[str]:
+        if cog.qualified_name in config:
+            return cog.qualified_name
+        current = getattr(cog, "config", None)
+        for section, value in config.items():
+            if current is not None and value is current:
+                return section
+        return None
+
+    def cogs_of(self, extension: str) -> list:
+        return [cog for cog in self.bot.cogs.values() if cog.__module__ == extension]
+
+    async def reload(self, config: Optional[dict] = None) -> ReloadResult:
+        """Read and validate the config file, hand the new config to the cogs, and reload the cogs whose config or
+        code changed. Nothing is changed if the config is invalid.
+        :param config: The config to apply, instead of reading the config file
+        :raises ValueError: If the config is invalid
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if config is None:
+                config = await asyncio.to_thread(load_config, self.path)
+            validate_config(config)
+            self.config_mtime = self._config_mtime()
+            old = self.bot.config
+            warnings = [
+                f"system.{key} changes on the next restart"
+                for key in RESTART_SYSTEM_KEYS
+                if old["system"].get(key) != config["system"].get(key)
+            ]
+            result = ReloadResult([], [], [], [], {}, warnings)
+
+            # Decide what to do while the cogs are still paired with the config they were created with
+            to_reload = []
+            for extension, module in list(self.bot.extensions.items()):
+                if extension not in config["system"]["plugins"]:
+                    continue
+                if self.mtimes.get(extension) != _mtime(module):
+                    to_reload.append(extension)
+                    continue
+                for cog in self.cogs_of(extension):
+                    section = self.section_for(cog, old)
+                    if section is None or old.get(section) == config.get(section):
+                        continue
+                    apply = getattr(cog, "apply_config", None)
+                    if apply and apply(config.get(section)):
+                        result.applied.append(cog.qualified_name)
+                    else:
+                        to_reload.append(extension)
+                        break
+
+            self.bot.config = config
+            self.bot.logger.setLevel(config["system"]["log_level"])
+            for extension in list(self.bot.extensions):
+                if extension not in config["system"]["plugins"]:
+                    await self._run(result, extension, result.unloaded, unload=True)
+            for extension in to_reload:
+                await self._run(result, extension, result.reloaded)
+            for extension in config["system"]["plugins"]:
+                if extension not in self.bot.extensions:
+                    await self._run(result, extension, result.loaded, load=True)
+            self.snapshot()
+            # Intents are sent when connecting, so cogs that need new ones have to wait for a restart
+            for intent, cogs in cachepolicy.missing_intents(self.bot).items():
+                result.warnings.append(
+                    f"{', '.join(cogs)} needs the {intent} intent, enabled on the next restart"
+                )
+            if self.bot.is_ready():
+                if result.reloaded or result.loaded or result.unloaded:
+                    # Only guilds whose commands actually changed are synced
+                    await commandsync.sync_changed(self.bot, self.bot.backend)
+                await cachepolicy.chunk_required(self.bot)
+            return result
+
+    async def _run(
+        self, result: ReloadResult, extension: str, done: list, load=False, unload=False
+    ):
+        states = {}
+        try:
+            if unload:
+                self.bot.unload_extension(extension)
+            elif load:
+                self.bot.load_extension(extension)
+            else:
+                for cog in self.cogs_of(extension):
+                    if hasattr(cog, "export_state"):
+                        states[cog.qualified_name] = cog.export_state()
+                self.bot.reload_extension(extension)
+        except Exception as e:
+            # A failed reload rolls back to the old code, which still gets its state back below
+            self.bot.logger.error(f"Could not reload {extension}: {e}")
+            result.failed[extension] = str(e)
+        else:
+            done.append(extension)
+        if unload:
+            return
+        for cog in self.cogs_of(extension):
+            if cog.qualified_name in states and hasattr(cog, "import_state"):
+                cog.import_state(states[cog.qualified_name])
+            if self.bot.is_ready():
+                # The ready event has been and gone, so run the cog's own handler for it
+                for name, listener in cog.get_listeners():
+                    if name == "on_ready":
+                        await listener()
+
+    def changed(self) -> bool:
+        """Whether the config file or the code of a loaded extension changed since the last reload"""
+        if self._config_mtime() != self.config_mtime:
+            return True
+        return any(
+            self.mtimes.get(name) != _mtime(module)
+            for name, module in self.bot.extensions.items()
+        )
+
+    def watch(self):
+        """Start reloading automatically when files change"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.changed():
+                continue
+            try:
+                result = await self.reload()
+            except Exception as e:
+                # Keep running the old config until the file is fixed
+                self.config_mtime = self._config_mtime()
+                self.bot.logger.error(f"Not reloading, the config is invalid: {e}")
+                continue
+            self.bot.logger.warning(f"Reloaded after a file changed: {summary(result)}")
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+
+def summary(result: ReloadResult) -> str:
+    parts = []
+    for label, items in (
+        ("config applied to", result.applied),
+        ("reloaded", result.reloaded),
+        ("loaded", result.loaded),
+        ("unloaded", result.unloaded),
+    ):
+        if items:
+            parts.append(f"{label} {', '.join(items)}")
+    for extension, error in result.failed.items():
+        parts.append(f"{extension} failed: {error}")
+    parts.extend(result.warnings)
+    return "; ".join(parts) or "nothing changed"
@@ -0,0 +1,67 @@
+from copy import deepcopy
+from typing import Dict, Optional, Type
+
+from blitzdb import Document
+
+
+class SettingsCache:
+    """An in-memory cache of per-user settings documents stored in a blitzdb backend. Reads are served from memory
+    after the first lookup, and documents are only written back when a value actually changes.
+    """
+
+    def __init__(
+        self, backend, document: Type[Document], key: str, defaults: dict = None
+    ):
+        """
+        :param backend: The blitzdb backend the documents are stored in
+        :param document: The document class holding the settings
+        :param key: The document field holding the user ID
+        :param defaults: Values for users who don't have a stored document yet
+        """
+        self.backend = backend
+        self.document = document
+        self.key = key
+        self.defaults = defaults or {}
+        # None marks a user known to have no stored document
+        self._docs: Dict[int, Optional[Document]] = {}
+        self._preloaded = False
+
+    def preload(self) -> int:
+        """Load every stored document in one go, so later lookups never touch the backend.
+        :return: The number of documents loaded
+        """
+        self._docs = {
+            doc[self.key]: doc for doc in self.backend.filter(self.document, {})
+        }
+        self._preloaded = True
+        return len(self._docs)
+
+    def find(self, uid: int) -> Optional[Document]:
+        """Returns the stored settings of a user, or None if they don't have any"""
+        if uid not in self._docs:
+            if self._preloaded:
+                return None
+            try:
+                self._docs[uid] = self.backend.get(self.document, {self.key: uid})
+            except self.document.DoesNotExist:
+                self._docs[uid] = None
+        return self._docs[uid]
+
+    def get(self, uid: int) -> Document:
+        """Returns the settings of a user, falling back to the defaults if they don't have any stored. The returned
+        document must be treated as read-only; use `update` to change it."""
+        doc = self.find(uid)
+        if doc is None:
+            doc = self.document({self.key: uid, **deepcopy(self.defaults)})
+        return doc
+
+    def update(self, uid: int, **values) -> Document:
+        """Change some of a user's settings, saving them only if something is different from what we already have"""
+        doc = self.get(uid)
+        if all(doc.get(k) == v for k, v in values.items()):
+            return doc
+        for k, v in values.items():
+            doc[k] = v
+        self.backend.save(doc)
+        self._docs[uid] = doc
+        return doc
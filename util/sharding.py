@@ -0,0 +1,71 @@
+"""Running the bot as several shards in one process.
+
+Sharding is turned on by a `sharding` section under `system`:
+
+    sharding:
+      shard_count: 8      # Shards across all hosts. Omit to use the count Discord recommends.
+      shard_ids: [0, 1]   # The shards this host runs; all of them if omitted
+
+All of a host's shards share one bot, with its cache, event loop and db folder. Splitting them over several processes
+isn't supported: blitzdb keeps its indexes in memory, so processes sharing the db folder would overwrite each other's
+writes. Background tasks (reminders, polling, presence) only run on the host that has shard 0, see
+`runs_background_tasks`.
+"""
+
+from typing import List, Optional
+
+# Discord sends direct messages to shard 0, and the host that has it runs the background tasks
+BACKGROUND_SHARD = 0
+
+
+def validate(sharding: dict):
+    """:raises ValueError: If the sharding section can't be used"""
+    count = sharding.get("shard_count")
+    ids = sharding.get("shard_ids")
+    if count is not None and (not isinstance(count, int) or count < 1):
+        raise ValueError("sharding.shard_count must be a positive number")
+    if ids is not None:
+        if count is None:
+            raise ValueError("sharding.shard_ids needs shard_count")
+        if not ids or any(not isinstance(i, int) or not 0 <= i < count for i in ids):
+            raise ValueError(f"sharding.shard_ids must be between 0 and {count - 1}")
+    if "processes" in sharding:
+        raise ValueError(
+            "sharding.processes is not supported, a host runs all its shards in one process"
+        )
+
+
+def enabled(config: dict) -> bool:
+    return bool(config["system"].get("sharding"))
+
+
+def options(config: dict) -> dict:
+    """The keyword arguments that make an AutoShardedBot run the configured shards"""
+    sharding = config["system"].get("sharding") or {}
+    return {
+        key: sharding[key]
+        for key in ("shard_count", "shard_ids")
+        if sharding.get(key) is not None
+    }
+
+
+def runs_background_tasks(shard_ids: Optional[List[int]]) -> bool:
+    """Whether a host running these shards (None meaning all of them, or no sharding) runs the background tasks"""
+    return shard_ids is None or BACKGROUND_SHARD in shard_ids
+
+
+def shard_of(guild_id: int, shard_count: int) -> int:
+    """The shard Discord sends a guild's events to"""
+    return (guild_id >> 22) % shard_count
+
+
+def event_shard(args, shard_count: int) -> int:
+    """The shard an event came in on, from the guild it happened in. Events outside of a guild come in on shard 0."""
+    for arg in args:
+        guild_id = getattr(arg, "guild_id", None)
+        if guild_id is None:
+            guild = getattr(arg, "guild", None)
+            guild_id = getattr(guild, "id", None)
+        if isinstance(guild_id, int):
+            return shard_of(guild_id, shard_count)
+    return BACKGROUND_SHARD
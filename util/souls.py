@@ -1,11 +1,14 @@
+import logging
 import os
+import time
 from collections import namedtuple
-from typing import Optional
+from functools import lru_cache
+from typing import Dict, List, Optional
 from xml.etree import ElementTree
 
 import yaml
 
-cores = {}
+logger = logging.getLogger("bot")
 
 
 def format_from_soul(txt: str) -> (Optional[str], list):
@@ -21,13 +24,6 @@ def format_from_soul(txt: str) -> (Optional[str], list):
         return None
 
 
-def scan_cores(*args):
-    for f in os.listdir("ai/cores"):
-        sc = yaml.safe_load(open(f"ai/cores/{f}"))
-        cores[f] = sc["name"]
-    return [f"{k} ({cores[k]})" for k in cores]
-
-
 Soul = namedtuple(
     "Soul", ["name", "short_personality", "long_personality", "initial_plan"]
 )
@@ -61,3 +57,89 @@ Now, think through {name}'s response to the last message using the following out
 <ANALYSIS>I think [[fill in]]</ANALYSIS>
 </root>
 """
+
+
+@lru_cache(maxsize=64)
+def render_soul_prompt(soul: "Soul") -> str:
+    return SOUL_PROMPT.format(**soul._asdict())
+
+
+@lru_cache(maxsize=64)
+def render_remembrance_prompt(soul: "Soul") -> str:
+    return REMEMBRANCE_PROMPT.format(**soul._asdict())
+
+
+# A soul core file as loaded by the registry
+SoulCore = namedtuple("SoulCore", ["filename", "soul", "mtime"])
+
+
+class SoulRegistry:
+    """Loads and validates every soul core once and serves them from memory. The cores directory is re-checked at
+    most every `check_interval` seconds, and only files whose modification time changed are parsed again.
+    """
+
+    def __init__(self, path: str = "ai/cores", check_interval: float = 5):
+        self.path = path
+        self.check_interval = check_interval
+        self._cores: Dict[str, SoulCore] = {}
+        # Modification times of files that failed to load, so they aren't tried again until they change
+        self._failed: Dict[str, float] = {}
+        self._last_check = 0.0
+
+    def refresh(self, force: bool = False):
+        """Pick up added, changed and removed core files. A file that can't be loaded is logged and left out, and
+        the last good version of it, if any, is kept."""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        seen = set()
+        for entry in os.scandir(self.path):
+            if not entry.is_file() or not entry.name.endswith((".yml", ".yaml")):
+                continue
+            seen.add(entry.name)
+            mtime = entry.stat().st_mtime
+            loaded = self._cores.get(entry.name)
+            if loaded and loaded.mtime == mtime:
+                continue
+            if self._failed.get(entry.name) == mtime:
+                continue
+            try:
+                with open(entry.path) as file:
+                    soul = Soul(**yaml.safe_load(file))
+            except (OSError, yaml.YAMLError, TypeError) as e:
+                logger.error(f"Could not load soul core {entry.name}: {e}")
+                self._failed[entry.name] = mtime
+                continue
+            self._failed.pop(entry.name, None)
+            self._cores[entry.name] = SoulCore(entry.name, soul, mtime)
+        for name in set(self._cores) - seen:
+            del self._cores[name]
+        for name in set(self._failed) - seen:
+            del self._failed[name]
+
+    def get(self, core: str) -> SoulCore:
+        """Returns a soul core by file name. Autocomplete choices ("file.yml (Name)") are accepted as well.
+        :raises KeyError: if there is no such core
+        """
+        self.refresh()
+        return self._cores[core.split(" ")[0]]
+
+    def autocomplete(self, prefix: str = "") -> List[str]:
+        """Returns autocomplete choices for every core whose file or soul name starts with the given prefix"""
+        self.refresh()
+        prefix = (prefix or "").lower()
+        return [
+            f"{core.filename} ({core.soul.name})"
+            for core in sorted(self._cores.values())
+            if core.filename.lower().startswith(prefix)
+            or core.soul.name.lower().startswith(prefix)
+        ]
+
+
+registry = SoulRegistry()
+
+
+def scan_cores(ctx) -> List[str]:
+    """Autocomplete callback for soul core options"""
+    return registry.autocomplete(ctx.value)
@@ -0,0 +1,138 @@
+"""Faster startup: deferred imports, concurrent cog imports and a report of where the time went.
+
+Heavy dependencies are imported through `lazy_import`, which hands back a stand-in that imports the real module the
+first time it's used:
+
+    dateparser = lazy_import("dateparser")
+    ...
+    dateparser.parse(when)  # imported here, the first time
+
+Unless the `startup: lazy` option is set, everything deferred this way is imported in the background once the cogs
+are loaded, so the first command to need it doesn't have to wait.
+"""
+
+import asyncio
+import importlib
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+# How long loading one cog took. imported is the time taken importing its module (and everything it imports) in a
+# worker thread, setup is the time taken by load_extension on the event loop. error is why it failed, if it did.
+CogTiming = namedtuple("CogTiming", ["name", "imported", "setup", "error"])
+
+# How long each deferred import took, in seconds, once it has happened
+import_times: Dict[str, float] = {}
+# Everything deferred, by name. A cog module that is executed again replaces its stand-ins.
+_deferred: Dict[str, "Lazy"] = {}
+
+
+class Lazy:
+    """Stands in for a module (or any other object) that is expensive to create, creating it the first time one of
+    its attributes is used"""
+
+    __slots__ = ["_name", "_factory", "_target", "_lock"]
+
+    def __init__(self, name: str, factory: Callable[[], object]):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_target", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+        _deferred[name] = self
+
+    def _resolve(self):
+        target = self._target
+        if target is None:
+            with self._lock:
+                target = self._target
+                if target is None:
+                    started = time.perf_counter()
+                    target = self._factory()
+                    import_times.setdefault(self._name, time.perf_counter() - started)
+                    object.__setattr__(self, "_target", target)
+        return target
+
+    @property
+    def loaded(self) -> bool:
+        return self._target is not None
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._resolve(), name)
+
+    def __repr__(self):
+        state = "loaded" if self.loaded else "not loaded yet"
+        return f"<lazy {self._name}, {state}>"
+
+
+def lazy_import(name: str) -> Lazy:
+    """A module that's imported the first time it's used"""
+    return Lazy(name, lambda: importlib.import_module(name))
+
+
+def preload():
+    """Import (or create) everything deferred that hasn't been yet. Blocks, so run it in a thread."""
+    for deferred in list(_deferred.values()):
+        try:
+            deferred._resolve()
+        except Exception:
+            # It'll fail again, and be reported, where it's actually used
+            continue
+
+
+def _import(name: str) -> float:
+    started = time.perf_counter()
+    try:
+        importlib.import_module(name)
+    except Exception:
+        # load_extension will run into it again, and report it
+        pass
+    return time.perf_counter() - started
+
+
+async def load_extensions(bot, names: List[str], threads: int = 4) -> List[CogTiming]:
+    """Load cogs, importing their modules in worker threads first. Cogs that fail to load are logged and skipped.
+    load_extension executes each cog module again on the event loop, but by then everything it imports is cached.
+    """
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(threads, thread_name_prefix="cog-import") as pool:
+        imports = await asyncio.gather(
+            *(loop.run_in_executor(pool, _import, name) for name in names)
+        )
+    timings = []
+    for name, imported in zip(names, imports):
+        started = time.perf_counter()
+        try:
+            bot.logger.info(f"Attempting to load {name}")
+            bot.load_extension(name)
+        except Exception as e:
+            bot.logger.error(e)
+            bot.logger.error(f"Skipping {name}")
+            error = str(e)
+        else:
+            error = None
+        timings.append(CogTiming(name, imported, time.perf_counter() - started, error))
+    return timings
+
+
+def report(timings: List[CogTiming]) -> str:
+    """A table of how long each cog and each deferred import took, slowest first"""
+    lines = ["Startup timing (ms):"]
+    for timing in sorted(timings, key=lambda t: t.imported + t.setup, reverse=True):
+        lines.append(
+            f"  {timing.name:<24} import {timing.imported * 1000:7.1f}  setup {timing.setup * 1000:7.1f}"
+            + ("  FAILED" if timing.error else "")
+        )
+    pending = [name for name, d in _deferred.items() if not d.loaded]
+    for name, seconds in sorted(import_times.items(), key=lambda i: -i[1]):
+        lines.append(f"  deferred {name:<15} {seconds * 1000:7.1f}")
+    if pending:
+        lines.append(f"  not imported yet: {', '.join(sorted(pending))}")
+    return "\n".join(lines)
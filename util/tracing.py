@@ -0,0 +1,113 @@
+"""Opt-in Sentry performance tracing.
+
+Turned on by giving the `sentry` config block a sample rate:
+
+    sentry:
+      init_url: https://...
+      traces_sample_rate: 0.2
+      traces_sample_rates:
+        on_message: 0.01
+        ai chat: 1.0
+
+Every application command and event listener becomes a transaction (see `PixlBot._run_event` and
+`PixlBot.invoke_application_command`), with child spans for AI model requests, for the storage calls of cogs that
+keep their data in a `TracedBackend`, and, through Sentry's own integrations, for aiohttp (Discord API requests
+included) and requests calls. Anything else worth timing can be wrapped in `span`.
+"""
+
+import contextlib
+import functools
+from typing import Optional
+
+from blitzdb import FileBackend
+
+sentry_sdk = None
+rates = {}
+default_rate = 0.0
+
+# The storage calls cogs make, each of which becomes a span
+STORAGE_METHODS = ("get", "filter", "save", "delete", "commit")
+
+
+def enabled() -> bool:
+    return sentry_sdk is not None
+
+
+def sampler(context: dict) -> float:
+    """Pick the sample rate for a new transaction: by command or listener name first, then by event, falling back on
+    `traces_sample_rate`"""
+    transaction = context.get("transaction_context", {})
+    if transaction.get("op") == "http.server":
+        # Prometheus scrapes and liveness checks of the metrics server
+        return 0.0
+    name = transaction.get("name")
+    if name in rates:
+        return rates[name]
+    event = context.get("event")
+    if event and f"on_{event}" in rates:
+        return rates[f"on_{event}"]
+    return default_rate
+
+
+def init_options(config: dict) -> dict:
+    """The extra `sentry_sdk.init` options for a `sentry` config block, which are empty unless tracing is turned on"""
+    global default_rate, rates
+    if "traces_sample_rate" not in config:
+        return {}
+    default_rate = float(config["traces_sample_rate"])
+    rates = {
+        name: float(rate)
+        for name, rate in (config.get("traces_sample_rates") or {}).items()
+    }
+    return {"traces_sampler": sampler}
+
+
+def enable(sentry):
+    """Start tracing, once `sentry.init` has been called with `init_options`"""
+    global sentry_sdk
+    sentry_sdk = sentry
+
+
+def _traced(method):
+    @functools.wraps(method)
+    def wrapper(backend, *args, **kwargs):
+        with span("db.blitzdb", method.__name__):
+            return method(backend, *args, **kwargs)
+
+    return wrapper
+
+
+class TracedBackend(FileBackend):
+    """A blitzdb FileBackend whose storage calls become spans while tracing is on. Cogs use it in place of FileBackend
+    to have their storage traced."""
+
+
+for _method in STORAGE_METHODS:
+    setattr(TracedBackend, _method, _traced(getattr(FileBackend, _method)))
+
+
+def transaction(name: str, op: str, **sampling):
+    """A context manager that runs its body as a transaction in a scope of its own, so concurrent transactions don't
+    pick up each other's spans. It does nothing when tracing is off.
+    :param sampling: Extra values handed to the sampler
+    """
+    if sentry_sdk is None:
+        return contextlib.nullcontext()
+    return _transaction(name, op, sampling)
+
+
+@contextlib.contextmanager
+def _transaction(name: str, op: str, sampling: dict):
+    with sentry_sdk.Hub(sentry_sdk.Hub.current):
+        with sentry_sdk.start_transaction(
+            name=name, op=op, source="component", custom_sampling_context=sampling
+        ) as tx:
+            yield tx
+
+
+def span(op: str, description: Optional[str] = None):
+    """A context manager timing its body as a child span of the current transaction. It does nothing when tracing is
+    off or there is no transaction running."""
+    if sentry_sdk is None or sentry_sdk.Hub.current.scope.span is None:
+        return contextlib.nullcontext()
+    return sentry_sdk.start_span(op=op, description=description)
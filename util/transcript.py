@@ -0,0 +1,137 @@
+"""Lossless conversation export and import.
+
+An export is JSON Lines: a header object describing the conversation, followed by one object per line of the
+conversation, in order:
+
+    {"version": 1, "name": "...", "model": "gpt-4", "prompt_info": null, "config": 3, "soul": null}
+    {"role": "system", "content": "..."}
+    {"role": "user", "content": "..."}
+
+Exports can be gzip-compressed, or zstd-compressed if the zstandard package is installed. Imports detect the
+compression on their own.
+"""
+
+import gzip
+import io
+import json
+from typing import BinaryIO, Iterator, List, Tuple
+
+from util.chatgpt import ConversationLine, GPTUser, Model, UserConfig
+from util.souls import Soul
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+VERSION = 1
+ROLES = ("system", "user", "assistant")
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+MAX_SIZE = 4 * 1024 * 1024  # the largest uncompressed export accepted, in bytes
+
+
+def compressions() -> List[str]:
+    """The compression formats available for exports"""
+    return ["none", "gzip"] + (["zstd"] if zstandard else [])
+
+
+def export_lines(gu: GPTUser) -> Iterator[str]:
+    header = {
+        "version": VERSION,
+        "name": gu.name,
+        "model": gu.model.model,
+        "prompt_info": gu.prompt_info,
+        "config": gu.config.value,
+        "soul": gu.soul._asdict() if gu.soul else None,
+    }
+    yield json.dumps(header) + "\n"
+    for line in gu.conversation:
+        yield json.dumps({"role": line["role"], "content": line["content"]}) + "\n"
+
+
+def write_export(gu: GPTUser, file: BinaryIO, compression: str = "none"):
+    """Write a user's conversation to a binary file object, one line at a time
+    :param compression: One of `compressions()`
+    """
+    if compression == "gzip":
+        out = gzip.GzipFile(fileobj=file, mode="wb")
+    elif compression == "zstd" and zstandard:
+        out = zstandard.ZstdCompressor().stream_writer(file, closefd=False)
+    elif compression == "none":
+        out = None
+    else:
+        raise ValueError(f"Unsupported compression {compression}")
+    for line in export_lines(gu):
+        (out or file).write(line.encode("utf-8"))
+    if out:
+        out.close()
+
+
+def _decompress(data: bytes, limit: int) -> bytes:
+    if data.startswith(GZIP_MAGIC):
+        raw = gzip.GzipFile(fileobj=io.BytesIO(data)).read(limit + 1)
+    elif data.startswith(ZSTD_MAGIC):
+        if not zstandard:
+            raise ValueError("zstd compressed conversations are not supported here")
+        raw = (
+            zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read(limit + 1)
+        )
+    else:
+        raw = data
+    if len(raw) > limit:
+        raise ValueError("Conversation is too large")
+    return raw
+
+
+def read_export(
+    data: bytes, limit: int = MAX_SIZE
+) -> Tuple[dict, List[ConversationLine]]:
+    """Parse and validate an export
+    :param limit: The largest uncompressed size accepted, in bytes
+    :return: The header and the conversation
+    """
+    lines = _decompress(data, limit).decode("utf-8").splitlines()
+    if not lines:
+        raise ValueError("Conversation is empty")
+    header = json.loads(lines[0])
+    if not isinstance(header, dict) or header.get("version") != VERSION:
+        raise ValueError("Not a conversation export, or from an unsupported version")
+    conversation = []
+    for n, text in enumerate(lines[1:], 2):
+        line = json.loads(text)
+        if (
+            not isinstance(line, dict)
+            or line.get("role") not in ROLES
+            or not isinstance(line.get("content"), str)
+        ):
+            raise ValueError(f"Line {n} is not a valid conversation line")
+        conversation.append({"role": line["role"], "content": line["content"]})
+    if not conversation or conversation[0]["role"] != "system":
+        raise ValueError("Conversation does not start with a system prompt")
+    return header, conversation
+
+
+def restore(
+    data: bytes, uid: int, uname: str, model: Model, limit: int = MAX_SIZE
+) -> GPTUser:
+    """Rebuild a GPTUser from an export. The conversation continues with the given model rather than the exported
+    one, since that is the model its new home is allowed to use. Token counts are recomputed, so this is best run
+    in a worker thread.
+    """
+    header, conversation = read_export(data, limit)
+    config = UserConfig(header.get("config", 0))
+    # The exported system prompt already carries the name suffix, if there was one
+    gu = GPTUser(
+        uid=uid,
+        uname=uname,
+        sysprompt=conversation[0]["content"],
+        prompt_info=header.get("prompt_info"),
+        model=model,
+        config=config & ~UserConfig.NAMESUFFIX,
+    )
+    gu.config = config
+    if header.get("soul"):
+        gu.soul = Soul(**header["soul"])
+    gu.conversation = conversation
+    return gu
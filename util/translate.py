@@ -0,0 +1,212 @@
+import asyncio
+import re
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from util.chatgpt import ConversationLine, Model
+
+# Sends a conversation to a model on behalf of the message or command contexts of the lines in it, returning the reply
+# or None. The usage is shared out between the contexts.
+SendFunction = Callable[
+    [List[ConversationLine], Model, List[object]], Awaitable[Optional[str]]
+]
+# A line waiting to be batched: its text, the context it's translated for, and where its translation goes
+Pending = Tuple[str, object, asyncio.Future]
+
+NUMBERED_LINE = re.compile(r"^\s*(\d+)[.):]\s?(.*)$")
+
+
+class TranslationSession:
+    """Someone's ongoing translations in one direction, with the last few lines kept for consistency"""
+
+    __slots__ = ["source", "target", "window"]
+
+    def __init__(self, source: str, target: str, window: int = 3):
+        self.source = source
+        self.target = target
+        self.window: Deque[Tuple[str, str]] = deque(maxlen=window)
+
+    @property
+    def pair(self) -> Tuple[str, str]:
+        return self.source.lower(), self.target.lower()
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+class TranslationEngine:
+    """Translates lines statelessly: each request carries only the translator prompt and a session's last few lines,
+    never a whole conversation. Translations are remembered per language pair. A single line with nothing else pending
+    for its session and model is sent right away, and the lines for the same model that follow it within
+    `batch_window` seconds are translated together in the next request.
+    """
+
+    def __init__(
+        self,
+        send: SendFunction,
+        memory_size: int = 2048,
+        batch_window: float = 0.5,
+        max_batch: int = 10,
+    ):
+        """
+        :param send: How requests get to the model
+        :param memory_size: How many translations are remembered per language pair
+        :param batch_window: How long after a request the next lines wait for others to share theirs, in seconds
+        :param max_batch: The most lines translated in one request
+        """
+        self.send = send
+        self.memory_size = memory_size
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.memory: Dict[Tuple[str, str], OrderedDict] = {}
+        # Keyed by session and model, since a session's lines can go to a degraded model when over quota
+        self._batches: Dict[Tuple[int, Model], List[Pending]] = {}
+        # The tasks sending each batch, for as long as lines for it should wait to be batched
+        self._flushes: Dict[Tuple[int, Model], asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def recall(self, session: TranslationSession, text: str) -> Optional[str]:
+        memory = self.memory.get(session.pair)
+        translation = memory.get(normalize(text)) if memory else None
+        if translation:
+            memory.move_to_end(normalize(text))
+        return translation
+
+    def remember(self, session: TranslationSession, text: str, translation: str):
+        memory = self.memory.setdefault(session.pair, OrderedDict())
+        memory[normalize(text)] = translation
+        memory.move_to_end(normalize(text))
+        while len(memory) > self.memory_size:
+            memory.popitem(last=False)
+
+    @staticmethod
+    def prompt(session: TranslationSession, numbered: bool) -> str:
+        prompt = (
+            f"You are an expert translator, fluent in both {session.source} and {session.target}. "
+            f"Translate what the user says from {session.source} to {session.target}. "
+        )
+        if numbered:
+            prompt += "Each line is numbered. Reply with only the translations, numbered the same way, one per line."
+        else:
+            prompt += "Reply with only the translation."
+        if session.window:
+            prompt += (
+                "\nFor consistency, these are the most recent lines you translated:\n"
+                + "\n".join(
+                    f"{source} => {translation}"
+                    for source, translation in session.window
+                )
+            )
+        return prompt
+
+    async def translate(
+        self, session: TranslationSession, text: str, model: Model, context=None
+    ) -> Optional[str]:
+        """Translate one line (or paragraph), from memory if possible
+        :param context: The message or command context the translation is for, passed on to `send`
+        :return: The translation, or None if the model could not be reached
+        """
+        translation = self.recall(session, text)
+        if translation:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if "\n" in text or self.max_batch <= 1:
+                translation = await self._translate_one(session, text, model, context)
+            else:
+                translation = await self._batched(session, text, model, context)
+            if translation:
+                self.remember(session, text, translation)
+        if translation:
+            session.window.append((text, translation))
+        return translation
+
+    async def _translate_one(
+        self, session: TranslationSession, text: str, model: Model, context
+    ) -> Optional[str]:
+        conversation = [
+            {"role": "system", "content": self.prompt(session, False)},
+            {"role": "user", "content": text},
+        ]
+        return await self.send(conversation, model, [context])
+
+    async def _batched(
+        self, session: TranslationSession, text: str, model: Model, context
+    ) -> Optional[str]:
+        key = (id(session), model)
+        if key not in self._flushes:
+            # Nothing to wait for, but the lines right behind this one are collected to be sent together
+            self._flushes[key] = asyncio.create_task(self._flush_later(session, model))
+            return await self._translate_one(session, text, model, context)
+        future = asyncio.get_running_loop().create_future()
+        batch = self._batches.setdefault(key, [])
+        batch.append((text, context, future))
+        if len(batch) >= self.max_batch:
+            # Full, so it goes now and later lines start a new batch
+            del self._batches[key]
+            await self._send_batch(session, batch, model)
+        return await future
+
+    async def _flush_later(self, session: TranslationSession, model: Model):
+        """Send the lines collected for a session and model every `batch_window` seconds, until none arrive"""
+        key = (id(session), model)
+        try:
+            while True:
+                await asyncio.sleep(self.batch_window)
+                batch = self._batches.pop(key, None)
+                if not batch:
+                    return
+                await self._send_batch(session, batch, model)
+        finally:
+            del self._flushes[key]
+
+    async def _send_batch(
+        self, session: TranslationSession, batch: List[Pending], model: Model
+    ):
+        try:
+            translations = await self._translate_batch(
+                session,
+                [text for text, _, _ in batch],
+                model,
+                [context for _, context, _ in batch],
+            )
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), translation in zip(batch, translations):
+            future.set_result(translation)
+
+    async def _translate_batch(
+        self,
+        session: TranslationSession,
+        lines: List[str],
+        model: Model,
+        contexts: List[object],
+    ) -> List[Optional[str]]:
+        if len(lines) == 1:
+            return [await self._translate_one(session, lines[0], model, contexts[0])]
+        conversation = [
+            {"role": "system", "content": self.prompt(session, True)},
+            {
+                "role": "user",
+                "content": "\n".join(f"{n}. {line}" for n, line in enumerate(lines, 1)),
+            },
+        ]
+        reply = await self.send(conversation, model, contexts)
+        if not reply:
+            return [None] * len(lines)
+        translations = {}
+        for line in reply.splitlines():
+            match = NUMBERED_LINE.match(line)
+            if match:
+                translations[int(match.group(1))] = match.group(2).strip()
+        if len(translations) == len(lines):
+            return [translations.get(n) for n in range(1, len(lines) + 1)]
+        # The model didn't keep to the format, so fall back to one request per line
+        return [
+            await self._translate_one(session, line, model, context)
+            for line, context in zip(lines, contexts)
+        ]
@@ -0,0 +1,145 @@
+from collections import defaultdict, deque
+from datetime import date
+from typing import Deque, Dict, List, Optional, Tuple
+
+from blitzdb import Document
+
+from util.chatgpt import Completion
+from util.metrics import percentile
+
+# (guild ID, user ID, model name, command)
+UsageKey = Tuple[Optional[int], Optional[int], str, str]
+COUNTERS = ["requests", "errors", "prompt_tokens", "completion_tokens", "cached_tokens"]
+
+
+class UsageRecord(Document):
+    """Daily usage totals for one guild, user, model and command"""
+
+    pass
+
+
+def split_completion(completion: Completion, parts: int) -> List[Completion]:
+    """Split a completion's tokens between `parts` requesters as evenly as whole tokens allow, for a request made on
+    behalf of several at once"""
+
+    def split(tokens: int) -> List[int]:
+        return [tokens // parts + (n < tokens % parts) for n in range(parts)]
+
+    return [
+        completion._replace(
+            prompt_tokens=prompt, completion_tokens=reply, cached_tokens=cached
+        )
+        for prompt, reply, cached in zip(
+            split(completion.prompt_tokens),
+            split(completion.completion_tokens),
+            split(completion.cached_tokens),
+        )
+    ]
+
+
+class UsageTracker:
+    """Aggregates model token usage and latency in memory, per guild, user, model and command. Totals are written to
+    storage in batches by `flush`, rather than on every request."""
+
+    def __init__(self, latency_samples: int = 1000):
+        """
+        :param latency_samples: How many of the most recent latencies are kept per model and command, for percentiles
+        """
+        self.latency_samples = latency_samples
+        # Totals since the bot started, summed by each part of the usage key on its own, so they grow with the number
+        # of guilds, users, models and commands rather than with every combination of them
+        self.totals: List[Dict[object, Dict[str, int]]] = [
+            defaultdict(lambda: dict.fromkeys(COUNTERS, 0)) for _ in range(4)
+        ]
+        self.latencies: Dict[Tuple[str, str], Deque[float]] = defaultdict(
+            lambda: deque(maxlen=self.latency_samples)
+        )
+        self._pending: Dict[UsageKey, Dict[str, int]] = defaultdict(
+            lambda: dict.fromkeys(COUNTERS, 0)
+        )
+
+    def record(
+        self,
+        guild_id: Optional[int],
+        user_id: Optional[int],
+        model: str,
+        command: str,
+        completion: Optional[Completion],
+        latency: float,
+    ):
+        """Record one model request. A missing completion counts as an error."""
+        key = (guild_id, user_id, model, command)
+        for counters in (
+            *(totals[part] for totals, part in zip(self.totals, key)),
+            self._pending[key],
+        ):
+            counters["requests"] += 1
+            if completion:
+                counters["prompt_tokens"] += completion.prompt_tokens
+                counters["completion_tokens"] += completion.completion_tokens
+                counters["cached_tokens"] += completion.cached_tokens
+            else:
+                counters["errors"] += 1
+        self.latencies[(model, command)].append(latency)
+
+    def summarize(self, dimension: int) -> Dict[object, Dict[str, int]]:
+        """The totals by one part of the usage key (0: guild, 1: user, 2: model, 3: command)"""
+        return {
+            part: dict(counters) for part, counters in self.totals[dimension].items()
+        }
+
+    def grand_total(self) -> Dict[str, int]:
+        total = dict.fromkeys(COUNTERS, 0)
+        # Every request has exactly one model
+        for counters in self.totals[2].values():
+            for counter, value in counters.items():
+                total[counter] += value
+        return total
+
+    def latency_percentiles(
+        self, model: Optional[str] = None, command: Optional[str] = None
+    ) -> Dict[str, float]:
+        """p50, p95 and p99 latency in seconds, optionally narrowed down to a model and/or command"""
+        samples: List[float] = []
+        for (m, c), latencies in self.latencies.items():
+            if (model is None or m == model) and (command is None or c == command):
+                samples.extend(latencies)
+        return {f"p{p}": percentile(samples, p) for p in (50, 95, 99)}
+
+    def take_pending(self) -> Dict[UsageKey, Dict[str, int]]:
+        """Take the usage recorded since the last call, to be written with `save`. Call this on the event loop, so
+        nothing is recorded while it's being taken."""
+        pending, self._pending = self._pending, defaultdict(
+            lambda: dict.fromkeys(COUNTERS, 0)
+        )
+        return dict(pending)
+
+    @staticmethod
+    def save(backend, pending: Dict[UsageKey, Dict[str, int]]) -> int:
+        """Add usage taken with `take_pending` to today's stored totals. This blocks on the database, so run it in a
+        thread.
+        :return: The number of records written
+        """
+        day = date.today().isoformat()
+        for (guild_id, user_id, model, command), counters in pending.items():
+            query = {
+                "day": day,
+                "guild_id": guild_id,
+                "user_id": user_id,
+                "model": model,
+                "command": command,
+            }
+            try:
+                record = backend.get(UsageRecord, query)
+            except UsageRecord.DoesNotExist:
+                record = UsageRecord({**query, **dict.fromkeys(COUNTERS, 0)})
+            for counter, value in counters.items():
+                record[counter] = record.get(counter, 0) + value
+            backend.save(record)
+        return len(pending)
+
+    def flush(self, backend) -> int:
+        """Add the usage recorded since the last flush to today's stored totals, right away
+        :return: The number of records written
+        """
+        return self.save(backend, self.take_pending())
@@ -0,0 +1,118 @@
+"""A pool of worker processes for CPU-heavy work, so one big parse or tokenization doesn't hold up every guild.
+
+    from util import workers
+    flavors = await workers.run(parse_cookie_content, html)
+
+The function and its arguments are pickled over to a worker process, so the function has to be defined at the top
+level of a module and everything passed to it (and returned) has to be picklable. Until the bot sets up the pool,
+or with `workers: false` in the config, functions are simply called in place.
+"""
+
+import asyncio
+import importlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, Sequence
+
+from util import metrics
+
+# Imported in each worker as it starts, so the first job doesn't pay for it
+DEFAULT_WARMUP = ("bs4", "dateparser", "recurrent.event_parser", "tiktoken")
+
+# The bot's pool, once it has one
+pool: Optional["WorkerPool"] = None
+
+
+def _warm_up(modules: Sequence[str]):
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            # It'll fail again where it's actually used, and be reported there
+            continue
+
+
+def _call(func: Callable, args: tuple, kwargs: dict):
+    # Runs in the worker: when the job came off the queue, and what it returned
+    return time.time(), func(*args, **kwargs)
+
+
+def _name(func: Callable) -> str:
+    return f"{func.__module__}.{getattr(func, '__qualname__', repr(func))}"
+
+
+class WorkerPool:
+    """Worker processes, started from scratch (spawned) so they don't inherit the bot's threads and connections"""
+
+    def __init__(self, processes: Optional[int] = None, warmup: Sequence[str] = None):
+        """
+        :param processes: How many worker processes to run, by default one per CPU
+        :param warmup: Modules to import in each worker as it starts
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.warmup = list(DEFAULT_WARMUP if warmup is None else warmup)
+        self.pending = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        metrics.registry.gauge(
+            "pixlbot_worker_pending",
+            "Jobs waiting for or running in a worker process",
+            lambda: self.pending,
+        )
+
+    def _start_executor(self) -> ProcessPoolExecutor:
+        self._executor = ProcessPoolExecutor(
+            self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_up,
+            initargs=(self.warmup,),
+        )
+        return self._executor
+
+    def start(self):
+        """Start the workers now, and warm them up, rather than on the first job"""
+        executor = self._executor or self._start_executor()
+        for _ in range(self.processes):
+            executor.submit(time.time)
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """Run `func(*args, **kwargs)` in a worker process and return what it returns
+        :raises: Whatever `func` raises
+        """
+        executor = self._executor or self._start_executor()
+        name = _name(func)
+        submitted = time.time()
+        status = "error"
+        self.pending += 1
+        try:
+            started, result = await asyncio.get_running_loop().run_in_executor(
+                executor, _call, func, args, kwargs
+            )
+            status = "ok"
+        except BrokenProcessPool:
+            # A worker died (killed, or out of memory). Start over with fresh workers for the next job.
+            if self._executor is executor:
+                executor.shutdown(wait=False)
+                self._executor = None
+            raise
+        finally:
+            self.pending -= 1
+            metrics.WORKER_DURATION.observe(
+                time.time() - submitted, function=name, status=status
+            )
+        metrics.WORKER_WAIT.observe(max(started - submitted, 0), function=name)
+        return result
+
+    def stop(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+async def run(func: Callable, *args, **kwargs):
+    """Run `func(*args, **kwargs)` in the bot's worker pool, or in place if there isn't one"""
+    if pool is None:
+        return func(*args, **kwargs)
+    return await pool.run(func, *args, **kwargs)